@@ -12,3 +12,9 @@ loglevel = getenv('WSGI_LOG_LEVEL', 'info')
 keepalive = getenv('WSGI_KEEP_ALIVE', 2)
 worker_tmp_dir = '/dev/shm'
 worker_class = getenv('GUNICORN_WORKER_CLASS', 'meinheld.gmeinheld.MeinheldWorker')
+
+
+def post_worker_init(worker):
+    # Imported here, as the application gets loaded after the configuration.
+    from redirect import start_aliases_loader
+    start_aliases_loader()
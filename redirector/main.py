@@ -3,12 +3,17 @@
 from bottle import redirect, response, route, run, default_app
 from decouple import config
 
+import redirect as bundle_redirect
 from redirect import calculate_redirect
 
 DEBUG = config('DEBUG', default=False, cast=bool)
 
 SNIPPET_BUNDLE_PREGEN_REDIRECT_TIMEOUT = config(
     'SNIPPET_BUNDLE_PREGEN_REDIRECT_TIMEOUT', default=60 * 60 * 24, cast=int)  # One day
+# Redirects are cached for less time with BUNDLE_LOCALE_ALIASES, as locales
+# stop being aliases once their bundles differ.
+BUNDLE_ALIASES_REDIRECT_TIMEOUT = config(
+    'BUNDLE_ALIASES_REDIRECT_TIMEOUT', default=60 * 15, cast=int)  # 15 minutes
 
 GIT_SHA = config('GIT_SHA', default='HEAD')
 
@@ -53,13 +58,14 @@ def healthz():
 def redirect_to_bundle(*args, **kwargs):
     locale, distribution, full_url = calculate_redirect(*args, **kwargs)
 
-    response.set_header(
-        'Cache-Control',
-        f'public, max-age={SNIPPET_BUNDLE_PREGEN_REDIRECT_TIMEOUT}'
-    )
+    max_age = SNIPPET_BUNDLE_PREGEN_REDIRECT_TIMEOUT
+    if bundle_redirect.BUNDLE_LOCALE_ALIASES:
+        max_age = min(max_age, BUNDLE_ALIASES_REDIRECT_TIMEOUT)
+    response.set_header('Cache-Control', f'public, max-age={max_age}')
     return redirect(full_url)
 
 
 if __name__ == '__main__':
     if DEBUG:
+        bundle_redirect.start_aliases_loader()
         run(host='localhost', port=8000)
@@ -1,10 +1,76 @@
+import json
+import logging
+import threading
+import time
 from urllib.parse import urljoin
+from urllib.request import Request, urlopen
 
 from decouple import config
 
+logger = logging.getLogger(__name__)
+
 MEDIA_BUNDLES_PREGEN_ROOT = config('MEDIA_BUNDLES_PREGEN_ROOT', default='bundles-pregen/')
 SITE_URL = config('SITE_URL', default='')
 CDN_URL = config('CDN_URL', default='')
+# Must match the BUNDLE_CHANNEL_PARTITIONING setting of snippets-service.
+BUNDLE_CHANNEL_PARTITIONING = config('BUNDLE_CHANNEL_PARTITIONING', default=False, cast=bool)
+CHANNELS = ('release', 'beta', 'aurora', 'nightly', 'esr')
+# Must match the BUNDLE_LOCALE_ALIASES setting of snippets-service.
+BUNDLE_LOCALE_ALIASES = config('BUNDLE_LOCALE_ALIASES', default=False, cast=bool)
+# URL of the bundle alias map, next to the bundles it maps. It gets requested
+# with `Cache-Control: no-cache`, for a CDN to revalidate its copy.
+BUNDLE_ALIASES_URL = config(
+    'BUNDLE_ALIASES_URL',
+    default=urljoin(CDN_URL or SITE_URL, f'{MEDIA_BUNDLES_PREGEN_ROOT}/aliases.json'))
+# Seconds between reloads of the bundle alias map.
+BUNDLE_ALIASES_REFRESH = config('BUNDLE_ALIASES_REFRESH', default=60, cast=int)
+BUNDLE_ALIASES_TIMEOUT = config('BUNDLE_ALIASES_TIMEOUT', default=5, cast=int)
+
+_aliases = {'map': {}, 'loader': None}
+
+
+def load_aliases():
+    """Loads the map of aliased bundle paths to the paths of the bundles they
+    are identical to from BUNDLE_ALIASES_URL.
+
+    The last loaded map stays in use while the alias map can't be loaded.
+    Returns whether it got loaded.
+
+    """
+    request = Request(BUNDLE_ALIASES_URL, headers={'Cache-Control': 'no-cache'})
+    try:
+        with urlopen(request, timeout=BUNDLE_ALIASES_TIMEOUT) as fp:
+            _aliases['map'] = json.loads(fp.read())
+    except (OSError, ValueError):
+        return False
+    return True
+
+
+def _reload_aliases():
+    while True:
+        time.sleep(BUNDLE_ALIASES_REFRESH)
+        load_aliases()
+
+
+def start_aliases_loader():
+    """Loads the bundle alias map and starts a thread reloading it every
+    BUNDLE_ALIASES_REFRESH seconds, so that requests never wait for it.
+
+    Gets called once per worker process, see `post_worker_init` in config.py.
+
+    """
+    if not BUNDLE_LOCALE_ALIASES or _aliases['loader']:
+        return
+    if not load_aliases():
+        logger.warning('Could not load the bundle alias map from %s. Aliased bundles '
+                       'get redirected to their own path until it loads.', BUNDLE_ALIASES_URL)
+    _aliases['loader'] = threading.Thread(target=_reload_aliases, daemon=True)
+    _aliases['loader'].start()
+
+
+def get_aliases():
+    """Returns the last loaded bundle alias map."""
+    return _aliases['map']
 
 
 def calculate_redirect(*args, **kwargs):
@@ -24,11 +90,22 @@ def calculate_redirect(*args, **kwargs):
     else:
         distribution = 'default'
 
-    filename = (
-        f'{MEDIA_BUNDLES_PREGEN_ROOT}/{product}/'
-        f'{locale}/{distribution}.json'
-    )
+    if BUNDLE_CHANNEL_PARTITIONING:
+        # Channels like `release-cck-foo` of partner builds get the bundle of
+        # their base channel and unknown channels the release bundle.
+        channel = kwargs.get('channel', '').lower().split('-', 1)[0]
+        if channel not in CHANNELS:
+            channel = 'release'
+        path = f'{product}/{locale}/{channel}/{distribution}.json'
+    else:
+        path = f'{product}/{locale}/{distribution}.json'
+
+    # Locales with the same bundle as another locale get redirected to the
+    # bundle of that locale.
+    if BUNDLE_LOCALE_ALIASES:
+        path = get_aliases().get(path, path)
 
+    filename = f'{MEDIA_BUNDLES_PREGEN_ROOT}/{path}'
     full_url = urljoin(CDN_URL or SITE_URL, filename)
 
     # Return calculated locale, distribution, full_url
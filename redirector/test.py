@@ -36,6 +36,90 @@ def test_redirect_calculate_redirect_default_experiment():
     assert distribution == 'default'
 
 
+@patch('redirect.BUNDLE_CHANNEL_PARTITIONING', True)
+@patch('redirect.SITE_URL', 'https://www.example.com')
+def test_redirect_calculate_redirect_channel():
+    full_url = redirect.calculate_redirect(
+        locale='en-us', channel='Nightly', distribution='default')[2]
+    assert full_url == 'https://www.example.com/bundles-pregen/Firefox/en-us/nightly/default.json'
+
+    full_url = redirect.calculate_redirect(
+        locale='en-us', channel='release-cck-foo', distribution='experiment-foo')[2]
+    assert full_url == 'https://www.example.com/bundles-pregen/Firefox/en-us/release/foo.json'
+
+    full_url = redirect.calculate_redirect(
+        locale='en-us', channel='default', distribution='default')[2]
+    assert full_url == 'https://www.example.com/bundles-pregen/Firefox/en-us/release/default.json'
+
+
+@patch('redirect.BUNDLE_LOCALE_ALIASES', True)
+@patch('redirect.SITE_URL', 'https://www.example.com')
+@patch('redirect.get_aliases')
+def test_redirect_calculate_redirect_alias(get_aliases):
+    get_aliases.return_value = {'Firefox/en-gb/default.json': 'Firefox/en-us/default.json'}
+    full_url = redirect.calculate_redirect(locale='en-GB', distribution='default')[2]
+    assert full_url == 'https://www.example.com/bundles-pregen/Firefox/en-us/default.json'
+
+    full_url = redirect.calculate_redirect(locale='de', distribution='default')[2]
+    assert full_url == 'https://www.example.com/bundles-pregen/Firefox/de/default.json'
+
+
+@patch('redirect._aliases', {'map': {}, 'loader': None})
+@patch('redirect.BUNDLE_ALIASES_URL', 'https://origin.example.com/bundles-pregen/aliases.json')
+@patch('redirect.urlopen')
+def test_redirect_load_aliases(urlopen):
+    urlopen.return_value.__enter__.return_value.read.return_value = (
+        b'{"Firefox/en-gb/default.json": "Firefox/en-us/default.json"}')
+    aliases = {'Firefox/en-gb/default.json': 'Firefox/en-us/default.json'}
+    assert redirect.get_aliases() == {}
+    assert redirect.load_aliases()
+    assert redirect.get_aliases() == aliases
+    request = urlopen.call_args[0][0]
+    assert request.full_url == 'https://origin.example.com/bundles-pregen/aliases.json'
+    assert request.get_header('Cache-control') == 'no-cache'
+    assert urlopen.call_args[1] == {'timeout': 5}
+
+    # Requests only read the loaded map.
+    assert redirect.get_aliases() == aliases
+    assert urlopen.call_count == 1
+
+    # The last map stays in use when loading fails.
+    urlopen.side_effect = OSError
+    assert not redirect.load_aliases()
+    assert redirect.get_aliases() == aliases
+
+
+@patch('redirect._aliases', {'map': {}, 'loader': None})
+@patch('redirect.threading')
+@patch('redirect.logger')
+@patch('redirect.load_aliases')
+def test_redirect_start_aliases_loader(load_aliases, logger, threading):
+    redirect.start_aliases_loader()
+    assert not load_aliases.called
+
+    load_aliases.return_value = True
+    with patch('redirect.BUNDLE_LOCALE_ALIASES', True):
+        redirect.start_aliases_loader()
+        redirect.start_aliases_loader()
+    load_aliases.assert_called_once_with()
+    assert not logger.warning.called
+    threading.Thread.assert_called_once_with(target=redirect._reload_aliases, daemon=True)
+    threading.Thread.return_value.start.assert_called_once_with()
+
+
+@patch('redirect._aliases', {'map': {}, 'loader': None})
+@patch('redirect.BUNDLE_LOCALE_ALIASES', True)
+@patch('redirect.threading')
+@patch('redirect.logger')
+@patch('redirect.load_aliases')
+def test_redirect_start_aliases_loader_failure(load_aliases, logger, threading):
+    # Failing to load the alias map gets logged and keeps reloading it.
+    load_aliases.return_value = False
+    redirect.start_aliases_loader()
+    assert logger.warning.called
+    threading.Thread.return_value.start.assert_called_once_with()
+
+
 def test_main_index():
     assert main.index() == ''
 
@@ -58,3 +142,15 @@ def test_main_redirect_to_bundle(calculate_redirect, redirect_mock, response_moc
     main.redirect_to_bundle(locale='fr', distribution='default')
     assert redirect_mock.called_with('https://www.example.com/bundle.json')
     response_mock.set_header.assert_called_with('Cache-Control', 'public, max-age=90')
+
+
+@patch('redirect.BUNDLE_LOCALE_ALIASES', True)
+@patch('main.BUNDLE_ALIASES_REDIRECT_TIMEOUT', 30)
+@patch('main.SNIPPET_BUNDLE_PREGEN_REDIRECT_TIMEOUT', 90)
+@patch('main.response')
+@patch('main.redirect')
+@patch('main.calculate_redirect')
+def test_main_redirect_to_bundle_aliases(calculate_redirect, redirect_mock, response_mock):
+    calculate_redirect.return_value = ('fr', 'default', 'https://www.example.com/bundle.json')
+    main.redirect_to_bundle(locale='fr', distribution='default')
+    response_mock.set_header.assert_called_with('Cache-Control', 'public, max-age=30')
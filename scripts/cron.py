@@ -2,6 +2,7 @@ from __future__ import print_function
 import datetime
 import os
 import sys
+import threading
 from subprocess import check_call
 
 from django.conf import settings
@@ -10,16 +11,15 @@ from django.db import connection
 import babis
 from apscheduler.schedulers.blocking import BlockingScheduler
 
+from snippets.base import bundles
 from snippets.base.util import create_countries
 
 
 MANAGE = os.path.join(settings.ROOT, 'manage.py')
 schedule = BlockingScheduler()
-
-# Used by generate_bundles commands. This is intentionally here and not in
-# a persistent storage to force all bundle regeneration when we restart the
-# service, which is typically when we push new code.
-last_timestamp = 0
+# Bundle generation and the promotion of prestaged bundles both update the
+# bundle manifest.
+bundles_lock = threading.Lock()
 
 
 def call_command(command):
@@ -68,14 +68,34 @@ def job_update_product_details():
 @scheduled_job('cron', month='*', day='*', hour='*', minute='*', max_instances=1, coalesce=True)
 @babis.decorator(ping_after=settings.DEAD_MANS_SNITCH_UPDATE_JOBS)
 def job_update_jobs():
-    global last_timestamp
-    call_command('update_jobs')
-    utc_now = datetime.datetime.utcnow()
-    if last_timestamp:
-        call_command('generate_bundles --timestamp "{}"'.format(last_timestamp))
-    else:
-        call_command('generate_bundles')
-    last_timestamp = utc_now
+    with bundles_lock:
+        call_command('update_jobs')
+        # Regenerates only the bundles marked as dirty. All bundles get
+        # regenerated when new code gets deployed. The bundle_daemon process
+        # does this as soon as bundles get marked, when enabled.
+        if not settings.BUNDLE_DAEMON:
+            call_command('generate_bundles --dirty')
+
+
+def job_promote_prestaged_bundles():
+    with bundles_lock:
+        bundles.promote_prestaged_bundles()
+    connection.close()
+
+
+def job_prestage_bundles():
+    call_command('prestage_bundles')
+    # Prestaged bundles get promoted at their boundary, instead of on the
+    # next run of job_update_jobs. The bundle_daemon process does this when
+    # enabled.
+    if not settings.BUNDLE_DAEMON:
+        for boundary in bundles.get_prestaged_boundaries():
+            schedule.add_job(
+                job_promote_prestaged_bundles, 'date', run_date=boundary, timezone='UTC',
+                id=f'job_promote_prestaged_bundles_{boundary:%Y%m%d%H%M%S%f}',
+                replace_existing=True, misfire_grace_time=None,
+            )
+        connection.close()
 
 
 @babis.decorator(ping_after=settings.DEAD_MANS_SNITCH_FETCH_METRICS)
@@ -88,6 +108,12 @@ def job_fetch_daily_metrics():
     call_command('fetch_daily_metrics')
 
 
+if settings.BUNDLE_PRESTAGE:
+    scheduled_job(
+        'cron', month='*', day='*', hour='*', minute='*/10', max_instances=1, coalesce=True
+    )(job_prestage_bundles)
+
+
 if settings.REDASH_API_KEY:
     scheduled_job(
         'cron', month='*', day='*', hour='*', minute='10', max_instances=1, coalesce=True
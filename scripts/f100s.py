@@ -11,6 +11,8 @@ import csv
 import io
 import itertools
 
+from django.db.models import Q
+
 from snippets.base.models import ASRSnippet, Job
 
 
@@ -30,9 +32,10 @@ def run():
     for locale in {'de', 'en', 'es', 'id', 'pl', 'pt-br', 'ru', 'zh-cn', 'zh-tw', 'fr'}:
         csvfile = io.StringIO()
         csvwriter = csv.writer(csvfile, dialect=csv.excel, quoting=csv.QUOTE_ALL)
-        s = ASRSnippet.objects.filter(locale__code__contains=f',{locale}',
+        s = ASRSnippet.objects.filter(Q(locale__codes__code=locale) |
+                                      Q(locale__codes__code__startswith=f'{locale}-'),
                                       name__icontains='f100',
-                                      jobs__status=Job.PUBLISHED)
+                                      jobs__status=Job.PUBLISHED).distinct()
         snippets = {}
         count = 0
         for i in range(1, 18):
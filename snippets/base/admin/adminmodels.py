@@ -17,6 +17,7 @@ from taggit_helpers.admin import TaggitListFilter
 
 from snippets.base import forms, models
 from snippets.base.admin import actions, filters
+from snippets.base.locales import get_locale_index
 
 
 MATCH_LOCALE_REGEX = re.compile(r'(\w+(?:-\w+)*)')
@@ -1011,12 +1012,16 @@ class TargetAdmin(RelatedJobsMixin, admin.ModelAdmin):
 
 
 class LocaleAdmin(admin.ModelAdmin):
-    list_display = ('name', 'code')
+    list_display = ('name', 'code', 'bundle_locales')
     search_fields = (
         'name',
         'code',
     )
 
+    def bundle_locales(self, obj):
+        return ', '.join(get_locale_index().expand(obj.code.strip(',').split(',')))
+    bundle_locales.short_description = 'Bundle Locales'
+
 
 class JobAdmin(admin.ModelAdmin):
     form = forms.JobAdminForm
@@ -0,0 +1,138 @@
+"""Benchmark of bundle generation on a synthetic dataset.
+
+The dataset gets created with the test factories, so this must only run
+against a throwaway database, see the `benchmark_bundles` command. They get
+imported when seeding, as they are not available in production images.
+
+"""
+import itertools
+import tempfile
+import time
+import tracemalloc
+from io import StringIO
+from unittest.mock import patch
+
+from django.conf import settings
+from django.db import connection, connections
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from snippets.base import bundles, models
+from snippets.base.locales import get_locale_index
+from snippets.base.storage import OverwriteStorage
+
+
+# Factories of the Templates other than SimpleTemplate, which ASRSnippetFactory
+# creates by default, and the name of their icon field.
+TEMPLATE_FACTORIES = {
+    'simple': None,
+    'simple_below_search': ('SimpleBelowSearchTemplateFactory', 'icon'),
+    'fundraising': ('FundraisingTemplateFactory', 'icon'),
+    'fxa_signup': ('FxASignupTemplateFactory', 'scene1_icon'),
+    'newsletter': ('NewsletterTemplateFactory', 'scene1_icon'),
+    'send_to_device': ('SendToDeviceTemplateFactory', 'scene1_icon'),
+    'send_to_device_single_scene': ('SendToDeviceSingleSceneTemplateFactory', 'icon'),
+}
+
+
+def seed_dataset(jobs, locales, distribution_bundles):
+    """Creates `jobs` Published Jobs spread over the first `locales`
+    product_details locales, `distribution_bundles` DistributionBundles and
+    all the Template types.
+
+    """
+    from snippets.base import tests
+    from snippets.base.tests import (DistributionBundleFactory, DistributionFactory,
+                                     IconFactory, JobFactory, TargetFactory, UserFactory)
+
+    user = UserFactory()
+    icon = IconFactory(creator=user)
+    target = TargetFactory(creator=user, channels='release;beta')
+    locale_codes = get_locale_index().locales[:locales]
+
+    distributions = []
+    for i in range(distribution_bundles):
+        distribution = DistributionFactory(name=f'benchmark-{i}')
+        distribution_bundle = DistributionBundleFactory(
+            name=f'Benchmark {i}', code_name=f'benchmark-{i}')
+        distribution_bundle.distributions.add(distribution)
+        distributions.append(distribution)
+
+    template_factories = itertools.cycle(TEMPLATE_FACTORIES.values())
+    for i in range(jobs):
+        job = JobFactory(
+            creator=user,
+            distribution=distributions[i % len(distributions)],
+            snippet__locale=locale_codes[(i // len(distributions)) % len(locale_codes)],
+            snippet__template_relation__icon=icon,
+            targets=[target],
+        )
+        template_factory = next(template_factories)
+        if template_factory:
+            factory_name, icon_field = template_factory
+            job.snippet.template_relation.delete()
+            template = getattr(tests, factory_name)(snippet=job.snippet, **{icon_field: icon})
+            job.snippet.template_relation = template.template_ptr
+            job.snippet.save()
+
+
+def _measure(fn):
+    result = {}
+    tracemalloc.start()
+    start_time = time.monotonic()
+    # Reads of the bundle snapshot go to the BUNDLE_DATABASE_ALIAS database.
+    with CaptureQueriesContext(connection) as queries, \
+            CaptureQueriesContext(connections[settings.BUNDLE_DATABASE_ALIAS]) as snapshot_queries:
+        summary = fn()
+    result['time'] = time.monotonic() - start_time
+    result['peak_memory'] = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    result['queries'] = len(queries) + len(snapshot_queries)
+    result['bundles_written'] = len(summary['written'])
+    result['bundles_unchanged'] = len(summary['unchanged'])
+    return result
+
+
+def run_benchmark(jobs=1000, locales=20, distribution_bundles=3, changed_jobs=10, workers=1):
+    """Seeds the dataset and returns a dictionary with the time, number of
+    queries, peak traced memory and written bundles of:
+
+     - `full`: a full generation with empty storage.
+     - `full_unchanged`: a second full generation.
+     - `incremental`: a dirty generation after `changed_jobs` Jobs changed.
+
+    Queries of worker processes are not counted. Rendered Jobs are not
+    cached, to measure the generation itself.
+
+    """
+    results = {
+        'git_sha': settings.GIT_SHA,
+        'parameters': {
+            'jobs': jobs,
+            'locales': locales,
+            'distribution_bundles': distribution_bundles,
+            'changed_jobs': changed_jobs,
+            'workers': workers,
+        },
+        'runs': {},
+    }
+
+    start_time = time.monotonic()
+    seed_dataset(jobs, locales, distribution_bundles)
+    results['seed_time'] = time.monotonic() - start_time
+
+    with tempfile.TemporaryDirectory() as directory, \
+            override_settings(JOB_RENDER_CACHE_TIMEOUT=0), \
+            patch.object(bundles, 'default_storage', OverwriteStorage(location=directory)):
+        models.DirtyBundle.objects.all().delete()
+        results['runs']['full'] = _measure(
+            lambda: bundles.generate_bundles(stdout=StringIO(), workers=workers))
+        results['runs']['full_unchanged'] = _measure(
+            lambda: bundles.generate_bundles(stdout=StringIO(), workers=workers))
+
+        for job in models.Job.objects.order_by('id')[:changed_jobs]:
+            job.weight += 1
+            job.save()
+        results['runs']['incremental'] = _measure(
+            lambda: bundles.generate_bundles(stdout=StringIO(), workers=workers, dirty=True))
+
+    return results
@@ -1,22 +1,1907 @@
+import gzip
+import hashlib
 import itertools
 import json
+import multiprocessing
 import os
-from datetime import datetime
+import select
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timedelta
 from io import StringIO
 
 import brotli
 from django.conf import settings
-from django.core.files.base import ContentFile
+from django.contrib.auth import get_user_model
+from django.core.files.base import ContentFile, File
 from django.core.files.storage import default_storage
-from django.db.models import Q
-from product_details import product_details
+from django.db import (DEFAULT_DB_ALIAS, close_old_connections, connection, connections,
+                       transaction)
+from django.db.models import F, Max, Q
 
 from snippets.base import models
+from snippets.base.routers import current_snapshot
+from snippets.base.locales import get_locale_index
+from snippets.base.storage import CONTENT_HASH_SUFFIX
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-def generate_bundles(timestamp=None, limit_to_locale=None,
-                     limit_to_distribution_bundle=None, save_to_disk=True,
+MANIFEST_FILENAME = 'manifest.json'
+ALIASES_FILENAME = 'aliases.json'
+STAGING_DIRNAME = '.staging'
+PRESTAGED_DIRNAME = '.prestaged'
+OBJECTS_DIRNAME = '.objects'
+PLAN_FILENAME = 'plan.json'
+# Bundle metadata that changes on every run without the bundle changing.
+VOLATILE_METADATA = ('generated_at', 'snapshot')
+
+# The first configured encoding gets stored in the bundle path. Any other
+# encoding gets stored next to it, with the extension appended.
+BUNDLE_ENCODING_EXTENSIONS = {
+    'br': '.br',
+    'gzip': '.gz',
+    'identity': '.raw',
+}
+
+# Message content values that match the defaults of Firefox's snippet
+# templates. Compact bundles leave them out.
+FIREFOX_CONTENT_DEFAULTS = {
+    'do_not_autoblock': False,
+    'include_sms': False,
+    'tall': False,
+}
+
+
+class BundleSizeBudgetExceeded(Exception):
+    pass
+
+
+class BundleWorkUnitFailed(Exception):
+    pass
+
+
+class BundleStats:
+    """Collects the time spent and the queries run in each phase of bundle
+    generation.
+
+    Use an instance as a database execute wrapper to count queries. Time and
+    queries outside of any phase are accounted to `other`. Compression time
+    is summed across threads and, after merging, all times are summed across
+    worker processes.
+
+    """
+    PHASES = ('query', 'render', 'serialize', 'compress', 'write', 'other')
+
+    def __init__(self):
+        self.phases = {phase: {'time': 0, 'queries': 0} for phase in self.PHASES}
+        self._stack = ['other']
+        self._started = time.monotonic()
+
+    def __call__(self, execute, sql, params, many, context):
+        self.phases[self._stack[-1]]['queries'] += 1
+        return execute(sql, params, many, context)
+
+    def _flush(self):
+        now = time.monotonic()
+        self.phases[self._stack[-1]]['time'] += now - self._started
+        self._started = now
+
+    @contextmanager
+    def phase(self, name):
+        self._flush()
+        self._stack.append(name)
+        try:
+            yield
+        finally:
+            self._flush()
+            self._stack.pop()
+
+    def add_time(self, name, seconds):
+        self.phases[name]['time'] += seconds
+
+    def merge(self, phases):
+        for name, values in phases.items():
+            for key, value in values.items():
+                self.phases[name][key] += value
+
+    def as_dict(self):
+        self._flush()
+        return {name: dict(values) for name, values in self.phases.items()}
+
+
+class BundlePlanner:
+    """Loads all Published Jobs for a set of DistributionBundles in a fixed
+    number of queries, indexes them by (Distribution, locale code) and
+    renders each Job at most once.
+
+    The index is built lazily on first use, so that runs without any
+    DistributionBundles to process don't hit the database.
+
+    `jobs` is a queryset of the Jobs to include instead of the Published
+    ones.
+
+    """
+    def __init__(self, distribution_bundles, stats=None, jobs=None):
+        self.distribution_bundles = distribution_bundles
+        self.stats = stats or BundleStats()
+        self.jobs = jobs
+        self._index = None
+        self._positions = {}
+        self._rendered = {}
+
+    @staticmethod
+    def _get_select_related():
+        # Follow the reverse one-to-one relations from Template to each
+        # subtemplate model and their Icon foreign keys, so that
+        # `ASRSnippet.template_ng` and `Icon.url` don't query the database.
+        fields = [
+            'campaign',
+            'distribution',
+            'snippet__locale',
+            'snippet__template_relation',
+        ]
+        for subtemplate in models.Template.__subclasses__():
+            path = 'snippet__template_relation__{}'.format(subtemplate._meta.model_name)
+            fields.append(path)
+            for field in subtemplate._meta.get_fields():
+                if field.many_to_one and field.related_model is models.Icon:
+                    fields.append('{}__{}'.format(path, field.name))
+        return fields
+
+    def _build_index(self):
+        self._index = defaultdict(list)
+        distributions = set(itertools.chain.from_iterable(
+            bundle.distributions.all() for bundle in self.distribution_bundles
+        ))
+        jobs = (_get_jobs(self.jobs)
+                .filter(distribution__in=distributions)
+                .select_related(*self._get_select_related())
+                .prefetch_related('targets'))
+
+        for position, job in enumerate(jobs):
+            self._positions[job.id] = position
+            for code in job.snippet.locale.code.strip(',').split(','):
+                self._index[(job.distribution_id, code)].append(job)
+
+    def get_jobs(self, distribution_bundle, locale, channel=None):
+        """Returns the Published Jobs of `distribution_bundle` that target
+        either `locale` or its language without territory information,
+        in the default Job ordering.
+
+        With a `channel`, only the Jobs that apply to it get returned.
+
+        """
+        if self._index is None:
+            with self.stats.phase('query'):
+                self._build_index()
+
+        codes = {locale.lower(), locale.lower().split('-', 1)[0]}
+        jobs = {}
+        for distribution in distribution_bundle.distributions.all():
+            for code in codes:
+                for job in self._index.get((distribution.id, code), []):
+                    if _job_in_channel(job, channel):
+                        jobs[job.id] = job
+        return sorted(jobs.values(), key=lambda job: self._positions[job.id])
+
+    def render(self, job):
+        if job.id not in self._rendered:
+            with self.stats.phase('render'):
+                self._rendered[job.id] = job.render()
+        return self._rendered[job.id]
+
+
+@contextmanager
+def bundle_snapshot(snapshot=None, export=False):
+    """Runs the block in a single REPEATABLE READ READ ONLY transaction on
+    the BUNDLE_DATABASE_ALIAS database, e.g. a read replica, and routes reads
+    to it. Yields a dictionary with the `xmin` and `timestamp` of the
+    snapshot, which get recorded in the metadata of the bundles.
+
+    With `export`, the dictionary also has the `id` of the snapshot, to
+    import it as `snapshot` in other transactions, including ones of other
+    processes, while the block runs. The exported snapshot is held open on
+    a dedicated connection, so that closing the database connections, e.g.
+    before forking worker processes, doesn't invalidate it.
+
+    Without BUNDLE_SNAPSHOT or PostgreSQL, yields None and reads use the
+    default database as usual.
+
+    """
+    alias = settings.BUNDLE_DATABASE_ALIAS
+    active = current_snapshot.get()
+    if active:
+        yield active[1]
+        return
+    if not settings.BUNDLE_SNAPSHOT or connections[alias].vendor != 'postgresql':
+        yield None
+        return
+
+    def begin(cursor):
+        cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY')
+        cursor.execute("SELECT txid_snapshot_xmin(txid_current_snapshot()), "
+                       "now() AT TIME ZONE 'UTC'")
+        xmin, timestamp = cursor.fetchone()
+        return {'xmin': xmin, 'timestamp': timestamp.isoformat()}
+
+    exporter = None
+    try:
+        if export and not snapshot:
+            exporter = connections[alias].get_new_connection(
+                connections[alias].get_connection_params())
+            with exporter.cursor() as cursor:
+                snapshot = begin(cursor)
+                cursor.execute('SELECT pg_export_snapshot()')
+                snapshot['id'] = cursor.fetchone()[0]
+
+        with transaction.atomic(using=alias):
+            with connections[alias].cursor() as cursor:
+                if snapshot:
+                    cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY')
+                    cursor.execute('SET TRANSACTION SNAPSHOT %s', [snapshot['id']])
+                    info = dict(snapshot)
+                else:
+                    info = begin(cursor)
+
+            token = current_snapshot.set((alias, info))
+            try:
+                yield info
+            finally:
+                current_snapshot.reset(token)
+    finally:
+        if exporter:
+            exporter.close()
+
+
+@contextmanager
+def _count_queries(stats):
+    """Counts the queries on the default and the bundle snapshot databases
+    in `stats`.
+
+    """
+    with connection.execute_wrapper(stats):
+        if settings.BUNDLE_DATABASE_ALIAS == DEFAULT_DB_ALIAS:
+            yield
+            return
+        with connections[settings.BUNDLE_DATABASE_ALIAS].execute_wrapper(stats):
+            yield
+
+
+def _get_jobs(jobs=None):
+    if jobs is None:
+        return models.Job.objects.filter(status=models.Job.PUBLISHED)
+    return jobs
+
+
+def _job_in_channel(job, channel):
+    # Jobs without any channel Targets apply to all channels.
+    channels = job.channels
+    return not channel or not channels or channel in channels
+
+
+def get_bundle_channels():
+    """Returns the channels bundles get partitioned by, or [None] when
+    BUNDLE_CHANNEL_PARTITIONING is off.
+
+    """
+    return list(models.CHANNELS) if settings.BUNDLE_CHANNEL_PARTITIONING else [None]
+
+
+def _iter_bundle_slots(bundles_to_process):
+    """Yields a (DistributionBundle, locale, channel) tuple for each bundle
+    file of the (DistributionBundle, locale) tuples `bundles_to_process`.
+
+    """
+    channels = get_bundle_channels()
+    for distribution_bundle, locale in bundles_to_process:
+        for channel in channels:
+            yield distribution_bundle, locale, channel
+
+
+def _get_bundle_path(locale, distribution_bundle, channel=None):
+    if channel:
+        return 'Firefox/{locale}/{channel}/{distribution}.json'.format(
+            locale=locale,
+            channel=channel,
+            distribution=distribution_bundle.code_name,
+        )
+    return 'Firefox/{locale}/{distribution}.json'.format(
+        locale=locale,
+        distribution=distribution_bundle.code_name,
+    )
+
+
+def _get_bundle_filename(locale, distribution_bundle, channel=None):
+    return os.path.join(settings.MEDIA_BUNDLES_PREGEN_ROOT,
+                        _get_bundle_path(locale, distribution_bundle, channel))
+
+
+def _get_bundle_metadata(distribution_bundle, locale, channel, number_of_snippets):
+    metadata = {
+        'generated_at': datetime.utcnow().isoformat(),
+        'number_of_snippets': number_of_snippets,
+        'locale': locale,
+        'distribution_bundle': distribution_bundle.code_name,
+    }
+    if channel:
+        metadata['channel'] = channel
+    snapshot = current_snapshot.get()
+    if snapshot:
+        alias, info = snapshot
+        metadata['snapshot'] = {'xmin': info['xmin'], 'timestamp': info['timestamp']}
+    return metadata
+
+
+def _get_manifest_filename():
+    return os.path.join(settings.MEDIA_BUNDLES_PREGEN_ROOT, MANIFEST_FILENAME)
+
+
+def load_manifest():
+    """Returns the manifest of the generated bundles, or an empty manifest if
+    it doesn't exist yet.
+
+    The manifest is a dictionary with the bundle paths, relative to
+    MEDIA_BUNDLES_PREGEN_ROOT, as keys of `bundles`.
+
+    """
+    filename = _get_manifest_filename()
+    if not default_storage.exists(filename):
+        return {'generated_at': None, 'bundles': {}}
+
+    with default_storage.open(filename) as fp:
+        return json.loads(fp.read())
+
+
+def _save_manifest(manifest):
+    filename = _get_manifest_filename()
+    content_file = ContentFile(json.dumps(manifest, sort_keys=True).encode('utf-8'))
+    default_storage.save(filename, content_file)
+
+
+def _save_alias_map(manifest_bundles, existing_files=None):
+    """Saves the paths of the aliased bundles mapped to the paths of the
+    bundles they are identical to, for the redirector to resolve.
+
+    """
+    aliases = {path: entry['alias_of'] for path, entry in manifest_bundles.items()
+               if entry.get('alias_of')}
+    filename = os.path.join(settings.MEDIA_BUNDLES_PREGEN_ROOT, ALIASES_FILENAME)
+    if not aliases and not settings.BUNDLE_LOCALE_ALIASES:
+        # Only empty the map of a previous run.
+        if existing_files is not None:
+            exists = filename in existing_files
+        else:
+            exists = default_storage.exists(filename)
+        if not exists:
+            return
+    content_file = ContentFile(json.dumps(aliases, sort_keys=True).encode('utf-8'))
+    default_storage.save(filename, content_file)
+
+
+def _remove_expired_aliases(manifest_bundles, existing_files=None):
+    """Deletes the files of the bundles aliased for longer than
+    SNIPPET_BUNDLE_PREGEN_REDIRECT_TIMEOUT and returns their filenames.
+
+    Until then, redirects cached before a bundle got aliased may still point
+    to its file.
+
+    """
+    expired_at = (datetime.utcnow() -
+                  timedelta(seconds=settings.SNIPPET_BUNDLE_PREGEN_REDIRECT_TIMEOUT)).isoformat()
+    filenames = []
+    for path, entry in manifest_bundles.items():
+        if entry.get('alias_of') and entry['aliased_at'] and entry['aliased_at'] <= expired_at:
+            filenames.append(os.path.join(settings.MEDIA_BUNDLES_PREGEN_ROOT, path))
+            entry['aliased_at'] = None
+    _delete_bundles(filenames, existing_files)
+    return filenames
+
+
+def get_bundle_encodings():
+    """Returns the list of encodings each bundle gets stored with.
+
+    Defaults to brotli or identity, depending on BUNDLE_BROTLI_COMPRESS.
+
+    """
+    if settings.BUNDLE_ENCODINGS:
+        return settings.BUNDLE_ENCODINGS
+    return ['br'] if settings.BUNDLE_BROTLI_COMPRESS else ['identity']
+
+
+def get_bundle_file_encoding(filename):
+    """Returns the encoding of a file under MEDIA_BUNDLES_PREGEN_ROOT based on
+    its name.
+
+    """
+    for encoding, extension in BUNDLE_ENCODING_EXTENSIONS.items():
+        if filename.endswith(extension):
+            return encoding
+    if (filename.endswith('.json') and
+            os.path.basename(filename) not in (MANIFEST_FILENAME, ALIASES_FILENAME)):
+        return get_bundle_encodings()[0]
+    return 'identity'
+
+
+def _get_variant_filenames(filename):
+    """Returns a list of (encoding, filename) tuples for all the configured
+    encodings of the bundle stored in `filename`.
+
+    """
+    encodings = get_bundle_encodings()
+    return [
+        (encoding, filename if i == 0 else filename + BUNDLE_ENCODING_EXTENSIONS[encoding])
+        for i, encoding in enumerate(encodings)
+    ]
+
+
+def _get_encoding_options():
+    options = {}
+    for encoding in get_bundle_encodings():
+        if encoding == 'br':
+            options[encoding] = {
+                'quality': settings.BUNDLE_BROTLI_QUALITY,
+                'lgwin': settings.BUNDLE_BROTLI_WINDOW,
+            }
+        elif encoding == 'gzip':
+            options[encoding] = {'compresslevel': settings.BUNDLE_GZIP_LEVEL}
+        else:
+            options[encoding] = {}
+    return options
+
+
+def _compress(content, encoding, options):
+    if encoding == 'br':
+        return brotli.compress(content, **options)
+    elif encoding == 'gzip':
+        # Fixed mtime, so that the output only depends on the content.
+        return gzip.compress(content, mtime=0, **options)
+    return content
+
+
+def _compress_bundle(content_file):
+    """Returns a list of (encoding, ContentFile, seconds) tuples with
+    `content_file` encoded with each configured encoding, in order.
+
+    Brotli and zlib release the GIL while compressing, so this can run in
+    threads.
+
+    """
+    content = content_file.read()
+    variants = []
+    for encoding, options in _get_encoding_options().items():
+        start_time = time.monotonic()
+        variant = ContentFile(_compress(content, encoding, options))
+        if encoding != 'identity':
+            variant.content_encoding = encoding
+        variant.content_hash = content_file.content_hash
+        variants.append((encoding, variant, time.monotonic() - start_time))
+    return variants
+
+
+class _EncodingStream:
+    """Encodes the data written to it with `encoding` into a temporary file."""
+    def __init__(self, encoding, options):
+        self.encoding = encoding
+        self.file = tempfile.TemporaryFile()
+        self.seconds = 0
+        if encoding == 'br':
+            self.compressor = brotli.Compressor(**options)
+            self._process = self.compressor.process
+            self._finish = self.compressor.finish
+        elif encoding == 'gzip':
+            # A wbits value of 16 + 15 writes a gzip header with zero mtime.
+            self.compressor = zlib.compressobj(options['compresslevel'], zlib.DEFLATED, 31)
+            self._process = self.compressor.compress
+            self._finish = self.compressor.flush
+        else:
+            self._process = lambda data: data
+            self._finish = lambda: b''
+
+    def write(self, data):
+        start_time = time.monotonic()
+        self.file.write(self._process(data))
+        self.seconds += time.monotonic() - start_time
+
+    def finish(self):
+        """Returns a File with the encoded data."""
+        start_time = time.monotonic()
+        self.file.write(self._finish())
+        self.seconds += time.monotonic() - start_time
+        self.file.seek(0)
+        return File(self.file, name=self.encoding)
+
+
+def _iter_bundle_jobs(distribution_bundle, locale, channel, chunk_size, stats, jobs=None):
+    """Yields the same Jobs as `BundlePlanner.get_jobs`, loading them from the
+    database `chunk_size` at a time.
+
+    """
+    codes = {locale.lower(), locale.lower().split('-', 1)[0]}
+    with stats.phase('query'):
+        job_ids = list(_get_jobs(jobs)
+                       .filter(distribution__in=distribution_bundle.distributions.all())
+                       .filter(snippet__locale__codes__code__in=codes)
+                       .values_list('id', flat=True)
+                       .distinct())
+
+    for i in range(0, len(job_ids), chunk_size):
+        chunk = job_ids[i:i + chunk_size]
+        with stats.phase('query'):
+            jobs = (models.Job.objects
+                    .filter(id__in=chunk)
+                    .select_related(*BundlePlanner._get_select_related())
+                    .prefetch_related('targets')
+                    .in_bulk())
+        for job_id in chunk:
+            if _job_in_channel(jobs[job_id], channel):
+                yield jobs[job_id]
+
+
+def _stream_bundle(distribution_bundle, locale, channel, stats, jobs=None):
+    """Renders the bundle of `distribution_bundle` for `locale` and
+    `channel` one Job at a time into each configured encoding.
+
+    Returns a (manifest entry, variants) tuple like `_render_bundle` and
+    `_compress_bundle` combined, with the variants backed by temporary files,
+    or (None, None) if there are no Published Jobs for the combination.
+
+    """
+    compact = settings.BUNDLE_COMPACT_ENCODING
+    encoding_options = _get_encoding_options()
+    streams = [
+        _EncodingStream(encoding, options) for encoding, options in encoding_options.items()
+    ]
+    content_hash = _ContentHash(encoding_options, compact)
+    head, separator, middle, tail = _get_bundle_delimiters(compact)
+    size = 0
+
+    def write(data):
+        nonlocal size
+        size += len(data)
+        with stats.phase('compress'):
+            for stream in streams:
+                stream.write(data)
+
+    metadata = _get_bundle_metadata(distribution_bundle, locale, channel, 0)
+    write(head)
+    for job in _iter_bundle_jobs(distribution_bundle, locale, channel,
+                                 settings.BUNDLE_STREAMING_CHUNK_SIZE, stats, jobs):
+        with stats.phase('render'):
+            message = job.render()
+        with stats.phase('serialize'):
+            if compact:
+                message = _elide_defaults(message)
+            content_hash.update(message)
+            encoded_message = _encode_bundle(message, compact=compact)
+        if metadata['number_of_snippets']:
+            write(separator)
+        write(encoded_message)
+        metadata['number_of_snippets'] += 1
+
+    if not metadata['number_of_snippets']:
+        for stream in streams:
+            stream.file.close()
+        return None, None
+
+    write(middle)
+    write(_encode_bundle(metadata, compact=compact))
+    write(tail)
+    alias_hash = content_hash.hexdigest(
+        {key: value for key, value in metadata.items() if key != 'locale'})
+    content_hash = content_hash.hexdigest(metadata)
+
+    variants = []
+    for stream in streams:
+        with stats.phase('compress'):
+            variant = stream.finish()
+        if stream.encoding != 'identity':
+            variant.content_encoding = stream.encoding
+        variant.content_hash = content_hash
+        variants.append((stream.encoding, variant, stream.seconds))
+
+    manifest_entry = dict(metadata, size=size, content_hash=content_hash,
+                          alias_hash=alias_hash)
+    return manifest_entry, variants
+
+
+def _render_bundle(planner, distribution_bundle, locale, channel=None):
+    """Returns a ContentFile with the uncompressed bundle of
+    `distribution_bundle` for `locale` and `channel` or None if there are no
+    Published Jobs for the combination.
+
+    """
+    bundle_jobs = planner.get_jobs(distribution_bundle, locale, channel)
+    if not bundle_jobs:
+        return None
+
+    compact = settings.BUNDLE_COMPACT_ENCODING
+    data = [
+        planner.render(job) for job in bundle_jobs
+    ]
+    if compact:
+        data = [_elide_defaults(message) for message in data]
+    metadata = _get_bundle_metadata(distribution_bundle, locale, channel, len(data))
+    with planner.stats.phase('serialize'):
+        bundle_content = _encode_bundle({
+            'messages': data,
+            'metadata': metadata,
+        }, compact=compact)
+
+        content_file = ContentFile(bundle_content)
+        content_file.content_hash = _get_content_hash(
+            data, metadata, _get_encoding_options(), compact)
+        alias_hash = _get_content_hash(
+            data, {key: value for key, value in metadata.items() if key != 'locale'},
+            _get_encoding_options(), compact)
+    content_file.manifest_entry = dict(metadata, size=len(bundle_content),
+                                       content_hash=content_file.content_hash,
+                                       alias_hash=alias_hash)
+
+    return content_file
+
+
+def _elide_defaults(message):
+    """Returns a copy of the rendered `message` without the content values
+    that are equal to Firefox's defaults.
+
+    """
+    content = {
+        key: value for key, value in message.get('content', {}).items()
+        if key not in FIREFOX_CONTENT_DEFAULTS or value is not FIREFOX_CONTENT_DEFAULTS[key]
+    }
+    return dict(message, content=content)
+
+
+def _encode_bundle(bundle, compact=False):
+    """Returns `bundle` encoded as JSON bytes.
+
+    Compact encoding uses minified separators and orjson when available.
+
+    """
+    if not compact:
+        content = json.dumps(bundle)
+    elif orjson:
+        content = orjson.dumps(bundle)
+    else:
+        content = json.dumps(bundle, separators=(',', ':'))
+
+    # Convert str to bytes.
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+
+    return content
+
+
+def _get_bundle_delimiters(compact=False):
+    """Returns the (head, separator, middle, tail) bytes that
+    `_encode_bundle` puts before the messages of a bundle, between them,
+    between them and the metadata and after the metadata.
+
+    """
+    head, rest = _encode_bundle({'messages': [], 'metadata': None}, compact=compact).split(b'[]')
+    middle, tail = rest.split(b'null')
+    separator = _encode_bundle([0, 0], compact=compact)[2:-2]
+    return head + b'[', separator, b']' + middle, tail
+
+
+def get_encoding_sizes():
+    """Renders all bundles without saving them and returns their total raw and
+    brotli compressed sizes for each encoding mode.
+
+    """
+    modes = [
+        ('default', False, False),
+        ('minified', True, False),
+        ('minified, without defaults', True, True),
+    ]
+    sizes = {name: {'raw': 0, 'brotli': 0} for name, compact, elide in modes}
+
+    bundles_to_process = _get_bundles_to_process(None, None, None, StringIO())
+    planner = BundlePlanner(list({b.id: b for b, locale in bundles_to_process}.values()))
+    for distribution_bundle, locale, channel in _iter_bundle_slots(bundles_to_process):
+        data = [planner.render(job)
+                for job in planner.get_jobs(distribution_bundle, locale, channel)]
+        if not data:
+            continue
+
+        for name, compact, elide in modes:
+            bundle_content = _encode_bundle({
+                'messages': [_elide_defaults(message) for message in data] if elide else data,
+                'metadata': _get_bundle_metadata(distribution_bundle, locale, channel,
+                                                 len(data)),
+            }, compact=compact)
+            sizes[name]['raw'] += len(bundle_content)
+            sizes[name]['brotli'] += len(brotli.compress(bundle_content))
+
+    return sizes
+
+
+def _get_message_sizes(message):
+    """Returns the encoded size of a rendered message, broken down into
+    text, icons, targeting and everything else.
+
+    """
+    def size(value):
+        return len(_encode_bundle(value))
+
+    content = message.get('content', {})
+    fields = {
+        'icons': sum(size(value) for key, value in content.items() if key.endswith('icon')),
+        'text': sum(size(value) for key, value in content.items()
+                    if not key.endswith('icon') and isinstance(value, str)),
+        'targeting': size(message.get('targeting', '')),
+    }
+    total = size(message)
+    fields['other'] = total - sum(fields.values())
+    return total, fields
+
+
+def get_size_report():
+    """Renders all bundles without saving them and returns their sizes, the
+    sizes of each message and their totals by template and by field.
+
+    Message sizes are uncompressed. Their brotli size is the size of each
+    message compressed on its own, which overestimates their share in the
+    compressed bundles.
+
+    """
+    report = {
+        'bundles': [],
+        'messages': {},
+        'templates': defaultdict(lambda: {'count': 0, 'raw': 0, 'brotli': 0}),
+        'fields': defaultdict(int),
+    }
+    bundles_to_process = _get_bundles_to_process(None, None, None, StringIO())
+    planner = BundlePlanner(list({b.id: b for b, locale in bundles_to_process}.values()))
+    for distribution_bundle, locale, channel in _iter_bundle_slots(bundles_to_process):
+        if not distribution_bundle.enabled:
+            continue
+        content_file = _render_bundle(planner, distribution_bundle, locale, channel)
+        if not content_file:
+            continue
+
+        bundle_content = content_file.read()
+        report['bundles'].append({
+            'path': _get_bundle_path(locale, distribution_bundle, channel),
+            'number_of_snippets': content_file.manifest_entry['number_of_snippets'],
+            'raw': len(bundle_content),
+            'brotli': len(brotli.compress(bundle_content)),
+        })
+
+        for job in planner.get_jobs(distribution_bundle, locale, channel):
+            if job.id not in report['messages']:
+                message = planner.render(job)
+                raw, fields = _get_message_sizes(message)
+                report['messages'][job.id] = {
+                    'job': job.id,
+                    'snippet': job.snippet.name,
+                    'template': message.get('template'),
+                    'raw': raw,
+                    'brotli': len(brotli.compress(_encode_bundle(message))),
+                    'fields': fields,
+                    'bundles': 0,
+                }
+            report['messages'][job.id]['bundles'] += 1
+
+    for message in report['messages'].values():
+        template = report['templates'][message['template']]
+        template['count'] += message['bundles']
+        template['raw'] += message['raw'] * message['bundles']
+        template['brotli'] += message['brotli'] * message['bundles']
+        for field, size in message['fields'].items():
+            report['fields'][field] += size * message['bundles']
+
+    report['messages'] = list(report['messages'].values())
+    report['templates'] = dict(report['templates'])
+    report['fields'] = dict(report['fields'])
+    return report
+
+
+def _get_content_hash(data, metadata, encodings=None, compact=False):
+    """Returns a stable hash of the bundle messages and metadata, ignoring
+    the VOLATILE_METADATA which changes on every run.
+
+    `encodings` are the encoding options the bundle gets stored with, so
+    that bundles get rewritten when they change.
+
+    """
+    content_hash = _ContentHash(encodings, compact)
+    for message in data:
+        content_hash.update(message)
+    return content_hash.hexdigest(metadata)
+
+
+class _ContentHash:
+    """Computes `_get_content_hash` one message at a time, for bundles that
+    get streamed.
+
+    It hashes the same JSON as a `json.dumps` with sorted keys of the
+    `compact`, `encodings`, `messages` and `metadata` of the bundle.
+
+    """
+
+    def __init__(self, encodings=None, compact=False):
+        self.hash = hashlib.sha256()
+        self.messages = 0
+        self._update(f'{{"compact": {json.dumps(compact)}, '
+                     f'"encodings": {json.dumps(encodings, sort_keys=True)}, "messages": [')
+
+    def _update(self, content):
+        self.hash.update(content.encode('utf-8'))
+
+    def update(self, message):
+        if self.messages:
+            self._update(', ')
+        self._update(json.dumps(message, sort_keys=True))
+        self.messages += 1
+
+    def hexdigest(self, metadata):
+        metadata = {key: value for key, value in metadata.items()
+                    if key not in VOLATILE_METADATA}
+        content_hash = self.hash.copy()
+        content_hash.update(
+            f'], "metadata": {json.dumps(metadata, sort_keys=True)}}}'.encode('utf-8'))
+        return content_hash.hexdigest()
+
+
+def _get_empty_summary():
+    return {
+        'written': [],
+        'unchanged': [],
+        'removed': [],
+        'manifest': {},
+        'compression': {},
+        'bytes_written': {},
+        'over_budget': [],
+        'available_at': {},
+        'aliased': [],
+    }
+
+
+def _write_bundles(bundles_to_process, manifest_bundles=None, stats=None, staging=None,
+                   existing_files=None, jobs=None, collapse_aliases=None):
+    """Writes or removes the bundle files for a list of
+    (DistributionBundle, locale) tuples and returns a summary dictionary.
+
+    `manifest_bundles` are the bundles of the current manifest. They are used
+    to look up content hashes without hitting the storage. `existing_files`
+    is the set of stored files from `_list_bundle_files`, used instead of
+    checking for each file whether it exists.
+
+    Files get uploaded by a pool of BUNDLE_UPLOAD_THREADS threads. With a
+    `staging` prefix they get uploaded under it and bundles to remove are
+    left in place, for `_publish_staged_bundles` to do both in one step.
+
+    `jobs` is a queryset of the Jobs to include instead of the Published
+    ones.
+
+    With `collapse_aliases`, which defaults to BUNDLE_LOCALE_ALIASES, bundles
+    that are identical to a bundle of the same DistributionBundle and channel
+    written before them, except for their locale, don't get uploaded. Their
+    manifest entry gets an `alias_of` path instead, see `_save_alias_map`.
+
+    """
+    if collapse_aliases is None:
+        collapse_aliases = settings.BUNDLE_LOCALE_ALIASES
+    summary = _get_empty_summary()
+    stats = stats or BundleStats()
+    manifest_bundles = manifest_bundles or {}
+    distribution_bundles = {bundle.id: bundle for bundle, locale in bundles_to_process}
+    planner = BundlePlanner(list(distribution_bundles.values()), stats, jobs)
+    get_content_hash = getattr(default_storage, 'get_content_hash', None)
+    executor = ThreadPoolExecutor(max_workers=settings.BUNDLE_COMPRESSION_THREADS)
+    uploader = BundleUploader(stats, staging)
+    pending = []
+    canonical_paths = {}
+    aliased_at = datetime.utcnow().isoformat()
+
+    with uploader:
+        for distribution_bundle, locale, channel in _iter_bundle_slots(bundles_to_process):
+            path = _get_bundle_path(locale, distribution_bundle, channel)
+            filename = _get_bundle_filename(locale, distribution_bundle, channel)
+            manifest_entry = variants = None
+            if distribution_bundle.enabled and settings.BUNDLE_STREAMING:
+                manifest_entry, variants = _stream_bundle(distribution_bundle, locale, channel,
+                                                          stats, jobs)
+            elif distribution_bundle.enabled:
+                content_file = _render_bundle(planner, distribution_bundle, locale, channel)
+                if content_file:
+                    manifest_entry = content_file.manifest_entry
+
+            # If DistributionBundle is not enabled, or if there are no
+            # Published Jobs for the locale / distribution
+            # combination, delete the current bundle file if it exists.
+            if manifest_entry is None:
+                summary['manifest'][path] = None
+                if existing_files is not None:
+                    exists = filename in existing_files
+                else:
+                    with stats.phase('write'):
+                        exists = default_storage.exists(filename)
+                if exists:
+                    summary['removed'].append(filename)
+                continue
+
+            # Bundles identical to one processed earlier, which has more
+            # traffic, point to it instead of getting uploaded.
+            alias_hash = manifest_entry.pop('alias_hash')
+            previous_entry = manifest_bundles.get(path)
+            canonical_path = path
+            if collapse_aliases:
+                canonical_path = canonical_paths.setdefault(
+                    (distribution_bundle.id, channel, alias_hash), path)
+            if canonical_path != path:
+                if variants:
+                    _close_variants(variants)
+                if (previous_entry and previous_entry.get('alias_of') == canonical_path and
+                        previous_entry['content_hash'] == manifest_entry['content_hash']):
+                    summary['manifest'][path] = previous_entry
+                    summary['unchanged'].append(filename)
+                else:
+                    # Keep the time the bundle file stopped getting updated.
+                    if previous_entry and 'alias_of' in previous_entry:
+                        manifest_entry['aliased_at'] = previous_entry['aliased_at']
+                    else:
+                        manifest_entry['aliased_at'] = aliased_at
+                    manifest_entry['alias_of'] = canonical_path
+                    summary['manifest'][path] = manifest_entry
+                    summary['aliased'].append(filename)
+                continue
+
+            # Skip writing bundles whose content didn't change since the last
+            # time they got saved. The files of aliases are outdated.
+            if existing_files is not None and filename not in existing_files:
+                previous_hash = None
+            elif previous_entry and 'alias_of' in previous_entry:
+                previous_hash = None
+            elif previous_entry:
+                previous_hash = previous_entry['content_hash']
+            elif get_content_hash:
+                with stats.phase('write'):
+                    previous_hash = get_content_hash(filename)
+            else:
+                previous_hash = None
+
+            if previous_hash == manifest_entry['content_hash']:
+                if variants:
+                    _close_variants(variants)
+                # Keep the time the bundle file was actually generated.
+                summary['manifest'][path] = previous_entry or manifest_entry
+                summary['unchanged'].append(filename)
+                continue
+
+            if variants:
+                # Streamed bundles get saved right away to release their
+                # temporary files.
+                _save_variants(summary, path, filename, manifest_entry, variants, uploader)
+            else:
+                pending.append((path, filename, manifest_entry,
+                                executor.submit(_compress_bundle, content_file)))
+
+        with executor:
+            for path, filename, manifest_entry, future in pending:
+                variants = future.result()
+                for encoding, variant, seconds in variants:
+                    stats.add_time('compress', seconds)
+                _save_variants(summary, path, filename, manifest_entry, variants, uploader)
+        uploader.wait()
+    summary['available_at'] = uploader.available_at
+
+    if not staging:
+        with stats.phase('write'):
+            _delete_bundles(summary['removed'], existing_files)
+
+    return summary
+
+
+def _list_bundle_files():
+    """Returns the set of files stored under MEDIA_BUNDLES_PREGEN_ROOT,
+    without staged, prestaged and content-addressed files, or None if the
+    storage can't list them.
+
+    """
+    list_files = getattr(default_storage, 'list_files', None)
+    if not list_files:
+        return None
+    hidden_roots = tuple(os.path.join(settings.MEDIA_BUNDLES_PREGEN_ROOT, dirname, '')
+                         for dirname in (STAGING_DIRNAME, PRESTAGED_DIRNAME, OBJECTS_DIRNAME))
+    return {name for name in list_files(settings.MEDIA_BUNDLES_PREGEN_ROOT)
+            if not name.startswith(hidden_roots)}
+
+
+def _remove_orphaned_bundles(summary, bundles_to_process, manifest_bundles, existing_files):
+    """Deletes the files in `existing_files` that are neither a variant of
+    the bundles of the (DistributionBundle, locale) tuples
+    `bundles_to_process` nor the manifest or the alias map.
+
+    They are left over from locales and DistributionBundles that no Job is
+    for anymore, or from encodings that are not configured anymore. Their
+    bundles get removed from the manifest and added to `summary['removed']`.
+
+    """
+    planned_paths = {_get_bundle_path(locale, distribution_bundle, channel)
+                     for distribution_bundle, locale, channel
+                     in _iter_bundle_slots(bundles_to_process)}
+    planned_files = {_get_manifest_filename(),
+                     os.path.join(settings.MEDIA_BUNDLES_PREGEN_ROOT, ALIASES_FILENAME)}
+    for path in planned_paths:
+        filename = os.path.join(settings.MEDIA_BUNDLES_PREGEN_ROOT, path)
+        planned_files.update(name for encoding, name in _get_variant_filenames(filename))
+
+    for path in sorted(set(manifest_bundles) - planned_paths):
+        summary['manifest'][path] = None
+        filename = os.path.join(settings.MEDIA_BUNDLES_PREGEN_ROOT, path)
+        if filename in existing_files:
+            summary['removed'].append(filename)
+    _delete_bundles(sorted(name for name in existing_files
+                           if name not in planned_files and
+                           not name.endswith(CONTENT_HASH_SUFFIX)),
+                    existing_files)
+
+
+def _delete_bundles(filenames, existing_files=None):
+    """Deletes all variants of the bundles `filenames`, in batches when the
+    storage supports it.
+
+    """
+    names = [variant_filename
+             for filename in filenames
+             for encoding, variant_filename in _get_variant_filenames(filename)]
+    if existing_files is not None:
+        names = [name for name in names if name in existing_files]
+    if not names:
+        return
+
+    delete_many = getattr(default_storage, 'delete_many', None)
+    if delete_many:
+        delete_many(names)
+        return
+    for name in names:
+        if existing_files is not None or default_storage.exists(name):
+            default_storage.delete(name)
+
+
+class BundleUploader:
+    """Saves files to the default storage from a pool of
+    BUNDLE_UPLOAD_THREADS threads, under the `staging` prefix when given.
+
+    The time spent waiting for the uploads gets accounted to the `write`
+    phase of `stats`. After `wait`, `available_at` holds the time each
+    bundle's uploads completed.
+
+    """
+    def __init__(self, stats, staging=None):
+        self.stats = stats
+        self.staging = staging
+        self.available_at = {}
+        self._executor = ThreadPoolExecutor(max_workers=settings.BUNDLE_UPLOAD_THREADS)
+        self._futures = []
+
+    @staticmethod
+    def _upload(filename, content):
+        try:
+            default_storage.save(filename, content)
+        finally:
+            content.close()
+        return time.time()
+
+    def save(self, filename, content, bundle_filename=None):
+        """Uploads `content` as `filename`, a variant of the bundle
+        `bundle_filename`.
+
+        """
+        bundle_filename = bundle_filename or filename
+        if self.staging:
+            filename = _get_staged_filename(self.staging, filename)
+        self._futures.append(
+            (bundle_filename, self._executor.submit(self._upload, filename, content)))
+
+    def wait(self):
+        """Waits for all uploads and raises the first error."""
+        with self.stats.phase('write'):
+            for bundle_filename, future in self._futures:
+                uploaded_at = future.result()
+                self.available_at[bundle_filename] = max(
+                    uploaded_at, self.available_at.get(bundle_filename, 0))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        # Don't leave uploads running when generation fails.
+        self._executor.shutdown(wait=True)
+
+
+def _close_variants(variants):
+    """Closes the files of `variants`, releasing the temporary files of
+    streamed bundles.
+
+    """
+    for encoding, variant, seconds in variants:
+        variant.close()
+
+
+def _save_variants(summary, path, filename, manifest_entry, variants, uploader):
+    """Uploads the encoded `variants` of a bundle and records them in
+    `summary`.
+
+    """
+    size = variants[0][1].size
+    if settings.BUNDLE_SIZE_BUDGET and size > settings.BUNDLE_SIZE_BUDGET:
+        if settings.BUNDLE_SIZE_BUDGET_ACTION == 'fail':
+            _close_variants(variants)
+            raise BundleSizeBudgetExceeded(
+                f'{filename} is {size} bytes, over the budget of '
+                f'{settings.BUNDLE_SIZE_BUDGET} bytes.')
+        summary['over_budget'].append(filename)
+
+    variant_filenames = dict(_get_variant_filenames(filename))
+    manifest_entry['variants'] = {}
+    for encoding, variant, seconds in variants:
+        manifest_entry['variants'][encoding] = variant.size
+        encoding_stats = summary['compression'].setdefault(
+            encoding, {'raw_size': 0, 'size': 0, 'time': 0})
+        encoding_stats['raw_size'] += manifest_entry['size']
+        encoding_stats['size'] += variant.size
+        encoding_stats['time'] += seconds
+        uploader.save(variant_filenames[encoding], variant, filename)
+
+    manifest_entry['compressed_size'] = manifest_entry['variants'][variants[0][0]]
+    summary['manifest'][path] = manifest_entry
+    summary['written'].append(filename)
+    summary['bytes_written'][filename] = sum(manifest_entry['variants'].values())
+
+
+def _get_staging_prefix():
+    """Returns a new prefix under MEDIA_BUNDLES_PREGEN_ROOT to stage the
+    files of a generation run.
+
+    """
+    return os.path.join(settings.MEDIA_BUNDLES_PREGEN_ROOT, STAGING_DIRNAME,
+                        f'{datetime.utcnow():%Y%m%d%H%M%S}-{uuid.uuid4().hex[:8]}')
+
+
+def _get_staged_filename(staging, filename):
+    return os.path.join(staging, os.path.relpath(filename, settings.MEDIA_BUNDLES_PREGEN_ROOT))
+
+
+def _move(name, target):
+    move = getattr(default_storage, 'move', None)
+    if move:
+        move(name, target)
+        return
+    with default_storage.open(name) as fp:
+        default_storage.save(target, fp)
+    default_storage.delete(name)
+
+
+def _copy(name, target):
+    copy = getattr(default_storage, 'copy', None)
+    if copy:
+        copy(name, target)
+        return
+    with default_storage.open(name) as fp:
+        default_storage.save(target, fp)
+
+
+def _get_object_filename(content_hash):
+    """Returns the filename of the content-addressed copy of the bundle with
+    `content_hash`.
+
+    """
+    return os.path.join(settings.MEDIA_BUNDLES_PREGEN_ROOT, OBJECTS_DIRNAME,
+                        content_hash[:2], f'{content_hash}.json')
+
+
+def _record_bundle_run(written, removed, manifest_bundles, rollback_to=None):
+    """Copies the `written` bundle files to the content-addressed area, if
+    they are not stored there yet, and records the `written` and `removed`
+    bundles in a new BundleRun.
+
+    """
+    if not settings.BUNDLE_HISTORY or not (written or removed):
+        return None
+
+    # Listing the stored copies once saves checking for each bundle whether
+    # its copy exists.
+    list_files = getattr(default_storage, 'list_files', None)
+    stored_objects = None
+    if written and list_files:
+        stored_objects = list_files(
+            os.path.join(settings.MEDIA_BUNDLES_PREGEN_ROOT, OBJECTS_DIRNAME))
+
+    history = []
+    copies = []
+    for filename in written:
+        path = os.path.relpath(filename, settings.MEDIA_BUNDLES_PREGEN_ROOT)
+        content_hash = manifest_bundles[path]['content_hash']
+        history.append(models.BundleHistory(path=path, content_hash=content_hash))
+        object_filename = _get_object_filename(content_hash)
+        if stored_objects is not None:
+            stored = object_filename in stored_objects
+        else:
+            stored = default_storage.exists(object_filename)
+        if not stored:
+            # Copies of the same content get made once.
+            if stored_objects is not None:
+                stored_objects.add(object_filename)
+            copies.append(list(zip([name for encoding, name in _get_variant_filenames(filename)],
+                                   [name for encoding, name
+                                    in _get_variant_filenames(object_filename)])))
+    for filename in removed:
+        path = os.path.relpath(filename, settings.MEDIA_BUNDLES_PREGEN_ROOT)
+        history.append(models.BundleHistory(path=path, content_hash=''))
+
+    # The first variant gets copied last, as its existence marks the copy as
+    # complete.
+    with ThreadPoolExecutor(max_workers=settings.BUNDLE_UPLOAD_THREADS) as executor:
+        for variants in [[pairs[1:] for pairs in copies], [pairs[:1] for pairs in copies]]:
+            futures = [executor.submit(_copy, name, target)
+                       for pairs in variants for name, target in pairs]
+            for future in futures:
+                future.result()
+
+    run = models.BundleRun.objects.create(git_sha=settings.GIT_SHA, rollback_to=rollback_to)
+    for item in history:
+        item.run = run
+    models.BundleHistory.objects.bulk_create(history)
+    _prune_bundle_history()
+    return run
+
+
+def _prune_bundle_history():
+    """Deletes the BundleRuns from before `BundleRun.get_history_start` and
+    the content-addressed copies that no remaining run refers to.
+
+    The latest BundleHistory of each bundle from before then is kept, as it
+    holds the content that rollbacks to later runs restore.
+
+    """
+    pruned = models.BundleHistory.objects.filter(
+        run__created__lt=models.BundleRun.get_history_start())
+    kept_ids = list(pruned.values('path').annotate(latest=Max('id'))
+                    .values_list('latest', flat=True))
+    pruned = pruned.exclude(id__in=kept_ids)
+    content_hashes = set(pruned.values_list('content_hash', flat=True)) - {''}
+    pruned.delete()
+    (models.BundleRun.objects
+     .filter(created__lt=models.BundleRun.get_history_start(), bundles__isnull=True)
+     .delete())
+
+    content_hashes -= set(models.BundleHistory.objects
+                          .filter(content_hash__in=content_hashes)
+                          .values_list('content_hash', flat=True))
+    _delete_bundles([_get_object_filename(content_hash) for content_hash in content_hashes])
+
+
+def _get_object_manifest_entry(content_hash):
+    """Returns a manifest entry for the content-addressed bundle with
+    `content_hash` or None if it is not stored.
+
+    """
+    object_filename = _get_object_filename(content_hash)
+    content = _load_bundle(object_filename)
+    if content is None:
+        return None
+
+    metadata = json.loads(content)['metadata']
+    entry = dict(metadata, size=len(content), content_hash=content_hash, variants={})
+    for encoding, variant_filename in _get_variant_filenames(object_filename):
+        if default_storage.exists(variant_filename):
+            entry['variants'][encoding] = default_storage.size(variant_filename)
+    entry['compressed_size'] = entry['variants'].get(get_bundle_encodings()[0])
+    return entry
+
+
+def rollback_bundles(run_id, locale=None, distribution_bundle=None, dry_run=False,
                      stdout=StringIO()):
+    """Restores the bundles changed after BundleRun `run_id` to their content
+    after that run, from the content-addressed copies, without rendering.
+
+    Only bundles of `locale` and `distribution_bundle` code name get restored
+    when given. Bundles first written after the run get removed. Returns a
+    dictionary with the `restored` and `removed` bundle paths.
+
+    """
+    changed_paths = set(models.BundleHistory.objects
+                        .filter(run_id__gt=run_id)
+                        .values_list('path', flat=True))
+    paths = []
+    for path in sorted(changed_paths):
+        segments = path.split('/')
+        if locale and segments[1].lower() != locale.lower():
+            continue
+        if distribution_bundle and segments[-1] != f'{distribution_bundle.lower()}.json':
+            continue
+        paths.append(path)
+
+    targets = {}
+    for item in (models.BundleHistory.objects
+                 .filter(run_id__lte=run_id, path__in=paths)
+                 .order_by('run_id')):
+        targets[item.path] = item.content_hash
+
+    manifest = load_manifest()
+    result = {'restored': [], 'removed': []}
+    written = []
+    removed = []
+    for path in paths:
+        content_hash = targets.get(path, '')
+        current_entry = manifest['bundles'].get(path)
+        if (current_entry['content_hash'] if current_entry else '') == content_hash:
+            continue
+
+        filename = os.path.join(settings.MEDIA_BUNDLES_PREGEN_ROOT, path)
+        if not content_hash:
+            stdout.write(f'Removing {filename}')
+            result['removed'].append(path)
+            if not dry_run:
+                _delete_bundles([filename])
+                manifest['bundles'].pop(path, None)
+                removed.append(filename)
+            continue
+
+        entry = _get_object_manifest_entry(content_hash)
+        if entry is None:
+            stdout.write(f'Skipping {filename}: content {content_hash} is not stored.')
+            continue
+        stdout.write(f'Restoring {filename} to {content_hash}')
+        result['restored'].append(path)
+        if not dry_run:
+            object_filename = _get_object_filename(content_hash)
+            for (encoding, name), (target_encoding, target) in zip(
+                    _get_variant_filenames(object_filename), _get_variant_filenames(filename)):
+                if encoding in entry['variants']:
+                    _copy(name, target)
+            manifest['bundles'][path] = entry
+            written.append(filename)
+
+    # Aliases serve the content of the bundles they alias, so those of
+    # restored bundles serve the restored content and those of removed
+    # bundles get removed with them. They don't get regenerated, as that
+    # would regenerate the bundles they alias too and undo the rollback.
+    for path, entry in sorted(manifest['bundles'].items()):
+        if not entry.get('alias_of') or entry['alias_of'] not in result['removed']:
+            continue
+        filename = os.path.join(settings.MEDIA_BUNDLES_PREGEN_ROOT, path)
+        stdout.write(f'Removing {filename}')
+        result['removed'].append(path)
+        if not dry_run:
+            manifest['bundles'].pop(path)
+            # Files of aliases get removed once the redirects to them expire.
+            if entry['aliased_at']:
+                _delete_bundles([filename])
+                removed.append(filename)
+
+    if not dry_run and (written or removed):
+        _save_manifest(manifest)
+        _save_alias_map(manifest['bundles'])
+        _record_bundle_run(written, removed, manifest['bundles'],
+                           rollback_to=models.BundleRun.objects.get(id=run_id))
+    return result
+
+
+def _publish_staged_bundles(summary, staging, stats, existing_files=None):
+    """Moves the files staged under `staging` into place, using
+    BUNDLE_UPLOAD_THREADS threads, and removes the bundles in
+    `summary['removed']`.
+
+    """
+    moves = [(filename, _get_staged_filename(staging, variant_filename), variant_filename)
+             for filename in summary['written']
+             for encoding, variant_filename in _get_variant_filenames(filename)]
+    with stats.phase('write'):
+        with ThreadPoolExecutor(max_workers=settings.BUNDLE_UPLOAD_THREADS) as executor:
+            futures = [(filename, executor.submit(_move, name, target))
+                       for filename, name, target in moves]
+            for filename, future in futures:
+                future.result()
+                summary['available_at'][filename] = time.time()
+        _delete_bundles(summary['removed'], existing_files)
+        _remove_staging(staging)
+
+
+def _remove_staging(staging):
+    """Removes any files left under `staging`."""
+    try:
+        shutil.rmtree(default_storage.path(staging), ignore_errors=True)
+        return
+    except NotImplementedError:
+        pass
+
+    if hasattr(default_storage, 'list_files') and hasattr(default_storage, 'delete_many'):
+        default_storage.delete_many(default_storage.list_files(staging))
+        return
+
+    def remove(path):
+        directories, files = default_storage.listdir(path)
+        for name in files:
+            default_storage.delete(os.path.join(path, name))
+        for name in directories:
+            remove(os.path.join(path, name))
+
+    remove(staging)
+
+
+def _merge_summaries(summary, other):
+    for key, value in other.items():
+        if key in ('manifest', 'bytes_written', 'available_at'):
+            summary[key].update(value)
+        elif key == 'compression':
+            for encoding, stats in value.items():
+                total = summary[key].setdefault(
+                    encoding, {'raw_size': 0, 'size': 0, 'time': 0})
+                for name in total:
+                    total[name] += stats[name]
+        else:
+            summary[key].extend(value)
+
+
+def _decode_bundle(filename, content):
+    encoding = get_bundle_file_encoding(filename)
+    if encoding == 'br':
+        content = brotli.decompress(content)
+    elif encoding == 'gzip':
+        content = gzip.decompress(content)
+    return content
+
+
+def _load_bundle(filename):
+    """Returns the uncompressed content of the bundle stored in `filename`
+    or None if it doesn't exist.
+
+    """
+    if not default_storage.exists(filename):
+        return None
+    with default_storage.open(filename) as fp:
+        return _decode_bundle(filename, fp.read())
+
+
+def _diff_bundle(filename, old_content, new_content, ignored_metadata=VOLATILE_METADATA):
+    """Returns a dictionary with the message ID and size deltas between two
+    uncompressed bundles, or None if they only differ in `ignored_metadata`.
+
+    """
+    old_bundle = json.loads(old_content) if old_content else {'messages': [], 'metadata': {}}
+    new_bundle = json.loads(new_content) if new_content else {'messages': [], 'metadata': {}}
+    for bundle in [old_bundle, new_bundle]:
+        for key in ignored_metadata:
+            bundle['metadata'].pop(key, None)
+    if old_bundle == new_bundle:
+        return None
+
+    old_ids = [message['id'] for message in old_bundle['messages']]
+    new_ids = [message['id'] for message in new_bundle['messages']]
+    return {
+        'filename': filename,
+        'added_messages': [message_id for message_id in new_ids if message_id not in old_ids],
+        'removed_messages': [message_id for message_id in old_ids if message_id not in new_ids],
+        'size': len(new_content or b''),
+        'size_delta': len(new_content or b'') - len(old_content or b''),
+    }
+
+
+def _diff_bundles(bundles_to_process, manifest_bundles=None, stats=None,
+                  collapse_aliases=None):
+    """Renders the bundles of a list of (DistributionBundle, locale) tuples
+    and compares them with the stored ones, without writing anything.
+
+    Bundles are compared with the content served for them, which for aliases
+    in `manifest_bundles` is the file of the bundle they alias. With
+    `collapse_aliases`, bundles that `_write_bundles` would turn into aliases
+    get compared the same way.
+
+    Returns a dictionary with the `added`, `removed`, `changed` and `aliased`
+    bundle diffs and the number of `unchanged` bundles.
+
+    """
+    if collapse_aliases is None:
+        collapse_aliases = settings.BUNDLE_LOCALE_ALIASES
+    diff = {
+        'added': [],
+        'removed': [],
+        'changed': [],
+        'aliased': [],
+        'unchanged': 0,
+    }
+    stats = stats or BundleStats()
+    manifest_bundles = manifest_bundles or {}
+    distribution_bundles = {bundle.id: bundle for bundle, locale in bundles_to_process}
+    planner = BundlePlanner(list(distribution_bundles.values()), stats)
+    canonical_paths = {}
+
+    for distribution_bundle, locale, channel in _iter_bundle_slots(bundles_to_process):
+        path = _get_bundle_path(locale, distribution_bundle, channel)
+        filename = _get_bundle_filename(locale, distribution_bundle, channel)
+        new_content = manifest_entry = None
+        if distribution_bundle.enabled:
+            content_file = _render_bundle(planner, distribution_bundle, locale, channel)
+            if content_file:
+                new_content = content_file.read()
+                manifest_entry = content_file.manifest_entry
+
+        canonical_path = path
+        if collapse_aliases and manifest_entry:
+            canonical_path = canonical_paths.setdefault(
+                (distribution_bundle.id, channel, manifest_entry['alias_hash']), path)
+
+        # The files of aliases are outdated, or removed once expired.
+        previous_entry = manifest_bundles.get(path)
+        ignored_metadata = VOLATILE_METADATA
+        served_filename = filename
+        if previous_entry and previous_entry.get('alias_of'):
+            ignored_metadata += ('locale',)
+            served_filename = os.path.join(settings.MEDIA_BUNDLES_PREGEN_ROOT,
+                                           previous_entry['alias_of'])
+        with stats.phase('write'):
+            old_content = _load_bundle(served_filename)
+
+        bundle_diff = _diff_bundle(filename, old_content, new_content, ignored_metadata)
+        if (canonical_path != path and
+                (bundle_diff or not previous_entry or
+                 previous_entry.get('alias_of') != canonical_path)):
+            diff['aliased'].append({
+                'filename': filename,
+                'alias_of': canonical_path,
+                'added_messages': bundle_diff['added_messages'] if bundle_diff else [],
+                'removed_messages': bundle_diff['removed_messages'] if bundle_diff else [],
+            })
+        elif bundle_diff is None:
+            diff['unchanged'] += 1
+        elif old_content is None:
+            diff['added'].append(bundle_diff)
+        elif new_content is None:
+            diff['removed'].append(bundle_diff)
+        else:
+            diff['changed'].append(bundle_diff)
+
+    return diff
+
+
+def _write_diff(diff, stdout, details):
+    if details:
+        for prefix, key in [('+', 'added'), ('-', 'removed'), ('~', 'changed')]:
+            for bundle_diff in diff[key]:
+                stdout.write(
+                    f'{prefix} {bundle_diff["filename"]}: '
+                    f'+{len(bundle_diff["added_messages"])} '
+                    f'-{len(bundle_diff["removed_messages"])} messages, '
+                    f'{bundle_diff["size_delta"]:+} bytes'
+                )
+                if bundle_diff['added_messages']:
+                    stdout.write(f'    added: {", ".join(bundle_diff["added_messages"])}')
+                if bundle_diff['removed_messages']:
+                    stdout.write(f'    removed: {", ".join(bundle_diff["removed_messages"])}')
+        for bundle_diff in diff['aliased']:
+            stdout.write(
+                f'= {bundle_diff["filename"]} -> {bundle_diff["alias_of"]}: '
+                f'+{len(bundle_diff["added_messages"])} '
+                f'-{len(bundle_diff["removed_messages"])} messages'
+            )
+
+    stdout.write(
+        f'Bundles Added: {len(diff["added"])}\n'
+        f'Bundles Removed: {len(diff["removed"])}\n'
+        f'Bundles Changed: {len(diff["changed"])}\n'
+        f'Bundles Aliased: {len(diff["aliased"])}\n'
+        f'Bundles Unchanged: {diff["unchanged"]}\n'
+    )
+
+
+# Connections inherited from the parent process that are kept open for it.
+_inherited_connections = []
+
+
+def _close_connections_before_fork():
+    """Closes the database connections before forking, so that worker
+    processes don't share their sockets with the parent process.
+
+    Connections in a transaction, like the one of the bundle snapshot, stay
+    open for the parent process and get replaced in the workers.
+
+    """
+    for conn in connections.all():
+        if not conn.in_atomic_block:
+            conn.close()
+
+
+def _init_bundles_worker():
+    # Make sure that each worker process opens its own database connections
+    # and imports the bundle snapshot in them. Connections left open by the
+    # parent process must neither be used nor closed, as closing them ends
+    # the session of the parent. They are kept referenced, so that they don't
+    # get closed on garbage collection either.
+    for conn in connections.all():
+        if conn.in_atomic_block:
+            _inherited_connections.append(conn)
+            del connections[conn.alias]
+    connections.close_all()
+    current_snapshot.set(None)
+
+
+def _write_bundles_worker(bundles_to_process, manifest_bundles, staging, existing_files,
+                          snapshot):
+    stats = BundleStats()
+    with _count_queries(stats), bundle_snapshot(snapshot):
+        with stats.phase('query'):
+            distribution_bundles = (models.DistributionBundle.objects
+                                    .filter(id__in={bundle_id
+                                                    for bundle_id, locale in bundles_to_process})
+                                    .prefetch_related('distributions')
+                                    .in_bulk())
+        summary = _write_bundles(
+            [(distribution_bundles[bundle_id], locale)
+             for bundle_id, locale in bundles_to_process],
+            manifest_bundles,
+            stats,
+            staging,
+            existing_files,
+        )
+    summary['stats'] = stats.as_dict()
+    return summary
+
+
+def _write_bundles_in_pool(bundles_to_process, workers, manifest_bundles=None, stats=None,
+                           staging=None, existing_files=None, snapshot=None):
+    """Shards the (DistributionBundle, locale) tuples across a pool of
+    `workers` processes and returns the merged summary.
+
+    The phase stats of the workers get merged into `stats`. Workers import
+    the exported `snapshot` of `bundle_snapshot`.
+
+    """
+    stats = stats or BundleStats()
+    manifest_bundles = manifest_bundles or {}
+    shards = [([], {}, staging, None if existing_files is None else set(), snapshot)
+              for i in range(workers)]
+    # Locales of the same language go to the same worker, which collapses
+    # the identical ones into aliases.
+    groups = {}
+    for distribution_bundle, locale in bundles_to_process:
+        if settings.BUNDLE_LOCALE_ALIASES:
+            group = (distribution_bundle.id, locale.split('-', 1)[0])
+        else:
+            group = (distribution_bundle.id, locale)
+        shard = groups.setdefault(group, len(groups) % workers)
+        shard_bundles, shard_manifest_bundles, _, shard_files, _ = shards[shard]
+        shard_bundles.append((distribution_bundle.id, locale))
+        for channel in get_bundle_channels():
+            path = _get_bundle_path(locale, distribution_bundle, channel)
+            if path in manifest_bundles:
+                shard_manifest_bundles[path] = manifest_bundles[path]
+            if shard_files is not None:
+                filename = _get_bundle_filename(locale, distribution_bundle, channel)
+                shard_files.update(name for encoding, name in _get_variant_filenames(filename)
+                                   if name in existing_files)
+    shards = [shard for shard in shards if shard[0]]
+
+    _close_connections_before_fork()
+
+    summary = _get_empty_summary()
+    with ProcessPoolExecutor(max_workers=workers,
+                             mp_context=multiprocessing.get_context('fork'),
+                             initializer=_init_bundles_worker) as executor:
+        for shard_summary in executor.map(_write_bundles_worker, *zip(*shards)):
+            stats.merge(shard_summary.pop('stats'))
+            _merge_summaries(summary, shard_summary)
+    return summary
+
+
+def _get_worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}'
+
+
+def _claim_work_units(owner):
+    """Leases up to BUNDLE_LEASE_BATCH BundleWorkUnits that are not done and
+    not leased by another worker, to `owner`.
+
+    Rows locked by other workers claiming at the same time get skipped
+    instead of waited for.
+
+    """
+    now = datetime.utcnow()
+    with transaction.atomic():
+        unit_ids = list(models.BundleWorkUnit.objects
+                        .select_for_update(skip_locked=True)
+                        .filter(done=False)
+                        .filter(Q(lease_expires=None) | Q(lease_expires__lt=now))
+                        .order_by('id')
+                        .values_list('id', flat=True)[:settings.BUNDLE_LEASE_BATCH])
+        models.BundleWorkUnit.objects.filter(id__in=unit_ids).update(
+            owner=owner,
+            lease_expires=now + timedelta(seconds=settings.BUNDLE_LEASE_SECONDS),
+        )
+    return list(models.BundleWorkUnit.objects
+                .filter(id__in=unit_ids)
+                .select_related('generation', 'distribution_bundle')
+                .prefetch_related('distribution_bundle__distributions')
+                .order_by('generation', 'id'))
+
+
+@contextmanager
+def _renew_leases(units, owner):
+    """Renews the leases of `units` from a thread while the block runs, as
+    long as they are still leased to `owner`.
+
+    """
+    stop = threading.Event()
+
+    def renew():
+        try:
+            while not stop.wait(settings.BUNDLE_LEASE_SECONDS / 3):
+                models.BundleWorkUnit.objects.filter(
+                    id__in=[unit.id for unit in units], owner=owner, done=False,
+                ).update(lease_expires=datetime.utcnow() +
+                         timedelta(seconds=settings.BUNDLE_LEASE_SECONDS))
+        finally:
+            connection.close()
+
+    thread = threading.Thread(target=renew, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def _split_summary(summary, units):
+    """Returns the part of `summary` of each of `units`. The compression and
+    phase stats go to the first one.
+
+    """
+    unit_summaries = []
+    for unit in units:
+        paths = {_get_bundle_path(unit.locale, unit.distribution_bundle, channel)
+                 for channel in get_bundle_channels()}
+        filenames = {os.path.join(settings.MEDIA_BUNDLES_PREGEN_ROOT, path) for path in paths}
+        unit_summary = _get_empty_summary()
+        for key, value in summary.items():
+            if key == 'manifest':
+                unit_summary[key] = {path: entry for path, entry in value.items()
+                                     if path in paths}
+            elif key in ('bytes_written', 'available_at'):
+                unit_summary[key] = {filename: item for filename, item in value.items()
+                                     if filename in filenames}
+            elif isinstance(value, list):
+                unit_summary[key] = [filename for filename in value if filename in filenames]
+        unit_summaries.append(unit_summary)
+    if unit_summaries:
+        unit_summaries[0]['compression'] = summary['compression']
+        unit_summaries[0]['stats'] = summary['stats']
+    return unit_summaries
+
+
+def _process_work_units(units, owner, stats=None, count_queries=True, stdout=StringIO()):
+    """Writes the bundles of the leased `units` and marks them as done.
+
+    Units that fail get released to be retried, by this or any other worker,
+    up to BUNDLE_LEASE_ATTEMPTS times, and are then marked as done with the
+    error.
+
+    Without `count_queries`, the stats of the units leave out the queries,
+    for callers that count them already.
+
+    """
+    manifest_bundles = load_manifest()['bundles']
+    for generation, generation_units in itertools.groupby(units, lambda u: u.generation):
+        generation_units = list(generation_units)
+        unit_ids = [unit.id for unit in generation_units]
+        unit_stats = BundleStats()
+        query_counter = _count_queries(unit_stats) if count_queries else nullcontext()
+        try:
+            with _renew_leases(generation_units, owner), query_counter, \
+                    bundle_snapshot(json.loads(generation.snapshot or 'null')):
+                summary = _write_bundles(
+                    [(unit.distribution_bundle, unit.locale) for unit in generation_units],
+                    manifest_bundles, unit_stats, generation.staging or None)
+        except Exception as exc:
+            stdout.write(f'Failed to process bundle work units {unit_ids}: {exc!r}')
+            leased = models.BundleWorkUnit.objects.filter(id__in=unit_ids, owner=owner)
+            leased.filter(attempts__gte=settings.BUNDLE_LEASE_ATTEMPTS - 1).update(
+                owner='', lease_expires=None, attempts=F('attempts') + 1,
+                done=True, error=repr(exc))
+            leased.update(owner='', lease_expires=None, attempts=F('attempts') + 1)
+            continue
+
+        if stats:
+            stats.merge(unit_stats.as_dict())
+        summary['stats'] = unit_stats.as_dict()
+        for unit, unit_summary in zip(generation_units, _split_summary(summary, generation_units)):
+            # A unit whose lease expired may have been claimed by another
+            # worker meanwhile, which then records its own result.
+            models.BundleWorkUnit.objects.filter(id=unit.id, owner=owner, done=False).update(
+                done=True, lease_expires=None, result=json.dumps(unit_summary))
+
+
+def run_bundle_worker(stop_when_idle=False, owner=None, stats=None, count_queries=True,
+                      stdout=StringIO()):
+    """Processes the BundleWorkUnits of distributed generations, polling
+    every BUNDLE_WORKER_POLL_INTERVAL seconds for new ones.
+
+    With `stop_when_idle`, returns as soon as there are no units to lease.
+
+    """
+    owner = owner or _get_worker_name()
+    while True:
+        units = _claim_work_units(owner)
+        if units:
+            _process_work_units(units, owner, stats, count_queries, stdout)
+        elif stop_when_idle:
+            return
+        else:
+            time.sleep(settings.BUNDLE_WORKER_POLL_INTERVAL)
+
+
+def _write_bundles_distributed(bundles_to_process, stats=None, staging=None, snapshot=None,
+                               stdout=StringIO()):
+    """Splits the (DistributionBundle, locale) tuples into BundleWorkUnits
+    for `run_bundle_worker` on any node, takes part in processing them and
+    returns the merged summary once all of them are done.
+
+    Phase stats of the other workers get merged into `stats`. Workers import
+    the exported `snapshot` of `bundle_snapshot`, which must be taken on the
+    same database server as their BUNDLE_DATABASE_ALIAS.
+
+    """
+    stats = stats or BundleStats()
+    generation = models.BundleGeneration.objects.create(
+        staging=staging or '', snapshot=json.dumps(snapshot) if snapshot else '')
+    models.BundleWorkUnit.objects.bulk_create([
+        models.BundleWorkUnit(generation=generation, locale=locale,
+                              distribution_bundle=distribution_bundle)
+        for distribution_bundle, locale in bundles_to_process
+    ])
+    stdout.write(f'Distributed {len(bundles_to_process)} bundles in {generation}.')
+    owner = _get_worker_name()
+
+    try:
+        while True:
+            # The queries of the units processed here already get counted in
+            # `stats` by the caller.
+            run_bundle_worker(stop_when_idle=True, owner=owner, count_queries=False,
+                              stdout=stdout)
+            if not generation.units.filter(done=False).exists():
+                break
+            time.sleep(settings.BUNDLE_WORKER_POLL_INTERVAL)
+
+        summary = _get_empty_summary()
+        errors = []
+        for unit in generation.units.order_by('id'):
+            if unit.error:
+                errors.append(f'{unit}: {unit.error}')
+                continue
+            unit_summary = json.loads(unit.result)
+            if 'stats' in unit_summary:
+                stats.merge(unit_summary.pop('stats'))
+            _merge_summaries(summary, unit_summary)
+        if errors:
+            raise BundleWorkUnitFailed('Failed to process bundle work units:\n' + '\n'.join(errors))
+    finally:
+        generation.delete()
+    return summary
+
+
+def _expand_locales(locales):
+    """Returns the sorted product_details locales that start with any of
+    `locales`.
+
+    """
+    return get_locale_index().expand(locales)
+
+
+def _get_bundles_to_process(timestamp, limit_to_locale, limit_to_distribution_bundle, stdout):
     if not timestamp:
         stdout.write('Generating all bundles.')
         total_jobs = models.Job.objects.all()
@@ -30,102 +1915,743 @@ def generate_bundles(timestamp=None, limit_to_locale=None,
         ).distinct()
 
     stdout.write('Processing bundles…')
+    return _get_bundles_of_jobs(total_jobs, limit_to_locale, limit_to_distribution_bundle)
+
+
+def _get_bundles_of_jobs(jobs, limit_to_locale=None, limit_to_distribution_bundle=None):
+    """Returns the (DistributionBundle, locale) tuples of the bundles that
+    include the Jobs of the `jobs` queryset.
+
+    """
     if limit_to_locale:
         all_locales_to_process = [
             limit_to_locale,
         ]
     else:
         all_locales_to_process = set(
-            itertools.chain.from_iterable(
-                job.snippet.locale.code.strip(',').split(',')
-                for job in total_jobs
-            )
-        )
+            jobs.values_list('snippet__locale__codes__code', flat=True).distinct()
+        ) - {None}
     distribution_bundles_to_process = models.DistributionBundle.objects.filter(
-        distributions__jobs__in=total_jobs
+        distributions__jobs__in=jobs
     ).distinct().order_by('id')
 
     if limit_to_distribution_bundle:
         distribution_bundles_to_process = distribution_bundles_to_process.filter(
             name__iexact=limit_to_distribution_bundle
         )
+    distribution_bundles_to_process = list(
+        distribution_bundles_to_process.prefetch_related('distributions')
+    )
 
-    for distribution_bundle in distribution_bundles_to_process:
-        distributions = distribution_bundle.distributions.all()
+    locales_to_process = _expand_locales(all_locales_to_process)
+    return [
+        (distribution_bundle, locale_to_process)
+        for distribution_bundle in distribution_bundles_to_process
+        for locale_to_process in locales_to_process
+    ]
 
-        for locale in all_locales_to_process:
 
-            all_jobs = (models.Job.objects
-                        .filter(status=models.Job.PUBLISHED)
-                        .filter(distribution__in=distributions))
+def _get_traffic_weights(bundles_to_process):
+    """Returns the traffic weight of each (DistributionBundle id, locale) of
+    the (DistributionBundle, locale) tuples `bundles_to_process`.
 
-            locales_to_process = [
-                key.lower() for key in product_details.languages.keys()
-                if key.lower().startswith(locale)
-            ]
+    Weights are shares of the total of `bundles_to_process`. The configured
+    weights and the BundleTraffic requests are on different scales, so each
+    gets turned into shares before averaging them.
 
-            for locale_to_process in locales_to_process:
-                filename = 'Firefox/{locale}/{distribution}.json'.format(
-                    locale=locale_to_process,
-                    distribution=distribution_bundle.code_name,
-                )
-                filename = os.path.join(settings.MEDIA_BUNDLES_PREGEN_ROOT, filename)
-                full_locale = ',{},'.format(locale_to_process.lower())
-                splitted_locale = ',{},'.format(locale_to_process.lower().split('-', 1)[0])
-                bundle_jobs = all_jobs.filter(
-                    Q(snippet__locale__code__contains=splitted_locale) |
-                    Q(snippet__locale__code__contains=full_locale)).distinct()
-
-                # If DistributionBundle is not enabled, or if there are no
-                # Published Jobs for the locale / distribution
-                # combination, delete the current bundle file if it exists.
-                if save_to_disk and not distribution_bundle.enabled or not bundle_jobs.exists():
-                    if default_storage.exists(filename):
-                        stdout.write('Removing {}'.format(filename))
-                        default_storage.delete(filename)
-                    continue
-
-                data = [
-                    job.render() for job in bundle_jobs
-                ]
-                bundle_content = json.dumps({
-                    'messages': data,
+    """
+    default = settings.BUNDLE_TRAFFIC_DEFAULT_WEIGHT
+    configured = {
+        (distribution_bundle.id, locale): (
+            settings.BUNDLE_LOCALE_WEIGHTS.get(locale, default) *
+            settings.BUNDLE_DISTRIBUTION_WEIGHTS.get(distribution_bundle.code_name, default))
+        for distribution_bundle, locale in bundles_to_process
+    }
+    traffic = {}
+    for distribution_bundle_id, locale, requests in models.BundleTraffic.objects.values_list(
+            'distribution_bundle', 'locale', 'requests'):
+        if (distribution_bundle_id, locale) in configured:
+            traffic[(distribution_bundle_id, locale)] = requests
+
+    configured_total = sum(configured.values())
+    traffic_total = sum(traffic.values())
+    weights = {}
+    for key, weight in configured.items():
+        weights[key] = weight / configured_total if configured_total else 0
+        if traffic_total:
+            weights[key] = (weights[key] + traffic.get(key, 0) / traffic_total) / 2
+    return weights
+
+
+def update_bundle_traffic(requests, stdout=StringIO()):
+    """Replaces the BundleTraffic with the number of requests of each bundle
+    in `requests`, an iterable of (path, requests) tuples, e.g. from the CDN
+    logs.
+
+    Paths are bundle URL paths like `/bundles-pregen/Firefox/en-us/default.json`.
+    The requests of the channels of a bundle get summed and other paths get
+    skipped. Returns the number of BundleTraffic rows.
+
+    """
+    root = settings.MEDIA_BUNDLES_PREGEN_ROOT.strip('/') + '/'
+    counts = defaultdict(int)
+    for path, count in requests:
+        path = path.strip('/')
+        if path.startswith(root):
+            path = path[len(root):]
+        segments = path.split('/')
+        if len(segments) not in (3, 4) or segments[0] != 'Firefox' or \
+                not segments[-1].endswith('.json'):
+            continue
+        counts[(segments[1].lower(), segments[-1][:-len('.json')])] += int(count)
+
+    distribution_bundles = (models.DistributionBundle.objects
+                            .filter(code_name__in={code for locale, code in counts})
+                            .in_bulk(field_name='code_name'))
+    traffic = [
+        models.BundleTraffic(locale=locale, distribution_bundle=distribution_bundles[code_name],
+                             requests=count)
+        for (locale, code_name), count in sorted(counts.items())
+        if code_name in distribution_bundles
+    ]
+    with transaction.atomic():
+        models.BundleTraffic.objects.all().delete()
+        models.BundleTraffic.objects.bulk_create(traffic)
+    stdout.write(f'Updated the traffic of {len(traffic)} bundles.')
+    return len(traffic)
+
+
+def _prioritize_bundles(bundles_to_process, weights):
+    """Returns `bundles_to_process` ordered by descending traffic weight."""
+    return sorted(bundles_to_process, key=lambda b: -weights[(b[0].id, b[1])])
+
+
+def _get_traffic_coverage(bundles_to_process, weights, available_at, started_at):
+    """Returns (percent, seconds) tuples with the seconds after `started_at`
+    until each BUNDLE_TRAFFIC_COVERAGE percent of the traffic to the written
+    bundles got the new files, going by `available_at`.
+
+    """
+    filename_weights = {
+        _get_bundle_filename(locale, distribution_bundle, channel):
+            weights[(distribution_bundle.id, locale)]
+        for distribution_bundle, locale, channel in _iter_bundle_slots(bundles_to_process)
+    }
+    total = sum(filename_weights.get(filename, 0) for filename in available_at)
+    coverage = []
+    if not total:
+        return coverage
+
+    thresholds = sorted(settings.BUNDLE_TRAFFIC_COVERAGE)
+    covered = 0
+    for filename, at in sorted(available_at.items(), key=lambda item: item[1]):
+        covered += filename_weights.get(filename, 0)
+        while thresholds and covered >= total * thresholds[0] / 100:
+            coverage.append((thresholds.pop(0), max(at - started_at, 0)))
+    return coverage
+
+
+def _claim_dirty_bundles():
+    """Removes and returns all DirtyBundles."""
+    with transaction.atomic():
+        dirty_bundles = list(models.DirtyBundle.objects.select_for_update())
+        models.DirtyBundle.objects.filter(
+            id__in=[dirty_bundle.id for dirty_bundle in dirty_bundles]
+        ).delete()
+    return dirty_bundles
+
+
+def _get_dirty_bundles_to_process(dirty_bundles):
+    distribution_bundles = (models.DistributionBundle.objects
+                            .filter(id__in={d.distribution_bundle_id for d in dirty_bundles})
+                            .prefetch_related('distributions')
+                            .in_bulk())
+    bundles_to_process = {}
+    for dirty_bundle in dirty_bundles:
+        distribution_bundle = distribution_bundles[dirty_bundle.distribution_bundle_id]
+        for locale in _expand_locales([dirty_bundle.locale]):
+            bundles_to_process[(distribution_bundle.id, locale)] = (distribution_bundle, locale)
+    return sorted(bundles_to_process.values(), key=lambda b: (b[0].id, b[1]))
+
+
+def _get_aliased_bundles(paths, manifest_bundles):
+    """Returns the (DistributionBundle code name, locale) tuples of the
+    bundles in `manifest_bundles`, other than `paths`, that are aliased with
+    any of `paths`: the bundles they alias and the other aliases of those.
+
+    """
+    canonical_paths = set(paths) | {
+        manifest_bundles[path]['alias_of'] for path in paths
+        if manifest_bundles.get(path) and manifest_bundles[path].get('alias_of')}
+    return {
+        (entry['distribution_bundle'], entry['locale'])
+        for path, entry in manifest_bundles.items()
+        if path not in paths and (path in canonical_paths or
+                                  entry.get('alias_of') in canonical_paths)
+    }
+
+
+def _add_aliased_bundles(bundles_to_process, manifest_bundles):
+    """Returns `bundles_to_process` with the (DistributionBundle, locale)
+    tuples of the bundles aliased with any of them, which must get processed
+    together to check whether they are still identical.
+
+    """
+    paths = {_get_bundle_path(locale, distribution_bundle, channel)
+             for distribution_bundle, locale, channel in _iter_bundle_slots(bundles_to_process)}
+    processed = {(distribution_bundle.id, locale)
+                 for distribution_bundle, locale in bundles_to_process}
+    aliased_bundles = _get_aliased_bundles(paths, manifest_bundles)
+    if not aliased_bundles:
+        return bundles_to_process
+
+    distribution_bundles = (models.DistributionBundle.objects
+                            .filter(code_name__in={code for code, locale in aliased_bundles})
+                            .prefetch_related('distributions')
+                            .in_bulk(field_name='code_name'))
+    return bundles_to_process + [
+        (distribution_bundles[code_name], locale)
+        for code_name, locale in sorted(aliased_bundles)
+        if code_name in distribution_bundles and
+        (distribution_bundles[code_name].id, locale) not in processed
+    ]
+
+
+def _get_boundary_jobs(start, end):
+    """Returns the Jobs that `update_jobs` will publish or complete, based on
+    their publish dates, after `start` and until `end`.
+
+    """
+    offset = timedelta(minutes=settings.SNIPPETS_PUBLICATION_OFFSET)
+    return models.Job.objects.filter(
+        Q(status=models.Job.SCHEDULED,
+          publish_start__gt=start - offset, publish_start__lte=end - offset) |
+        Q(status__in=[models.Job.SCHEDULED, models.Job.PUBLISHED],
+          publish_end__gt=start, publish_end__lte=end)
+    )
+
+
+def get_publish_boundaries(start, end):
+    """Returns the sorted times after `start` and until `end` when Jobs get
+    published or completed.
+
+    """
+    offset = timedelta(minutes=settings.SNIPPETS_PUBLICATION_OFFSET)
+    boundaries = set()
+    jobs = _get_boundary_jobs(start, end).values_list('status', 'publish_start', 'publish_end')
+    for status, publish_start, publish_end in jobs:
+        if (status == models.Job.SCHEDULED and publish_start and
+                start < publish_start + offset <= end):
+            boundaries.add(publish_start + offset)
+        if publish_end and start < publish_end <= end:
+            boundaries.add(publish_end)
+    return sorted(boundaries)
+
+
+def _get_live_jobs(at):
+    """Returns the Jobs that will be Published at time `at`, if nothing but
+    their publish dates changes until then.
+
+    """
+    offset = timedelta(minutes=settings.SNIPPETS_PUBLICATION_OFFSET)
+    return models.Job.objects.filter(
+        Q(status=models.Job.PUBLISHED) |
+        Q(status=models.Job.SCHEDULED, publish_start__lte=at - offset) |
+        Q(status=models.Job.SCHEDULED, publish_start=None)
+    ).exclude(publish_end__lte=at)
+
+
+def _get_prestaged_prefix(boundary):
+    return os.path.join(settings.MEDIA_BUNDLES_PREGEN_ROOT, PRESTAGED_DIRNAME,
+                        f'{boundary:%Y%m%d%H%M%S%f}')
+
+
+def _get_prestaged_plans():
+    """Returns a sorted list of (boundary, prefix) tuples of the prestaged
+    bundle sets.
+
+    """
+    root = os.path.join(settings.MEDIA_BUNDLES_PREGEN_ROOT, PRESTAGED_DIRNAME)
+    try:
+        directories, files = default_storage.listdir(root)
+    except FileNotFoundError:
+        return []
+    return sorted((datetime.strptime(name, '%Y%m%d%H%M%S%f'), os.path.join(root, name))
+                  for name in directories)
+
+
+def prestage_bundles(now=None, horizon=None, stdout=StringIO()):
+    """Renders the bundles as they will be at each publish boundary in the
+    next `horizon`, a timedelta defaulting to BUNDLE_PRESTAGE_HORIZON
+    minutes, and uploads them under a prefix per boundary with a plan of the
+    changes.
+
+    Generation promotes them once their boundary is reached. Bundle sets
+    prestaged by a previous run for boundaries after `now` get replaced.
+
+    """
+    now = now or datetime.utcnow()
+    horizon = horizon or timedelta(minutes=settings.BUNDLE_PRESTAGE_HORIZON)
+    stats = BundleStats()
+    manifest_bundles = dict(load_manifest()['bundles'])
+    for boundary, prefix in _get_prestaged_plans():
+        if boundary > now:
+            _remove_staging(prefix)
+    existing_files = _list_bundle_files()
+
+    plans = []
+    start = now
+    for boundary in get_publish_boundaries(now, now + horizon):
+        boundary_jobs = _get_boundary_jobs(start, boundary)
+        bundles_to_process = _get_bundles_of_jobs(boundary_jobs)
+        prefix = _get_prestaged_prefix(boundary)
+        summary = _write_bundles(bundles_to_process, manifest_bundles, stats, prefix,
+                                 existing_files, jobs=_get_live_jobs(boundary),
+                                 collapse_aliases=False)
+
+        changed = set(summary['written']) | set(summary['removed'])
+        plan = {
+            'start': start.isoformat(),
+            'boundary': boundary.isoformat(),
+            'prestaged_at': now.isoformat(),
+            # The Jobs to publish or complete with the bundles.
+            'jobs': sorted(boundary_jobs.values_list('id', flat=True)),
+            'bundles': {},
+        }
+        start = boundary
+        for distribution_bundle, locale, channel in _iter_bundle_slots(bundles_to_process):
+            path = _get_bundle_path(locale, distribution_bundle, channel)
+            if _get_bundle_filename(locale, distribution_bundle, channel) not in changed:
+                continue
+            previous_entry = manifest_bundles.get(path)
+            plan['bundles'][path] = {
+                'entry': summary['manifest'][path],
+                # The content the bundle gets prestaged on top of.
+                'base_hash': previous_entry['content_hash'] if previous_entry else None,
+                'locale': locale,
+                'distribution_bundle': distribution_bundle.id,
+            }
+            if summary['manifest'][path] is None:
+                manifest_bundles.pop(path, None)
+            else:
+                manifest_bundles[path] = summary['manifest'][path]
+        if not plan['bundles']:
+            continue
+
+        if existing_files is not None:
+            for filename in summary['written']:
+                existing_files.update(name for encoding, name in _get_variant_filenames(filename))
+            for filename in summary['removed']:
+                existing_files.difference_update(
+                    name for encoding, name in _get_variant_filenames(filename))
+        default_storage.save(os.path.join(prefix, PLAN_FILENAME),
+                             ContentFile(json.dumps(plan, sort_keys=True)))
+        plans.append(plan)
+        stdout.write('Prestaged {} bundles for {}'.format(len(plan['bundles']), boundary))
+
+    return plans
+
+
+def get_prestaged_boundaries():
+    """Returns the sorted boundaries of the prestaged bundle sets."""
+    return [boundary for boundary, prefix in _get_prestaged_plans()]
+
+
+def _update_boundary_jobs(plan):
+    """Publishes and completes the Jobs that the bundles of `plan` got
+    prestaged for, like `update_jobs` does once their publish dates are
+    reached, without marking the bundles they are in as dirty.
+
+    """
+    if 'jobs' not in plan:
+        return
+    start = datetime.fromisoformat(plan['start'])
+    boundary = datetime.fromisoformat(plan['boundary'])
+    offset = timedelta(minutes=settings.SNIPPETS_PUBLICATION_OFFSET)
+    user = get_user_model().objects.get_or_create(username='snippets_bot')[0]
+    with transaction.atomic():
+        marked = set(models.DirtyBundle.objects.values_list('id', flat=True))
+        for job in _get_boundary_jobs(start, boundary).filter(id__in=plan['jobs']):
+            if (job.status == models.Job.SCHEDULED and job.publish_start and
+                    job.publish_start + offset <= boundary):
+                job.change_status(status=models.Job.PUBLISHED, user=user,
+                                  reason='Published start date reached.')
+            if (job.status == models.Job.PUBLISHED and job.publish_end and
+                    job.publish_end <= boundary):
+                job.change_status(status=models.Job.COMPLETED, user=user,
+                                  reason='Publication end date reached.')
+        models.DirtyBundle.objects.exclude(id__in=marked).delete()
+
+
+def promote_prestaged_bundles(now=None, stdout=StringIO()):
+    """Promotes the bundles prestaged for boundaries until `now`, together
+    with their Jobs.
+
+    Gets called at each boundary by the `bundle_daemon` process or the cron
+    process, see `get_prestaged_boundaries`, and by bundle generation.
+
+    """
+    stats = BundleStats()
+    with stats.phase('write'):
+        manifest = load_manifest()
+    _promote_prestaged_bundles(manifest, now or datetime.utcnow(), stats, stdout)
+
+
+def _promote_prestaged_bundles(manifest, now, stats, stdout):
+    """Moves the bundles prestaged for boundaries until `now` into place and
+    updates `manifest`, oldest boundary first.
+
+    Bundles that changed since they got prestaged, or that other bundles are
+    aliases of, are not promoted but marked as dirty, to get regenerated from
+    the current Jobs. The Jobs of the boundary get published and completed,
+    and the bundles promoted for them don't get marked as dirty.
+
+    """
+    promoted = False
+    for boundary, prefix in _get_prestaged_plans():
+        if boundary > now:
+            break
+
+        plan_filename = os.path.join(prefix, PLAN_FILENAME)
+        if not default_storage.exists(plan_filename):
+            # The plan gets saved last. Prestaging didn't finish.
+            _remove_staging(prefix)
+            continue
+        with default_storage.open(plan_filename) as fp:
+            plan = json.loads(fp.read())
+
+        summary = {'written': [], 'removed': [], 'available_at': {}}
+        dirty_bundles = []
+        # Bundles get prestaged without aliases, and bundles with aliases
+        # must get regenerated together with them.
+        canonical_paths = {entry.get('alias_of') for entry in manifest['bundles'].values()}
+        for path, item in plan['bundles'].items():
+            current_entry = manifest['bundles'].get(path)
+            if ((current_entry['content_hash'] if current_entry else None) != item['base_hash'] or
+                    path in canonical_paths):
+                dirty_bundles.append(models.DirtyBundle(
+                    locale=item['locale'], distribution_bundle_id=item['distribution_bundle']))
+                continue
+            filename = os.path.join(settings.MEDIA_BUNDLES_PREGEN_ROOT, path)
+            if item['entry'] is None:
+                summary['removed'].append(filename)
+                manifest['bundles'].pop(path, None)
+            else:
+                summary['written'].append(filename)
+                manifest['bundles'][path] = item['entry']
+
+        _publish_staged_bundles(summary, prefix, stats)
+        _update_boundary_jobs(plan)
+        models.DirtyBundle.objects.bulk_create(dirty_bundles, ignore_conflicts=True)
+        _record_bundle_run(summary['written'], summary['removed'], manifest['bundles'])
+        promoted = True
+        stdout.write('Promoted {} bundles prestaged for {}'.format(
+            len(summary['written']) + len(summary['removed']), boundary))
+
+    if promoted:
+        with stats.phase('write'):
+            _save_manifest(manifest)
+            _save_alias_map(manifest['bundles'])
+
+
+def generate_bundles(timestamp=None, limit_to_locale=None,
+                     limit_to_distribution_bundle=None, save_to_disk=True,
+                     stdout=StringIO(), workers=1, dirty=False, stats_format=None,
+                     dry_run=False, diff=False, distributed=False):
+    """Generates bundles and returns a summary dictionary or, when
+    `save_to_disk` is False, a ContentFile of the first bundle.
+
+    With `dry_run`, nothing gets written or marked as processed. The bundles
+    get compared with the stored ones and the diff dictionary of
+    `_diff_bundles` gets returned. `diff` writes the details of each bundle
+    to `stdout`.
+
+    With `dirty`, only the bundles marked in DirtyBundle get regenerated,
+    unless the code revision changed since the last full generation.
+
+    The time spent and the queries run in each phase are collected in the
+    `stats` of the summary. With `stats_format` set to `text` they get
+    written to `stdout` as a table, with `json` as a single JSON line.
+
+    With `distributed`, the bundles get written by `run_bundle_worker`
+    processes on any node, instead of `workers` local processes.
+
+    """
+    stats = BundleStats()
+    with _count_queries(stats):
+        return _generate_bundles(timestamp, limit_to_locale, limit_to_distribution_bundle,
+                                 save_to_disk, stdout, workers, dirty, stats, stats_format,
+                                 dry_run, diff, distributed)
+
+
+def _write_stats(summary, stdout, stats_format):
+    if stats_format == 'json':
+        stdout.write(json.dumps({
+            'event': 'generate_bundles',
+            'processed': summary['processed'],
+            'written': len(summary['written']),
+            'unchanged': len(summary['unchanged']),
+            'removed': len(summary['removed']),
+            'aliased': len(summary['aliased']),
+            'bytes_written': sum(summary['bytes_written'].values()),
+            'workers': summary['workers'],
+            'time': summary['time'],
+            'phases': summary['stats'],
+            'compression': summary['compression'],
+            'coverage': {str(percent): seconds for percent, seconds in summary['coverage']},
+        }, sort_keys=True))
+    elif stats_format == 'text':
+        stdout.write(f'{"Phase":<12}{"Time":>10}{"Queries":>10}')
+        for phase, values in summary['stats'].items():
+            stdout.write(f'{phase:<12}{values["time"]:>9.2f}s{values["queries"]:>10}')
+
+
+def _generate_bundles(timestamp, limit_to_locale, limit_to_distribution_bundle,
+                      save_to_disk, stdout, workers, dirty, stats, stats_format,
+                      dry_run, diff, distributed=False):
+    start_time = time.monotonic()
+    started_at = time.time()
+    full_generation = not any([timestamp, dirty, limit_to_locale, limit_to_distribution_bundle])
+    manifest = None
+    if save_to_disk:
+        with stats.phase('write'):
+            manifest = load_manifest()
+        if dirty and manifest.get('git_sha') != settings.GIT_SHA:
+            stdout.write('Code revision changed since the last full generation.')
+            dirty = False
+            full_generation = True
+        if settings.BUNDLE_PRESTAGE and not dry_run:
+            _promote_prestaged_bundles(manifest, datetime.utcnow(), stats, stdout)
+
+    # Bundles marked as dirty are claimed upfront, so that changes made
+    # during the generation get picked up by the next run.
+    dirty_bundles = []
+    with stats.phase('query'):
+        if dry_run and dirty:
+            dirty_bundles = list(models.DirtyBundle.objects.all())
+        elif save_to_disk and not dry_run and (dirty or full_generation):
+            dirty_bundles = _claim_dirty_bundles()
+
+    # All content gets read from a single snapshot, taken after claiming the
+    # DirtyBundles so that it includes their changes. Pool and distributed
+    # workers import it.
+    export = save_to_disk and not dry_run and (distributed or workers > 1)
+    with bundle_snapshot(export=export) as snapshot:
+        with stats.phase('query'):
+            if dirty:
+                stdout.write('Generating bundles marked as dirty.')
+                bundles_to_process = _get_dirty_bundles_to_process(dirty_bundles)
+            else:
+                bundles_to_process = _get_bundles_to_process(
+                    timestamp, limit_to_locale, limit_to_distribution_bundle, stdout)
+
+        if save_to_disk is False:
+            planner = BundlePlanner(list({b.id: b for b, locale in bundles_to_process}.values()),
+                                    stats)
+            for distribution_bundle, locale_to_process in bundles_to_process:
+                content_file = _render_bundle(planner, distribution_bundle, locale_to_process)
+                if content_file:
+                    encoding, variant, seconds = _compress_bundle(content_file)[0]
+                    return variant
+
+            # If we reach this point, it means that we didn't have any Jobs to
+            # return for the locale, channel, distribution combination. Return an
+            # empty bundle
+            return ContentFile(
+                json.dumps({
+                    'messages': [],
                     'metadata': {
                         'generated_at': datetime.utcnow().isoformat(),
-                        'number_of_snippets': len(data),
-                        'locale': locale_to_process,
-                        'distribution_bundle': distribution_bundle.code_name,
+                        'number_of_snippets': 0,
+                        'locale': limit_to_locale,
+                        'distribution_bundle': limit_to_distribution_bundle,
                     }
                 })
+            )
 
-                # Convert str to bytes.
-                if isinstance(bundle_content, str):
-                    bundle_content = bundle_content.encode('utf-8')
+        # Bundles with the most traffic get written first, so they are the
+        # ones others become aliases of.
+        with stats.phase('query'):
+            bundles_to_process = _add_aliased_bundles(bundles_to_process, manifest['bundles'])
+            weights = _get_traffic_weights(bundles_to_process)
+        bundles_to_process = _prioritize_bundles(bundles_to_process, weights)
 
-                if settings.BUNDLE_BROTLI_COMPRESS:
-                    content_file = ContentFile(brotli.compress(bundle_content))
-                    content_file.content_encoding = 'br'
-                else:
-                    content_file = ContentFile(bundle_content)
+        if dry_run:
+            bundles_diff = _diff_bundles(bundles_to_process, manifest['bundles'], stats)
+            _write_diff(bundles_diff, stdout, diff)
+            return bundles_diff
 
-                if save_to_disk is True:
-                    default_storage.save(filename, content_file)
-                    stdout.write('Writing bundle {}'.format(filename))
-                else:
-                    return content_file
-
-    # If save_to_disk is False and we reach this point, it means that we didn't
-    # have any Jobs to return for the locale, channel, distribution combination.
-    # Return an empty bundle
-    if save_to_disk is False:
-        return ContentFile(
-            json.dumps({
-                'messages': [],
-                'metadata': {
-                    'generated_at': datetime.utcnow().isoformat(),
-                    'number_of_snippets': 0,
-                    'locale': limit_to_locale,
-                    'distribution_bundle': limit_to_distribution_bundle,
-                }
-            })
+        # Files get uploaded under a staging prefix first and moved into place
+        # once all of them got uploaded, so that readers don't see a partially
+        # updated set of bundles.
+        staging = _get_staging_prefix() if settings.BUNDLE_STAGED_PUBLISH else None
+        try:
+            # Listing the stored files once saves checking for each bundle
+            # whether it exists.
+            with stats.phase('write'):
+                existing_files = _list_bundle_files()
+            if distributed:
+                summary = _write_bundles_distributed(bundles_to_process, stats, staging,
+                                                     snapshot, stdout)
+            elif workers > 1 and len(bundles_to_process) > 1:
+                summary = _write_bundles_in_pool(bundles_to_process, workers,
+                                                 manifest['bundles'], stats, staging,
+                                                 existing_files, snapshot)
+            else:
+                summary = _write_bundles(bundles_to_process, manifest['bundles'], stats, staging,
+                                         existing_files)
+            if staging:
+                _publish_staged_bundles(summary, staging, stats, existing_files)
+            # Only full generations plan all the bundles.
+            if full_generation and existing_files is not None:
+                with stats.phase('write'):
+                    _remove_orphaned_bundles(summary, bundles_to_process, manifest['bundles'],
+                                             existing_files)
+        except Exception:
+            if staging:
+                _remove_staging(staging)
+            # Put the claimed DirtyBundles back to get processed by the next run.
+            models.DirtyBundle.objects.bulk_create(
+                [models.DirtyBundle(locale=d.locale,
+                                    distribution_bundle_id=d.distribution_bundle_id)
+                 for d in dirty_bundles],
+                ignore_conflicts=True,
+            )
+            raise
+
+    changed = False
+    for path, entry in summary['manifest'].items():
+        if entry is None:
+            changed |= manifest['bundles'].pop(path, None) is not None
+        elif manifest['bundles'].get(path) != entry:
+            manifest['bundles'][path] = entry
+            changed = True
+    if full_generation and bundles_to_process and manifest.get('git_sha') != settings.GIT_SHA:
+        manifest['git_sha'] = settings.GIT_SHA
+        changed = True
+    with stats.phase('write'):
+        summary['removed_aliases'] = _remove_expired_aliases(manifest['bundles'], existing_files)
+        # The manifest only gets saved when it changed.
+        if changed or summary['removed_aliases']:
+            manifest['generated_at'] = datetime.utcnow().isoformat()
+            _save_manifest(manifest)
+            _save_alias_map(manifest['bundles'], existing_files)
+        _record_bundle_run(summary['written'], summary['removed'], manifest['bundles'])
+
+    summary['processed'] = len(bundles_to_process)
+    summary['workers'] = workers
+    summary['time'] = time.monotonic() - start_time
+    summary['stats'] = stats.as_dict()
+    summary['coverage'] = _get_traffic_coverage(bundles_to_process, weights,
+                                                summary['available_at'], started_at)
+
+    for filename in summary['removed']:
+        stdout.write('Removing {}'.format(filename))
+    for filename in summary['written']:
+        stdout.write('Writing bundle {} ({} bytes)'.format(
+            filename, summary['bytes_written'][filename]))
+    for filename in summary['aliased']:
+        path = os.path.relpath(filename, settings.MEDIA_BUNDLES_PREGEN_ROOT)
+        stdout.write('Aliasing bundle {} to {}'.format(
+            filename, summary['manifest'][path]['alias_of']))
+    for filename in summary['removed_aliases']:
+        stdout.write('Removing aliased {}'.format(filename))
+    for filename in summary['over_budget']:
+        stdout.write('Warning: {} is over the size budget of {} bytes'.format(
+            filename, settings.BUNDLE_SIZE_BUDGET))
+
+    stdout.write(
+        f'Bundles Processed: {summary["processed"]}\n'
+        f'Bundles Written: {len(summary["written"])}\n'
+        f'Bundles Unchanged: {len(summary["unchanged"])}\n'
+        f'Bundles Removed: {len(summary["removed"])}\n'
+        f'Bundles Aliased: {len(summary["aliased"])}\n'
+        f'Workers: {workers}\n'
+        f'Time: {summary["time"]:.2f}s\n'
+    )
+    for encoding, encoding_stats in sorted(summary['compression'].items()):
+        saved = (1 - encoding_stats['size'] / encoding_stats['raw_size']
+                 if encoding_stats['raw_size'] else 0)
+        stdout.write(
+            f'Compression {encoding}: {encoding_stats["raw_size"]} -> '
+            f'{encoding_stats["size"]} bytes ({saved:.1%} saved) in '
+            f'{encoding_stats["time"]:.2f}s\n'
         )
+    for percent, seconds in summary['coverage']:
+        stdout.write(f'Traffic {percent}% covered: {seconds:.2f}s\n')
+    _write_stats(summary, stdout, stats_format)
+
+    return summary
+
+
+class BundleNotificationListener:
+    """LISTENs for DirtyBundle notifications on a dedicated PostgreSQL
+    connection, which bundle generation can't close or keep in a transaction.
+
+    """
+    def __init__(self):
+        self.connection = connection.get_new_connection(connection.get_connection_params())
+        self.connection.autocommit = True
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'LISTEN {models.DirtyBundle.NOTIFY_CHANNEL}')
+
+    def wait(self, timeout):
+        """Waits up to `timeout` seconds for notifications and returns the
+        number received.
+
+        """
+        self.connection.poll()
+        if not self.connection.notifies:
+            select.select([self.connection], [], [], timeout)
+            self.connection.poll()
+        received = len(self.connection.notifies)
+        self.connection.notifies.clear()
+        return received
+
+    def close(self):
+        self.connection.close()
+
+
+def run_bundle_daemon(listener=None, iterations=None, stdout=StringIO()):
+    """Regenerates the dirty bundles whenever DirtyBundles get marked.
+
+    Notifications get debounced: generation starts once none arrived for
+    BUNDLE_DAEMON_DEBOUNCE seconds, or BUNDLE_DAEMON_MAX_DELAY seconds after
+    the first one. Bundles get also generated on start, to pick up new code,
+    and every BUNDLE_DAEMON_IDLE_TIMEOUT seconds if there are DirtyBundles,
+    in case a notification got lost.
+
+    With BUNDLE_PRESTAGE, prestaged bundles get promoted as soon as their
+    boundary is reached.
+
+    `iterations` limits the number of wake ups, for testing.
+
+    """
+    listener = listener or BundleNotificationListener()
+    try:
+        generate_bundles(dirty=True, distributed=settings.BUNDLE_DISTRIBUTED, stdout=stdout)
+        iteration = 0
+        while iterations is None or iteration < iterations:
+            iteration += 1
+            close_old_connections()
+            timeout = settings.BUNDLE_DAEMON_IDLE_TIMEOUT
+            if settings.BUNDLE_PRESTAGE:
+                now = datetime.utcnow()
+                boundaries = get_prestaged_boundaries()
+                if boundaries and boundaries[0] <= now:
+                    promote_prestaged_bundles(now, stdout)
+                upcoming = [boundary for boundary in boundaries if boundary > now]
+                if upcoming:
+                    timeout = min(timeout, (upcoming[0] - now).total_seconds())
+            if listener.wait(timeout):
+                deadline = time.monotonic() + settings.BUNDLE_DAEMON_MAX_DELAY
+                while True:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not listener.wait(
+                            min(settings.BUNDLE_DAEMON_DEBOUNCE, remaining)):
+                        break
+            elif not models.DirtyBundle.objects.exists():
+                continue
+            generate_bundles(dirty=True, distributed=settings.BUNDLE_DISTRIBUTED, stdout=stdout)
+    finally:
+        listener.close()
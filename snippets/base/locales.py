@@ -0,0 +1,50 @@
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from product_details import product_details
+
+
+class LocaleIndex:
+    """Maps every prefix of a set of locales to the locales starting with
+    it, to expand locale codes without scanning all the locales.
+
+    """
+    def __init__(self, locales):
+        self.locales = sorted({locale.lower() for locale in locales})
+        self._prefixes = defaultdict(list)
+        for locale in self.locales:
+            for i in range(1, len(locale) + 1):
+                self._prefixes[locale[:i]].append(locale)
+
+    def __contains__(self, locale):
+        return locale.lower() in self._prefixes.get(locale.lower(), [])
+
+    def expand(self, codes):
+        """Returns the sorted locales that start with any of `codes`.
+
+        Multiple codes can expand to the same locale (e.g. `en` and `en-us`),
+        each locale is returned only once.
+
+        """
+        return sorted({
+            locale for code in codes for locale in self._prefixes.get(code.lower(), [])
+        })
+
+
+_locale_index = None
+_locale_index_built_at = None
+
+
+def get_locale_index():
+    """Returns the LocaleIndex of product_details languages, rebuilt every
+    LOCALE_INDEX_TIMEOUT seconds to pick up the updates that
+    `update_product_details` makes from another process.
+
+    """
+    global _locale_index, _locale_index_built_at
+    now = time.monotonic()
+    if _locale_index is None or now - _locale_index_built_at >= settings.LOCALE_INDEX_TIMEOUT:
+        _locale_index = LocaleIndex(product_details.languages.keys())
+        _locale_index_built_at = now
+    return _locale_index
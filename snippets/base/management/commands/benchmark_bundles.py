@@ -0,0 +1,73 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, connections
+
+from snippets.base import benchmark
+
+
+class Command(BaseCommand):
+    args = '(no args)'
+    help = ('Benchmark bundle generation on a synthetic dataset and print the '
+            'results as JSON. Creates and destroys a test database.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--jobs',
+            type=int,
+            default=1000,
+            help='Number of Published Jobs to create. Defaults to 1000.',
+        )
+        parser.add_argument(
+            '--locales',
+            type=int,
+            default=20,
+            help='Number of locales to spread the Jobs over. Defaults to 20.',
+        )
+        parser.add_argument(
+            '--distribution-bundles',
+            type=int,
+            default=3,
+            help='Number of DistributionBundles to spread the Jobs over. Defaults to 3.',
+        )
+        parser.add_argument(
+            '--changed-jobs',
+            type=int,
+            default=10,
+            help='Number of Jobs to change before the incremental run. Defaults to 10.',
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=1,
+            help='Number of worker processes to generate bundles with. Defaults to 1.',
+        )
+        parser.add_argument(
+            '--output',
+            help='Write the results to a file instead of stdout.',
+        )
+
+    def handle(self, *args, **options):
+        # The dataset must not end up in the configured database.
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        connections[settings.BUNDLE_DATABASE_ALIAS].creation.set_as_test_mirror(
+            connection.settings_dict)
+        try:
+            results = benchmark.run_benchmark(
+                jobs=options['jobs'],
+                locales=options['locales'],
+                distribution_bundles=options['distribution_bundles'],
+                changed_jobs=options['changed_jobs'],
+                workers=options['workers'],
+            )
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        output = json.dumps(results, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as fp:
+                fp.write(output)
+        else:
+            self.stdout.write(output)
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from snippets.base import bundles
+
+
+class Command(BaseCommand):
+    args = '(no args)'
+    help = 'Regenerate bundles as soon as they get marked as dirty'
+
+    def handle(self, *args, **options):
+        bundles.run_bundle_daemon(stdout=self.stdout)
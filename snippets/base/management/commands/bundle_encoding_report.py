@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from snippets.base import bundles
+
+
+class Command(BaseCommand):
+    args = '(no args)'
+    help = 'Compare the size of all bundles with the different encoding modes'
+
+    def handle(self, *args, **options):
+        sizes = bundles.get_encoding_sizes()
+        default_size = sizes['default']['raw']
+
+        self.stdout.write(f'{"Encoding":<30}{"Raw":>15}{"Brotli":>15}{"Saved":>10}')
+        for name, size in sizes.items():
+            saved = 1 - size['raw'] / default_size if default_size else 0
+            self.stdout.write(
+                f'{name:<30}{size["raw"]:>15}{size["brotli"]:>15}{saved:>10.1%}'
+            )
+        self.stdout.write(f'JSON backend: {"orjson" if bundles.orjson else "json"}')
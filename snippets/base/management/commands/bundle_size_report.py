@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand
+
+from snippets.base import bundles
+
+
+class Command(BaseCommand):
+    args = '(no args)'
+    help = 'Print the largest bundles and the messages, templates and fields contributing the most'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--limit',
+            type=int,
+            default=10,
+            help='Number of bundles and messages to print. Defaults to 10.',
+        )
+
+    def handle(self, *args, **options):
+        report = bundles.get_size_report()
+        limit = options['limit']
+
+        self.stdout.write('Largest bundles')
+        self.stdout.write(f'{"Bundle":<50}{"Snippets":>10}{"Raw":>12}{"Brotli":>12}')
+        for bundle in sorted(report['bundles'], key=lambda b: b['brotli'], reverse=True)[:limit]:
+            self.stdout.write(
+                f'{bundle["path"]:<50}{bundle["number_of_snippets"]:>10}'
+                f'{bundle["raw"]:>12}{bundle["brotli"]:>12}'
+            )
+
+        self.stdout.write('\nLargest contributors, message size times the number of bundles')
+        self.stdout.write(
+            f'{"Job":>8}  {"Snippet":<40}{"Template":<30}{"Raw":>10}{"Bundles":>9}{"Total":>12}')
+        messages = sorted(report['messages'], key=lambda m: m['raw'] * m['bundles'], reverse=True)
+        for message in messages[:limit]:
+            self.stdout.write(
+                f'{message["job"]:>8}  {message["snippet"][:38]:<40}'
+                f'{message["template"] or "":<30}{message["raw"]:>10}'
+                f'{message["bundles"]:>9}{message["raw"] * message["bundles"]:>12}'
+            )
+
+        self.stdout.write('\nBy template')
+        self.stdout.write(f'{"Template":<40}{"Messages":>10}{"Raw":>12}{"Brotli":>12}')
+        for template, sizes in sorted(report['templates'].items(),
+                                      key=lambda item: item[1]['raw'], reverse=True):
+            self.stdout.write(
+                f'{template or "":<40}{sizes["count"]:>10}{sizes["raw"]:>12}{sizes["brotli"]:>12}')
+
+        self.stdout.write('\nBy field')
+        total = sum(report['fields'].values())
+        for field, size in sorted(report['fields'].items(), key=lambda item: item[1],
+                                  reverse=True):
+            share = size / total if total else 0
+            self.stdout.write(f'{field:<40}{size:>12}{share:>10.1%}')
@@ -1,4 +1,5 @@
-from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
 
 from snippets.base import bundles
 
@@ -13,9 +14,61 @@ class Command(BaseCommand):
             '--timestamp',
             help='Parse Jobs last modified after <timestamp>',
         )
+        parser.add_argument(
+            '--dirty',
+            action='store_true',
+            help='Only generate bundles with changes since the last run.',
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=1,
+            help='Number of worker processes to generate bundles with. Defaults to 1.',
+        )
+        parser.add_argument(
+            '--stats',
+            nargs='?',
+            const='text',
+            choices=['text', 'json'],
+            help='Write the time and queries of each phase as a table or a JSON line.',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Compare the bundles with the stored ones without writing anything.',
+        )
+        parser.add_argument(
+            '--diff',
+            action='store_true',
+            help='With --dry-run, list the added, removed and changed bundles and messages.',
+        )
+        parser.add_argument(
+            '--distributed',
+            action='store_true',
+            default=settings.BUNDLE_DISTRIBUTED,
+            help='Split the bundles into work units for --worker processes on any node.',
+        )
+        parser.add_argument(
+            '--worker',
+            action='store_true',
+            help='Process the work units of distributed generations until stopped.',
+        )
 
     def handle(self, *args, **options):
+        if options['worker']:
+            bundles.run_bundle_worker(stdout=self.stdout)
+            return
+
+        if options['diff'] and not options['dry_run']:
+            raise CommandError('--diff requires --dry-run.')
+
         bundles.generate_bundles(
             timestamp=options.get('timestamp', None),
+            dirty=options['dirty'],
+            workers=options['workers'],
+            stats_format=options['stats'],
+            dry_run=options['dry_run'],
+            diff=options['diff'],
+            distributed=options['distributed'],
             stdout=self.stdout,
         )
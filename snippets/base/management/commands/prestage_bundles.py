@@ -0,0 +1,25 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from snippets.base import bundles
+
+
+class Command(BaseCommand):
+    args = '(no args)'
+    help = 'Prestage the bundles of Jobs getting published or completed soon'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--horizon',
+            type=int,
+            default=settings.BUNDLE_PRESTAGE_HORIZON,
+            help='Minutes ahead to prestage bundles for. Defaults to BUNDLE_PRESTAGE_HORIZON.',
+        )
+
+    def handle(self, *args, **options):
+        bundles.prestage_bundles(
+            horizon=timedelta(minutes=options['horizon']),
+            stdout=self.stdout,
+        )
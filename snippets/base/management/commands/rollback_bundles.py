@@ -0,0 +1,67 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
+
+from snippets.base import bundles
+from snippets.base.models import BundleRun
+
+
+class Command(BaseCommand):
+    args = '[run]'
+    help = ('Restore bundles to their content after a bundle run, or list the latest runs. '
+            'Bundles get generated again from the Jobs on their next change.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'run',
+            nargs='?',
+            type=int,
+            help='ID of the bundle run to roll back to. Lists the latest runs when missing.',
+        )
+        parser.add_argument(
+            '--locale',
+            help='Only roll back the bundles of <locale>.',
+        )
+        parser.add_argument(
+            '--distribution-bundle',
+            help='Only roll back the bundles of the DistributionBundle with <code name>.',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='List the bundles that would get restored or removed.',
+        )
+        parser.add_argument(
+            '--limit',
+            type=int,
+            default=20,
+            help='Number of runs to list. Defaults to 20.',
+        )
+
+    def handle(self, *args, **options):
+        if options['run'] is None:
+            runs = BundleRun.objects.annotate(count=Count('bundles'))[:options['limit']]
+            for run in runs:
+                rollback = f' (rollback to {run.rollback_to_id})' if run.rollback_to_id else ''
+                self.stdout.write(
+                    f'{run.id:>8} {run.created:%Y-%m-%d %H:%M:%S} {run.git_sha:<12.12} '
+                    f'{run.count:>6} bundles{rollback}')
+            return
+
+        run = BundleRun.objects.filter(id=options['run']).first()
+        if run is None:
+            raise CommandError(f'Bundle run {options["run"]} does not exist.')
+        if run.created < BundleRun.get_history_start():
+            raise CommandError(f'The history of bundle run {run.id} got pruned, '
+                               f'see BUNDLE_HISTORY_DAYS.')
+
+        result = bundles.rollback_bundles(
+            options['run'],
+            locale=options['locale'],
+            distribution_bundle=options['distribution_bundle'],
+            dry_run=options['dry_run'],
+            stdout=self.stdout,
+        )
+        self.stdout.write(
+            f'Bundles Restored: {len(result["restored"])}\n'
+            f'Bundles Removed: {len(result["removed"])}\n'
+        )
@@ -0,0 +1,26 @@
+import csv
+import sys
+
+from django.core.management.base import BaseCommand
+
+from snippets.base import bundles
+
+
+class Command(BaseCommand):
+    args = '<file>'
+    help = ('Load the number of requests of each bundle, to generate the ones with the most '
+            'traffic first. Reads CSV rows of a bundle URL path and its number of requests, '
+            'e.g. aggregated from the CDN logs.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'file',
+            help='CSV file to read, or - for standard input.',
+        )
+
+    def handle(self, *args, **options):
+        if options['file'] == '-':
+            bundles.update_bundle_traffic(csv.reader(sys.stdin), stdout=self.stdout)
+            return
+        with open(options['file'], newline='') as fp:
+            bundles.update_bundle_traffic(csv.reader(fp), stdout=self.stdout)
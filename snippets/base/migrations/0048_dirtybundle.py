@@ -0,0 +1,26 @@
+# Generated by Django 2.2.28 on 2026-10-17 06:38
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0047_auto_20201112_0655'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DirtyBundle',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('locale', models.CharField(max_length=100)),
+                ('distribution_bundle', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='dirty_bundles', to='base.DistributionBundle')),
+            ],
+            options={
+                'unique_together': {('locale', 'distribution_bundle')},
+            },
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 2.2.28 on 2026-10-17 06:49
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def forwards(apps, schema_editor):
+    Locale = apps.get_model('base', 'Locale')
+    LocaleCode = apps.get_model('base', 'LocaleCode')
+    LocaleCode.objects.bulk_create([
+        LocaleCode(locale=locale, code=code)
+        for locale in Locale.objects.all()
+        for code in set(locale.code.strip(',').split(',')) if code
+    ])
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0048_dirtybundle'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LocaleCode',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('code', models.CharField(db_index=True, max_length=100)),
+                ('locale', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='codes', to='base.Locale')),
+            ],
+            options={
+                'unique_together': {('locale', 'code')},
+            },
+        ),
+        migrations.RunPython(forwards, migrations.RunPython.noop),
+    ]
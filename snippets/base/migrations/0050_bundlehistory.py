@@ -0,0 +1,39 @@
+# Generated by Django 2.2.28 on 2026-10-17 07:17
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0049_localecode'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BundleRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('git_sha', models.CharField(blank=True, max_length=100)),
+                ('rollback_to', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='base.BundleRun')),
+            ],
+            options={
+                'ordering': ('-id',),
+            },
+        ),
+        migrations.CreateModel(
+            name='BundleHistory',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(db_index=True, max_length=255)),
+                ('content_hash', models.CharField(blank=True, max_length=64)),
+                ('run', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='bundles', to='base.BundleRun')),
+            ],
+            options={
+                'verbose_name_plural': 'bundle history',
+                'unique_together': {('run', 'path')},
+            },
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 2.2.28 on 2026-10-17 07:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0050_bundlehistory'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BundleGeneration',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('staging', models.CharField(blank=True, max_length=255)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='BundleWorkUnit',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('locale', models.CharField(max_length=100)),
+                ('owner', models.CharField(blank=True, max_length=255)),
+                ('lease_expires', models.DateTimeField(blank=True, db_index=True, null=True)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('done', models.BooleanField(db_index=True, default=False)),
+                ('result', models.TextField(blank=True)),
+                ('error', models.TextField(blank=True)),
+                ('distribution_bundle', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='base.DistributionBundle')),
+                ('generation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='units', to='base.BundleGeneration')),
+            ],
+            options={
+                'unique_together': {('generation', 'locale', 'distribution_bundle')},
+            },
+        ),
+    ]
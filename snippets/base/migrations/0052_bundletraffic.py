@@ -0,0 +1,27 @@
+# Generated by Django 2.2.28 on 2026-10-17 07:51
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0051_bundleworkunit'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BundleTraffic',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('modified', models.DateTimeField(auto_now=True)),
+                ('locale', models.CharField(max_length=100)),
+                ('requests', models.PositiveIntegerField(default=0)),
+                ('distribution_bundle', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='base.DistributionBundle')),
+            ],
+            options={
+                'unique_together': {('locale', 'distribution_bundle')},
+            },
+        ),
+    ]
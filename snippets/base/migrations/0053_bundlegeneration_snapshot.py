@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-17 07:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0052_bundletraffic'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bundlegeneration',
+            name='snapshot',
+            field=models.TextField(blank=True),
+        ),
+    ]
@@ -1,11 +1,12 @@
 import copy
+import hashlib
 import io
 import os
 import re
 import uuid
 import subprocess
 from collections import namedtuple
-from datetime import datetime
+from datetime import datetime, timedelta
 from urllib.parse import urljoin, urlparse
 
 from django.conf import settings
@@ -13,12 +14,13 @@ from django.contrib.admin.models import CHANGE, LogEntry
 from django.contrib.admin.options import get_content_type_for_model
 from django.contrib.postgres.fields import JSONField
 from django.core import validators as django_validators
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.core.files.uploadedfile import InMemoryUploadedFile
 from django.urls import reverse
 from django.db import connection, models
 from django.db.models.manager import Manager
-from django.db.models.signals import post_save
+from django.db.models.signals import m2m_changed, post_save, pre_save
 from django.dispatch import receiver
 from django.template import engines
 from django.template.loader import render_to_string
@@ -393,6 +395,16 @@ class Template(models.Model):
 
         return url
 
+    def get_icons(self):
+        """ Returns a list of the Icons used by the template. """
+        icons = []
+        for field in self._meta.fields:
+            if field.many_to_one and field.related_model is Icon:
+                icon = getattr(self, field.name)
+                if icon:
+                    icons.append(icon)
+        return icons
+
     def get_url_fields(self):
         """ Returns a list of URL field names of the model. """
         fields = []
@@ -1581,6 +1593,7 @@ class Locale(models.Model):
         if self.code[-1] != ',':
             self.code = self.code + ','
         super().save(*args, **kwargs)
+        self.sync_codes()
 
     class Meta:
         ordering = ('name', 'code')
@@ -1588,6 +1601,33 @@ class Locale(models.Model):
     def __str__(self):
         return self.name
 
+    def get_codes(self):
+        return {code for code in self.code.strip(',').split(',') if code}
+
+    def sync_codes(self):
+        """Updates the LocaleCodes of the Locale to match `code`."""
+        codes = self.get_codes()
+        self.codes.exclude(code__in=codes).delete()
+        LocaleCode.objects.bulk_create(
+            [LocaleCode(locale=self, code=code) for code in codes],
+            ignore_conflicts=True,
+        )
+
+
+class LocaleCode(models.Model):
+    """A single code of `Locale.code`, to query Locales with equality lookups
+    instead of substring matches on `Locale.code`.
+
+    """
+    locale = models.ForeignKey(Locale, on_delete=models.CASCADE, related_name='codes')
+    code = models.CharField(max_length=100, db_index=True)
+
+    class Meta:
+        unique_together = ('locale', 'code')
+
+    def __str__(self):
+        return self.code
+
 
 class Job(models.Model):
     DRAFT = 0
@@ -1702,13 +1742,50 @@ class Job(models.Model):
              self.publish_start >= self.publish_end)):
             raise ValidationError('Publish start must come before publish end.')
 
+    def get_render_cache_key(self, always_eval_to_false=False):
+        """Returns a cache key that changes whenever the rendered Job would.
+
+        Besides the Job and ASRSnippet modification dates, the key includes
+        the Targets, Campaign and Icons versions because changes in M2M
+        relations don't update the modification dates, as well as the
+        deployed code revision.
+
+        """
+        targets = sorted(self.targets.all(), key=lambda t: t.id)
+        icons = sorted(self.snippet.template_ng.get_icons(), key=lambda i: i.id)
+        stamps = [
+            settings.GIT_SHA,
+            self.modified.isoformat(),
+            self.snippet.modified.isoformat(),
+            [(target.id, target.modified.isoformat()) for target in targets],
+            (self.campaign.id, self.campaign.modified.isoformat()) if self.campaign else None,
+            [(icon.id, icon.modified.isoformat()) for icon in icons],
+            always_eval_to_false,
+        ]
+        digest = hashlib.sha1(repr(stamps).encode('utf-8')).hexdigest()
+        return 'job-render:{}:{}'.format(self.id, digest)
+
     def render(self, always_eval_to_false=False):
         """Argument always_eval_to_false supports bundle generation for the
         nightly channel where we want all Release snippets to get
         included for the Fx team to monitor JEXL engine performance,
         but we don't want them to actually show. See #1308
 
+        Rendered Jobs are stored in the default cache for
+        JOB_RENDER_CACHE_TIMEOUT seconds. Set it to zero to disable caching.
+
         """
+        if not settings.JOB_RENDER_CACHE_TIMEOUT:
+            return self._render(always_eval_to_false)
+
+        cache_key = self.get_render_cache_key(always_eval_to_false)
+        rendered_snippet = cache.get(cache_key)
+        if rendered_snippet is None:
+            rendered_snippet = self._render(always_eval_to_false)
+            cache.set(cache_key, rendered_snippet, settings.JOB_RENDER_CACHE_TIMEOUT)
+        return rendered_snippet
+
+    def _render(self, always_eval_to_false=False):
         rendered_snippet = self.snippet.render()
 
         rendered_snippet['id'] = str(self.id)
@@ -1747,8 +1824,10 @@ class Job(models.Model):
         if rendered_snippet.get('targeting'):
             targeting.append(rendered_snippet['targeting'])
 
+        # Sort in Python instead of using order_by() so that prefetched
+        # targets don't trigger an extra query.
         targeting.extend([target.jexl_expr for
-                          target in self.targets.all().order_by('id') if
+                          target in sorted(self.targets.all(), key=lambda t: t.id) if
                           target.jexl_expr])
 
         # Make targeting always fail. Used for Nightly debuging.
@@ -2098,6 +2177,34 @@ def update_asrsnippet_modified_date(sender, instance, **kwargs):
     if snippets:
         ASRSnippet.objects.filter(pk__in=snippets).update(modified=now)
 
+    # Mark the bundles of the affected Published Jobs for regeneration. The
+    # saved Job is always included, to catch status changes.
+    if isinstance(instance, ASRSnippet):
+        snippets = [instance.pk]
+
+    jobs = models.Q(snippet__in=snippets or [], status=Job.PUBLISHED)
+    if isinstance(instance, Job):
+        jobs |= models.Q(pk=instance.pk)
+
+    if snippets or isinstance(instance, Job):
+        DirtyBundle.mark(Job.objects.filter(jobs))
+
+
+@receiver(pre_save, dispatch_uid='mark_previous_bundles_dirty')
+def mark_previous_bundles_dirty(sender, instance, **kwargs):
+    """Marks the bundles that a Published Job or ASRSnippet belonged to before
+    saving for regeneration, in case their locale or distribution changes.
+
+    """
+    if kwargs['raw'] or not instance.pk:
+        return
+
+    if isinstance(instance, Job):
+        DirtyBundle.mark(Job.objects.filter(pk=instance.pk, status=Job.PUBLISHED))
+
+    elif isinstance(instance, ASRSnippet):
+        DirtyBundle.mark(Job.objects.filter(snippet=instance.pk, status=Job.PUBLISHED))
+
 
 class Addon(models.Model):
     created = models.DateTimeField(auto_now_add=True)
@@ -2142,6 +2249,191 @@ class DistributionBundle(models.Model):
         super().save(*args, **kwargs)
 
 
+class DirtyBundle(models.Model):
+    """A locale and DistributionBundle combination with changes that have not
+    been written to the bundles yet.
+
+    The locale is a single code from `Locale.code`, e.g. `en`, and gets
+    expanded to all matching product_details locales on bundle generation.
+
+    On PostgreSQL, marking bundles sends a notification on NOTIFY_CHANNEL for
+    the `bundle_daemon` to regenerate them. It gets delivered when the
+    transaction commits.
+
+    """
+    NOTIFY_CHANNEL = 'snippets_dirty_bundles'
+
+    created = models.DateTimeField(auto_now_add=True)
+
+    locale = models.CharField(max_length=100)
+    distribution_bundle = models.ForeignKey(DistributionBundle, on_delete=models.CASCADE,
+                                            related_name='dirty_bundles')
+
+    class Meta:
+        unique_together = ('locale', 'distribution_bundle')
+
+    def __str__(self):
+        return '{} / {}'.format(self.locale, self.distribution_bundle)
+
+    @classmethod
+    def mark(cls, jobs):
+        """Marks the bundles that include the Jobs of the `jobs` queryset as dirty."""
+        dirty_bundles = set()
+        values = jobs.values_list('snippet__locale__codes__code',
+                                  'distribution__distributionbundle')
+        for locale, distribution_bundle_id in values:
+            if not locale or not distribution_bundle_id:
+                continue
+            dirty_bundles.add((locale, distribution_bundle_id))
+
+        cls.objects.bulk_create(
+            [cls(locale=locale, distribution_bundle_id=distribution_bundle_id)
+             for locale, distribution_bundle_id in dirty_bundles],
+            ignore_conflicts=True,
+        )
+        if dirty_bundles:
+            cls.notify()
+
+    @classmethod
+    def notify(cls):
+        if connection.vendor != 'postgresql':
+            return
+        with connection.cursor() as cursor:
+            cursor.execute(f'NOTIFY {cls.NOTIFY_CHANNEL}')
+
+
+@receiver(m2m_changed, sender=DistributionBundle.distributions.through,
+          dispatch_uid='mark_distribution_bundle_dirty')
+def mark_distribution_bundle_dirty(sender, instance, action, reverse, pk_set, **kwargs):
+    """Marks the bundles of the Published Jobs of the Distributions added to
+    or removed from a DistributionBundle for regeneration.
+
+    Distributions get marked after they are added and before they are
+    removed, while their Jobs belong to the DistributionBundle.
+
+    """
+    if action not in ('post_add', 'pre_remove', 'pre_clear'):
+        return
+
+    if reverse:
+        distributions = [instance.pk]
+    elif action == 'pre_clear':
+        distributions = instance.distributions.all()
+    else:
+        distributions = pk_set
+    DirtyBundle.mark(Job.objects.filter(distribution__in=distributions, status=Job.PUBLISHED))
+
+
+class BundleTraffic(models.Model):
+    """Number of requests of a bundle over a recent period, e.g. from the CDN
+    logs loaded with `update_bundle_traffic`, to generate the bundles with the most
+    traffic first.
+
+    The locale is a product_details locale, e.g. `en-us`.
+
+    """
+    modified = models.DateTimeField(auto_now=True)
+
+    locale = models.CharField(max_length=100)
+    distribution_bundle = models.ForeignKey(DistributionBundle, on_delete=models.CASCADE,
+                                            related_name='+')
+    requests = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('locale', 'distribution_bundle')
+
+    def __str__(self):
+        return '{} / {}'.format(self.locale, self.distribution_bundle_id)
+
+
+class BundleGeneration(models.Model):
+    """A bundle generation split into BundleWorkUnits for workers on any
+    node to process.
+
+    """
+    created = models.DateTimeField(auto_now_add=True)
+    # Prefix the bundle files get uploaded under, empty to upload in place.
+    staging = models.CharField(max_length=255, blank=True)
+    # JSON encoded exported snapshot of `bundles.bundle_snapshot` to generate
+    # the bundles from.
+    snapshot = models.TextField(blank=True)
+
+    def __str__(self):
+        return 'Bundle generation {}'.format(self.id)
+
+
+class BundleWorkUnit(models.Model):
+    """A locale and DistributionBundle combination of a BundleGeneration.
+
+    Workers lease units until `lease_expires`. Units of workers that crashed
+    get leased again once their lease expires.
+
+    """
+    generation = models.ForeignKey(BundleGeneration, on_delete=models.CASCADE,
+                                   related_name='units')
+    locale = models.CharField(max_length=100)
+    distribution_bundle = models.ForeignKey(DistributionBundle, on_delete=models.CASCADE,
+                                            related_name='+')
+
+    owner = models.CharField(max_length=255, blank=True)
+    lease_expires = models.DateTimeField(null=True, blank=True, db_index=True)
+    attempts = models.PositiveIntegerField(default=0)
+    done = models.BooleanField(default=False, db_index=True)
+    # JSON encoded summary of the written bundles.
+    result = models.TextField(blank=True)
+    error = models.TextField(blank=True)
+
+    class Meta:
+        unique_together = ('generation', 'locale', 'distribution_bundle')
+
+    def __str__(self):
+        return '{} / {}'.format(self.locale, self.distribution_bundle_id)
+
+
+class BundleRun(models.Model):
+    """A bundle generation, promotion or rollback that changed bundles."""
+    created = models.DateTimeField(auto_now_add=True)
+    git_sha = models.CharField(max_length=100, blank=True)
+    rollback_to = models.ForeignKey('self', null=True, blank=True, on_delete=models.SET_NULL,
+                                    related_name='+')
+
+    class Meta:
+        ordering = ('-id',)
+
+    def __str__(self):
+        return 'Bundle run {}'.format(self.id)
+
+    @staticmethod
+    def get_history_start():
+        """Returns the time from which runs are kept, see BUNDLE_HISTORY_DAYS.
+
+        Bundles can only be rolled back to runs after it, as the history of
+        earlier runs is partially pruned.
+
+        """
+        return timezone.now() - timedelta(days=settings.BUNDLE_HISTORY_DAYS)
+
+
+class BundleHistory(models.Model):
+    """A bundle written or removed in a BundleRun.
+
+    The content of written bundles is stored under `content_hash` in the
+    content-addressed area of the bundle storage. Removed bundles have an
+    empty `content_hash`.
+
+    """
+    run = models.ForeignKey(BundleRun, on_delete=models.CASCADE, related_name='bundles')
+    path = models.CharField(max_length=255, db_index=True)
+    content_hash = models.CharField(max_length=64, blank=True)
+
+    class Meta:
+        unique_together = ('run', 'path')
+        verbose_name_plural = 'bundle history'
+
+    def __str__(self):
+        return '{}: {}'.format(self.path, self.content_hash or 'removed')
+
+
 class JobDailyPerformance(models.Model):
     IMPRESSION_THRESHOLD_SECONDS = 5
     # Percentage of sessions out of total sessions that stayed on about:home or
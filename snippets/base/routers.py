@@ -0,0 +1,51 @@
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+
+# The database alias and the info of the bundle snapshot in progress, see
+# `snippets.base.bundles.bundle_snapshot`.
+current_snapshot = ContextVar('current_snapshot', default=None)
+
+
+class BundleSnapshotRouter:
+    """Routes reads to the database of the bundle snapshot in progress.
+
+    The bookkeeping models of bundle generation are left out, as they must
+    always be read from and written to the default database.
+
+    """
+    EXCLUDED_MODELS = {
+        'dirtybundle',
+        'bundlegeneration',
+        'bundleworkunit',
+        'bundlerun',
+        'bundlehistory',
+        'bundletraffic',
+    }
+
+    def db_for_read(self, model, **hints):
+        snapshot = current_snapshot.get()
+        if snapshot and model._meta.model_name not in self.EXCLUDED_MODELS:
+            alias, info = snapshot
+            return alias
+        return None
+
+    def db_for_write(self, model, **hints):
+        # Objects read from the snapshot get saved to the default database.
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db == settings.BUNDLE_DATABASE_ALIAS:
+            return DEFAULT_DB_ALIAS
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        aliases = {DEFAULT_DB_ALIAS, settings.BUNDLE_DATABASE_ALIAS}
+        if obj1._state.db in aliases and obj2._state.db in aliases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db == settings.BUNDLE_DATABASE_ALIAS:
+            return False
+        return None
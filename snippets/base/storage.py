@@ -1,15 +1,27 @@
+import os
+import posixpath
+import shutil
+
 from django.conf import settings
+from django.core.files.base import ContentFile
 from django.core.files.storage import FileSystemStorage
 from django.utils.deconstruct import deconstructible
 
+from botocore.exceptions import ClientError
 from storages.backends.s3boto3 import S3Boto3Storage
 
 
+CONTENT_HASH_SUFFIX = '.sha256'
+
+
 # TODO
 class OverwriteStorage(FileSystemStorage):
     """
     Comes from http://www.djangosnippets.org/snippets/976/
     See also Django #4339, which might add this functionality to core.
+
+    Files saved with a `content_hash` attribute get the hash stored in a
+    sidecar file next to them.
     """
 
     def get_available_name(self, name, max_length=None):
@@ -21,9 +33,71 @@ class OverwriteStorage(FileSystemStorage):
             self.delete(name)
         return name
 
+    def _save(self, name, content):
+        name = super()._save(name, content)
+        content_hash = getattr(content, 'content_hash', None)
+        if content_hash:
+            hash_name = name + CONTENT_HASH_SUFFIX
+            if self.exists(hash_name):
+                super().delete(hash_name)
+            super()._save(hash_name, ContentFile(content_hash.encode('utf-8')))
+        return name
+
+    def delete(self, name):
+        super().delete(name)
+        if not name.endswith(CONTENT_HASH_SUFFIX):
+            super().delete(name + CONTENT_HASH_SUFFIX)
+
+    def list_files(self, prefix):
+        """Returns the set of names of all files under the `prefix`
+        directory, content hash files included.
+
+        """
+        names = set()
+        for root, directories, files in os.walk(self.path(prefix)):
+            root = os.path.relpath(root, self.location)
+            names.update(os.path.join(root, name) for name in files)
+        return names
+
+    def delete_many(self, names):
+        """Deletes `names`, ignoring the ones that don't exist."""
+        for name in names:
+            self.delete(name)
+
+    def _transfer(self, transfer, name, target):
+        target_path = self.path(target)
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        transfer(self.path(name), target_path)
+        if self.exists(name + CONTENT_HASH_SUFFIX):
+            transfer(self.path(name + CONTENT_HASH_SUFFIX),
+                     self.path(target + CONTENT_HASH_SUFFIX))
+        else:
+            super().delete(target + CONTENT_HASH_SUFFIX)
+
+    def move(self, name, target):
+        """Moves `name` and its content hash to `target`, replacing it.
+
+        Each file gets replaced atomically with a rename.
+        """
+        self._transfer(os.replace, name, target)
+
+    def copy(self, name, target):
+        """Copies `name` and its content hash to `target`, replacing it."""
+        self._transfer(shutil.copyfile, name, target)
+
+    def get_content_hash(self, name):
+        """Returns the content hash stored when saving `name` or None."""
+        try:
+            with self.open(name + CONTENT_HASH_SUFFIX) as fp:
+                return fp.read().decode('utf-8')
+        except FileNotFoundError:
+            return None
+
 
 @deconstructible
 class S3Storage(S3Boto3Storage):
+    # The maximum number of keys of a DeleteObjects request.
+    DELETE_BATCH_SIZE = 1000
     cache_control_headers = getattr(settings, 'AWS_CACHE_CONTROL_HEADERS', {})
 
     def _get_write_parameters(self, name, content):
@@ -32,8 +106,77 @@ class S3Storage(S3Boto3Storage):
         if encoding:
             params['ContentEncoding'] = encoding
 
+        content_hash = getattr(content, 'content_hash', None)
+        if content_hash:
+            params.setdefault('Metadata', {})['content-hash'] = content_hash
+
         for filename_start, value in self.cache_control_headers.items():
             if name.startswith(filename_start):
                 params['CacheControl'] = value
 
         return params
+
+    def list_files(self, prefix):
+        """Returns the set of names of all objects under `prefix`, listed
+        1000 at a time.
+
+        """
+        prefix = self._clean_name(prefix).rstrip('/')
+        path = self._normalize_name(prefix)
+        if path and not path.endswith('/'):
+            path += '/'
+
+        names = set()
+        paginator = self.connection.meta.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=path):
+            for entry in page.get('Contents', ()):
+                names.add(posixpath.join(prefix, posixpath.relpath(entry['Key'], path)))
+        return names
+
+    def delete_many(self, names):
+        """Deletes `names` in batches of DELETE_BATCH_SIZE objects."""
+        keys = [self._normalize_name(self._clean_name(name)) for name in names]
+        for i in range(0, len(keys), self.DELETE_BATCH_SIZE):
+            response = self.connection.meta.client.delete_objects(
+                Bucket=self.bucket_name,
+                Delete={
+                    'Objects': [{'Key': key} for key in keys[i:i + self.DELETE_BATCH_SIZE]],
+                    'Quiet': True,
+                },
+            )
+            errors = response.get('Errors')
+            if errors:
+                raise IOError('Could not delete {} objects: {}'.format(
+                    len(errors), ', '.join(error['Key'] for error in errors)))
+
+    def copy(self, name, target):
+        """Copies `name` to `target` with a server side copy, which keeps the
+        headers and metadata of `name`.
+
+        """
+        source = self._normalize_name(self._clean_name(name))
+        self.connection.meta.client.copy_object(
+            Bucket=self.bucket_name,
+            Key=self._normalize_name(self._clean_name(target)),
+            CopySource={'Bucket': self.bucket_name, 'Key': source},
+        )
+
+    def move(self, name, target):
+        """Moves `name` to `target` with a server side copy, which keeps the
+        headers and metadata of `name`.
+
+        """
+        self.copy(name, target)
+        self.delete(name)
+
+    def get_content_hash(self, name):
+        """Returns the content hash stored in the object metadata of `name`
+        or None.
+
+        """
+        name = self._normalize_name(self._clean_name(name))
+        try:
+            response = self.connection.meta.client.head_object(Bucket=self.bucket_name, Key=name)
+        except ClientError:
+            return None
+        return response.get('Metadata', {}).get('content-hash')
@@ -80,6 +80,76 @@ class SimpleTemplateFactory(factory.django.DjangoModelFactory):
         model = models.SimpleTemplate
 
 
+class SimpleBelowSearchTemplateFactory(factory.django.DjangoModelFactory):
+    text = 'This is the main text with a <a href="https://example.com">link</a>.'
+    icon = factory.SubFactory(IconFactory)
+
+    class Meta:
+        model = models.SimpleBelowSearchTemplate
+
+
+class FundraisingTemplateFactory(factory.django.DjangoModelFactory):
+    text = 'This is the main text with a <a href="https://example.com">link</a>.'
+    icon = factory.SubFactory(IconFactory)
+    button_label = 'Donate'
+    donation_amount_first = 50
+    donation_amount_second = 25
+    donation_amount_third = 10
+    donation_amount_fourth = 3
+
+    class Meta:
+        model = models.FundraisingTemplate
+
+
+class FxASignupTemplateFactory(factory.django.DjangoModelFactory):
+    scene1_text = 'This is the main text with a <a href="https://example.com">link</a>.'
+    scene1_icon = factory.SubFactory(IconFactory)
+    scene2_text = 'Sign in to Firefox.'
+
+    class Meta:
+        model = models.FxASignupTemplate
+
+
+class NewsletterTemplateFactory(factory.django.DjangoModelFactory):
+    scene1_text = 'This is the main text with a <a href="https://example.com">link</a>.'
+    scene1_icon = factory.SubFactory(IconFactory)
+    scene2_text = 'Sign up for the newsletter.'
+    scene2_privacy_html = 'I’m okay with Mozilla handling my info.'
+    success_text = 'Check your inbox.'
+    error_text = 'Something went wrong.'
+
+    class Meta:
+        model = models.NewsletterTemplate
+
+
+class SendToDeviceTemplateFactory(factory.django.DjangoModelFactory):
+    scene1_text = 'This is the main text with a <a href="https://example.com">link</a>.'
+    scene1_icon = factory.SubFactory(IconFactory)
+    scene2_text = 'Send Firefox to your phone.'
+    scene2_icon = factory.SelfAttribute('scene1_icon')
+    scene2_disclaimer_html = 'The intended recipient must agree.'
+    message_id_email = 'download-firefox-mobile'
+    success_title = 'Your download link was sent.'
+    success_text = 'Check your device.'
+    error_text = 'Something went wrong.'
+
+    class Meta:
+        model = models.SendToDeviceTemplate
+
+
+class SendToDeviceSingleSceneTemplateFactory(factory.django.DjangoModelFactory):
+    text = 'This is the main text with a <a href="https://example.com">link</a>.'
+    icon = factory.SubFactory(IconFactory)
+    disclaimer_html = 'The intended recipient must agree.'
+    message_id_email = 'download-firefox-mobile'
+    success_title = 'Your download link was sent.'
+    success_text = 'Check your device.'
+    error_text = 'Something went wrong.'
+
+    class Meta:
+        model = models.SendToDeviceSingleSceneTemplate
+
+
 class ASRSnippetFactory(factory.django.DjangoModelFactory):
     creator = factory.SubFactory(UserFactory)
     name = factory.Sequence(lambda n: 'ASRSnippet {0}'.format(n))
@@ -3,9 +3,10 @@ from django.test.client import RequestFactory
 
 from unittest.mock import DEFAULT as DEFAULT_MOCK, Mock, patch
 
-from snippets.base.admin.adminmodels import ASRSnippetAdmin, JobAdmin
-from snippets.base.models import STATUS_CHOICES, ASRSnippet, Job
-from snippets.base.tests import (ASRSnippetFactory, JobFactory,
+from snippets.base.admin.adminmodels import ASRSnippetAdmin, JobAdmin, LocaleAdmin
+from snippets.base.locales import LocaleIndex
+from snippets.base.models import STATUS_CHOICES, ASRSnippet, Job, Locale
+from snippets.base.tests import (ASRSnippetFactory, JobFactory, LocaleFactory,
                                  TestCase, UserFactory)
 
 
@@ -148,3 +149,12 @@ class JobAdminTests(TestCase):
         )
         self.assertTrue(message_mocks['warning'].called)
         self.assertTrue(message_mocks['success'].called)
+
+
+class LocaleAdminTests(TestCase):
+    def test_bundle_locales(self):
+        locale = LocaleFactory(code=',es-mx,es-ar,')
+        admin = LocaleAdmin(Locale, AdminSite())
+        with patch('snippets.base.admin.adminmodels.get_locale_index') as get_locale_index_mock:
+            get_locale_index_mock.return_value = LocaleIndex(['es-AR', 'es-ES', 'es-MX'])
+            self.assertEqual(admin.bundle_locales(locale), 'es-ar, es-mx')
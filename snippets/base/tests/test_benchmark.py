@@ -0,0 +1,26 @@
+from django.conf import settings
+
+from snippets.base import models
+from snippets.base.benchmark import TEMPLATE_FACTORIES, run_benchmark
+from snippets.base.tests import TestCase
+
+
+class BenchmarkTests(TestCase):
+    databases = {'default', settings.BUNDLE_DATABASE_ALIAS}
+
+    def test_run_benchmark(self):
+        results = run_benchmark(jobs=7, locales=2, distribution_bundles=2, changed_jobs=1)
+
+        self.assertEqual(models.Job.objects.filter(status=models.Job.PUBLISHED).count(), 7)
+        template_types = {
+            job.snippet.template_ng._meta.model_name for job in models.Job.objects.all()
+        }
+        self.assertEqual(len(template_types), len(TEMPLATE_FACTORIES))
+
+        self.assertEqual(set(results['runs'].keys()), {'full', 'full_unchanged', 'incremental'})
+        self.assertEqual(results['runs']['full']['bundles_written'], 4)
+        self.assertEqual(results['runs']['full_unchanged']['bundles_unchanged'], 4)
+        self.assertEqual(results['runs']['incremental']['bundles_written'], 1)
+        for run in results['runs'].values():
+            self.assertGreater(run['queries'], 0)
+            self.assertGreater(run['peak_memory'], 0)
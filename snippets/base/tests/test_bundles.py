@@ -1,22 +1,66 @@
+import gzip
+import itertools
 import json
+import tempfile
+from datetime import datetime, timedelta
+from io import StringIO
+from unittest import skipUnless
 from unittest.mock import ANY, DEFAULT, Mock, call, patch
 
+import brotli
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import connection, connections, transaction
 from django.db.models import Q
-from django.test.utils import override_settings
+from django.test.utils import CaptureQueriesContext, override_settings
 
-from snippets.base.bundles import generate_bundles
-from snippets.base.models import Distribution, DistributionBundle, Job
+from snippets.base import bundles
+
+from snippets.base.bundles import (BundlePlanner, BundleSizeBudgetExceeded, BundleStats,
+                                   BundleWorkUnitFailed, _claim_work_units, _elide_defaults,
+                                   _encode_bundle, _get_traffic_weights,
+                                   _promote_prestaged_bundles, _publish_staged_bundles,
+                                   bundle_snapshot, generate_bundles, get_bundle_file_encoding,
+                                   get_encoding_sizes, get_prestaged_boundaries,
+                                   get_publish_boundaries, get_size_report, load_manifest,
+                                   prestage_bundles, promote_prestaged_bundles, rollback_bundles,
+                                   run_bundle_daemon, update_bundle_traffic)
+from snippets.base.locales import LocaleIndex
+from snippets.base.models import (BundleGeneration, BundleRun, BundleTraffic, BundleWorkUnit,
+                                  Distribution, DirtyBundle, DistributionBundle, Job)
+from snippets.base.routers import current_snapshot
+from snippets.base.storage import OverwriteStorage
 from snippets.base.tests import (DistributionBundleFactory, DistributionFactory,
                                  JobFactory, TargetFactory, TestCase)
 
 
 class GenerateBundlesTests(TestCase):
+    databases = {'default', settings.BUNDLE_DATABASE_ALIAS}
+
     def setUp(self):
         self.distribution = DistributionFactory.create(name='Default')
         self.distribution_bundle = DistributionBundleFactory.create(name='Default',
                                                                     code_name='default')
         self.distribution_bundle.distributions.add(self.distribution)
 
+    def get_storage(self):
+        """Returns an OverwriteStorage in a temporary directory that gets
+        removed after the test.
+
+        """
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        return OverwriteStorage(location=directory.name)
+
+    def patch_bundles(self, storage, locales):
+        """Patches the storage of snippets.base.bundles with `storage` and its
+        locale index with an index of `locales`.
+
+        """
+        return patch.multiple('snippets.base.bundles',
+                              get_locale_index=Mock(return_value=LocaleIndex(locales)),
+                              default_storage=storage)
+
     def test_generate_all(self):
         with patch('snippets.base.bundles.models.Job') as job_mock:
             job_mock.objects.all.return_value = Job.objects.none()
@@ -34,7 +78,7 @@ class GenerateBundlesTests(TestCase):
             Q(distribution__distributionbundle__modified__gte='2019-01-01')
         )
 
-    @override_settings(MEDIA_BUNDLES_PREGEN_ROOT='pregen')
+    @override_settings(MEDIA_BUNDLES_PREGEN_ROOT='pregen', BUNDLE_STAGED_PUBLISH=False)
     def test_generation(self):
         target = TargetFactory(channels='release;beta')
         # Draft, completed, scheduled or cancelled
@@ -85,17 +129,20 @@ class GenerateBundlesTests(TestCase):
 
         with patch.multiple('snippets.base.bundles',
                             json=DEFAULT,
-                            product_details=DEFAULT,
+                            get_locale_index=DEFAULT,
                             default_storage=DEFAULT) as mock:
             mock['json'].dumps.return_value = ''
-            mock['product_details'].languages.keys.return_value = ['fr', 'en-us', 'en-au']
+            mock['get_locale_index'].return_value = LocaleIndex(['fr', 'en-us', 'en-au'])
+            mock['default_storage'].exists.return_value = False
             generate_bundles(stdout=Mock())
 
-        self.assertEqual(mock['default_storage'].save.call_count, 2)
+        # Two bundles and the manifest.
+        self.assertEqual(mock['default_storage'].save.call_count, 3)
 
         mock['default_storage'].save.assert_has_calls([
             call('pregen/Firefox/en-us/default.json', ANY),
             call('pregen/Firefox/en-au/default.json', ANY),
+            call('pregen/manifest.json', ANY),
         ], any_order=True)
 
         # Check that there's only one job included in the bundle and that it's
@@ -147,16 +194,36 @@ class GenerateBundlesTests(TestCase):
             distribution=distribution,
         )
 
-        with patch('snippets.base.bundles.default_storage') as ds_mock:
+        with patch.multiple('snippets.base.bundles',
+                            default_storage=DEFAULT,
+                            load_manifest=DEFAULT) as mock:
+            ds_mock = mock['default_storage']
+            mock['load_manifest'].return_value = {
+                'bundles': {
+                    'Firefox/fr/default.json': {},
+                    'Firefox/fr/foo.json': {},
+                    'Firefox/de/default.json': {},
+                }
+            }
             # Test that only removes if file exists.
-            ds_mock.exists.return_value = True
+            ds_mock.list_files.return_value = {
+                'pregen/Firefox/fr/default.json',
+                'pregen/Firefox/fr/foo.json',
+                'pregen/Firefox/de/default.json',
+            }
             generate_bundles(stdout=Mock())
 
-        ds_mock.delete.assert_has_calls([
-            call('pregen/Firefox/fr/default.json'),
-            call('pregen/Firefox/fr/foo.json')
+        ds_mock.list_files.assert_called_once_with('pregen')
+        ds_mock.exists.assert_not_called()
+        # Bundles no Job is for anymore get deleted too.
+        self.assertEqual(ds_mock.delete_many.call_args_list, [
+            call(['pregen/Firefox/fr/default.json', 'pregen/Firefox/fr/foo.json']),
+            call(['pregen/Firefox/de/default.json']),
         ])
-        ds_mock.save.assert_not_called()
+        # Only the manifest gets saved, without the removed bundles.
+        ds_mock.save.assert_called_once_with('pregen/manifest.json', ANY)
+        manifest = json.loads(ds_mock.save.call_args[0][1].read())
+        self.assertEqual(manifest['bundles'], {})
 
     def test_delete_does_not_exist(self):
         target = TargetFactory(channels='nightly')
@@ -169,10 +236,56 @@ class GenerateBundlesTests(TestCase):
         with patch('snippets.base.bundles.default_storage') as ds_mock:
             # Test that only removes if file exists.
             ds_mock.exists.return_value = False
+            ds_mock.list_files.return_value = set()
             generate_bundles(stdout=Mock())
 
         ds_mock.delete.assert_not_called()
-        ds_mock.save.assert_not_called()
+        ds_mock.delete_many.assert_not_called()
+        # Only the manifest gets saved.
+        ds_mock.save.assert_called_once_with('bundles-pregen/manifest.json', ANY)
+
+    @override_settings(MEDIA_BUNDLES_PREGEN_ROOT='pregen', BUNDLE_STAGED_PUBLISH=False)
+    def test_delete_without_listing(self):
+        target = TargetFactory(channels='nightly')
+        JobFactory(
+            status=Job.COMPLETED,
+            snippet__locale=',fr,',
+            targets=[target],
+        )
+
+        with patch('snippets.base.bundles.default_storage') as ds_mock:
+            del ds_mock.list_files
+            del ds_mock.delete_many
+            ds_mock.exists.side_effect = lambda name: name == 'pregen/Firefox/fr/default.json'
+            generate_bundles(stdout=Mock())
+
+        ds_mock.delete.assert_called_once_with('pregen/Firefox/fr/default.json')
+
+    @override_settings(MEDIA_BUNDLES_PREGEN_ROOT='pregen')
+    def test_delete_orphaned(self):
+        JobFactory(status=Job.PUBLISHED, snippet__locale=',el,')
+        fr_job = JobFactory(status=Job.PUBLISHED, snippet__locale=',fr,')
+        storage = self.get_storage()
+
+        with self.patch_bundles(storage, ['el', 'fr']):
+            generate_bundles(stdout=Mock())
+            storage.save('pregen/Firefox/xx/default.json', ContentFile(b'{}'))
+            storage.save('pregen/Firefox/el/default.json.br', ContentFile(b'{}'))
+            fr_job.delete()
+
+            # Partial generations don't plan all the bundles.
+            generate_bundles(limit_to_locale='el', stdout=Mock())
+            self.assertTrue(storage.exists('pregen/Firefox/xx/default.json'))
+
+            summary = generate_bundles(stdout=Mock())
+
+        self.assertEqual(summary['removed'], ['pregen/Firefox/fr/default.json'])
+        self.assertNotIn('Firefox/fr/default.json', load_manifest()['bundles'])
+        self.assertEqual(storage.list_files('pregen/Firefox'), {
+            'pregen/Firefox/el/default.json',
+            'pregen/Firefox/el/default.json.sha256',
+        })
+        self.assertTrue(storage.exists('pregen/manifest.json'))
 
     def test_limit_to_locale_dist(self):
         job = JobFactory(
@@ -206,3 +319,1054 @@ class GenerateBundlesTests(TestCase):
         self.assertEqual(result['metadata']['number_of_snippets'], 0)
         self.assertEqual(result['metadata']['locale'], 'el')
         self.assertEqual(result['metadata']['distribution_bundle'], 'default')
+
+    @override_settings(MEDIA_BUNDLES_PREGEN_ROOT='pregen')
+    def test_render_each_job_once(self):
+        job = JobFactory(
+            status=Job.PUBLISHED,
+            snippet__locale=',en,fr,',
+        )
+
+        with patch.multiple('snippets.base.bundles',
+                            get_locale_index=DEFAULT,
+                            default_storage=DEFAULT) as mock:
+            mock['get_locale_index'].return_value = LocaleIndex([
+                'fr', 'en-US', 'en-GB', 'en-CA',
+            ])
+            mock['default_storage'].exists.return_value = False
+            with patch.object(Job, 'render', autospec=True, return_value={}) as render_mock:
+                generate_bundles(stdout=Mock())
+
+        self.assertEqual(mock['default_storage'].save.call_count, 5)
+        render_mock.assert_called_once_with(job)
+
+    @override_settings(MEDIA_BUNDLES_PREGEN_ROOT='pregen')
+    def test_workers(self):
+        shards = []
+
+        class InlineExecutor:
+            def __init__(self, max_workers, mp_context, initializer):
+                pass
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                pass
+
+            def map(self, fn, *iterables):
+                shards.extend(zip(*iterables))
+                return [fn(*shard) for shard in shards]
+
+        JobFactory(status=Job.PUBLISHED, snippet__locale=',en,')
+
+        with patch.multiple('snippets.base.bundles',
+                            get_locale_index=DEFAULT,
+                            default_storage=DEFAULT,
+                            ProcessPoolExecutor=DEFAULT) as mock:
+            mock['ProcessPoolExecutor'].side_effect = InlineExecutor
+            mock['get_locale_index'].return_value = LocaleIndex(['en-US', 'en-GB', 'en-CA'])
+            mock['default_storage'].exists.return_value = False
+            summary = generate_bundles(stdout=Mock(), workers=2)
+
+        self.assertEqual(len(shards), 2)
+        self.assertEqual(mock['default_storage'].save.call_count, 4)
+        self.assertEqual(
+            set(summary['written']),
+            {'pregen/Firefox/en-us/default.json',
+             'pregen/Firefox/en-gb/default.json',
+             'pregen/Firefox/en-ca/default.json'}
+        )
+
+    @override_settings(MEDIA_BUNDLES_PREGEN_ROOT='pregen')
+    def test_skip_unchanged(self):
+        JobFactory(status=Job.PUBLISHED, snippet__locale=',el,')
+        storage = self.get_storage()
+
+        with self.patch_bundles(storage, ['el']):
+            summary = generate_bundles(stdout=Mock())
+            self.assertEqual(summary['written'], ['pregen/Firefox/el/default.json'])
+
+            # Generating again at a different time doesn't write the bundle.
+            with patch('snippets.base.bundles.datetime') as datetime_mock:
+                datetime_mock.utcnow.return_value = datetime(2050, 1, 1)
+                summary = generate_bundles(stdout=Mock())
+            self.assertEqual(summary['written'], [])
+            self.assertEqual(summary['unchanged'], ['pregen/Firefox/el/default.json'])
+            # Neither the manifest.
+            self.assertNotEqual(load_manifest()['generated_at'], '2050-01-01T00:00:00')
+
+            # Bundles missing from the storage get written again.
+            storage.delete('pregen/Firefox/el/default.json')
+            summary = generate_bundles(stdout=Mock())
+            self.assertEqual(summary['written'], ['pregen/Firefox/el/default.json'])
+
+            # Without a manifest the hash stored with the bundle is used.
+            storage.delete('pregen/manifest.json')
+            summary = generate_bundles(stdout=Mock())
+            self.assertEqual(summary['unchanged'], ['pregen/Firefox/el/default.json'])
+
+            # A new Job changes the bundle.
+            JobFactory(status=Job.PUBLISHED, snippet__locale=',el,')
+            summary = generate_bundles(stdout=Mock())
+            self.assertEqual(summary['written'], ['pregen/Firefox/el/default.json'])
+
+    @override_settings(MEDIA_BUNDLES_PREGEN_ROOT='pregen')
+    def test_manifest(self):
+        job = JobFactory(status=Job.PUBLISHED, snippet__locale=',el,')
+        storage = self.get_storage()
+
+        with self.patch_bundles(storage, ['el', 'fr']):
+            generate_bundles(stdout=Mock())
+            manifest = load_manifest()
+
+            self.assertEqual(list(manifest['bundles'].keys()), ['Firefox/el/default.json'])
+            entry = manifest['bundles']['Firefox/el/default.json']
+            self.assertEqual(entry['locale'], 'el')
+            self.assertEqual(entry['distribution_bundle'], 'default')
+            self.assertEqual(entry['number_of_snippets'], 1)
+            self.assertEqual(entry['size'], storage.size('pregen/Firefox/el/default.json'))
+            self.assertEqual(entry['compressed_size'], entry['size'])
+            self.assertEqual(entry['content_hash'],
+                             storage.get_content_hash('pregen/Firefox/el/default.json'))
+
+            # Incremental runs keep the bundles they don't process.
+            JobFactory(status=Job.PUBLISHED, snippet__locale=',fr,')
+            generate_bundles(timestamp=datetime.utcnow() - timedelta(seconds=1), stdout=Mock())
+            manifest = load_manifest()
+            self.assertEqual(set(manifest['bundles'].keys()),
+                             {'Firefox/el/default.json', 'Firefox/fr/default.json'})
+
+            # Removed bundles get removed from the manifest.
+            job.change_status(Job.COMPLETED, send_slack=False)
+            generate_bundles(stdout=Mock())
+            manifest = load_manifest()
+            self.assertEqual(list(manifest['bundles'].keys()), ['Firefox/fr/default.json'])
+
+    @override_settings(MEDIA_BUNDLES_PREGEN_ROOT='pregen', GIT_SHA='abc')
+    def test_dirty(self):
+        JobFactory(status=Job.PUBLISHED, snippet__locale=',el,')
+        JobFactory(status=Job.PUBLISHED, snippet__locale=',fr,')
+        storage = self.get_storage()
+
+        with self.patch_bundles(storage, ['el', 'fr']):
+            # Without a full generation for this code revision, everything
+            # gets generated.
+            summary = generate_bundles(dirty=True, stdout=Mock())
+            self.assertEqual(len(summary['written']), 2)
+            self.assertFalse(DirtyBundle.objects.exists())
+            self.assertEqual(load_manifest()['git_sha'], 'abc')
+
+            summary = generate_bundles(dirty=True, stdout=Mock())
+            self.assertEqual(summary['written'] + summary['unchanged'], [])
+
+            JobFactory(status=Job.PUBLISHED, snippet__locale=',el,')
+            summary = generate_bundles(dirty=True, stdout=Mock())
+            self.assertEqual(summary['written'], ['pregen/Firefox/el/default.json'])
+            self.assertFalse(DirtyBundle.objects.exists())
+
+            # Dirty bundles are kept when generation fails.
+            JobFactory(status=Job.PUBLISHED, snippet__locale=',fr,')
+            with patch('snippets.base.bundles._write_bundles', side_effect=Exception):
+                self.assertRaises(Exception, generate_bundles, dirty=True, stdout=Mock())
+            self.assertEqual(
+                list(DirtyBundle.objects.values_list('locale', flat=True)), ['fr']
+            )
+
+    @override_settings(MEDIA_BUNDLES_PREGEN_ROOT='pregen', BUNDLE_COMPACT_ENCODING=True)
+    def test_compact_encoding(self):
+        job = JobFactory(status=Job.PUBLISHED, snippet__locale=',el,')
+        storage = self.get_storage()
+
+        with self.patch_bundles(storage, ['el']):
+            generate_bundles(stdout=Mock())
+
+        with storage.open('pregen/Firefox/el/default.json') as fp:
+            bundle_content = fp.read()
+
+        self.assertNotIn(b'", "', bundle_content)
+        message = json.loads(bundle_content)['messages'][0]
+        self.assertEqual(message['id'], str(job.id))
+        self.assertNotIn('do_not_autoblock', message['content'])
+        self.assertNotIn('tall', message['content'])
+        self.assertEqual(message['content']['block_button_text'], 'Remove this')
+
+    @override_settings(MEDIA_BUNDLES_PREGEN_ROOT='pregen',
+                       BUNDLE_ENCODINGS=['br', 'gzip', 'identity'])
+    def test_encoding_variants(self):
+        job = JobFactory(status=Job.PUBLISHED, snippet__locale=',el,')
+        storage = self.get_storage()
+        stdout = StringIO()
+
+        with self.patch_bundles(storage, ['el']):
+            summary = generate_bundles(stdout=stdout)
+            manifest = load_manifest()
+
+            with storage.open('pregen/Firefox/el/default.json') as fp:
+                brotli_content = fp.read()
+            with storage.open('pregen/Firefox/el/default.json.gz') as fp:
+                gzip_content = fp.read()
+            with storage.open('pregen/Firefox/el/default.json.raw') as fp:
+                content = fp.read()
+
+            self.assertEqual(brotli.decompress(brotli_content), content)
+            self.assertEqual(gzip.decompress(gzip_content), content)
+            self.assertEqual(json.loads(content)['messages'][0]['id'], str(job.id))
+
+            entry = manifest['bundles']['Firefox/el/default.json']
+            self.assertEqual(entry['compressed_size'], len(brotli_content))
+            self.assertEqual(entry['variants'], {
+                'br': len(brotli_content),
+                'gzip': len(gzip_content),
+                'identity': len(content),
+            })
+            self.assertEqual(set(summary['compression'].keys()), {'br', 'gzip', 'identity'})
+            self.assertEqual(summary['compression']['gzip']['size'], len(gzip_content))
+            self.assertIn('Compression br:', stdout.getvalue())
+
+            # Variants get removed with the bundle.
+            job.change_status(Job.COMPLETED, send_slack=False)
+            generate_bundles(stdout=Mock())
+            self.assertFalse(storage.exists('pregen/Firefox/el/default.json'))
+            self.assertFalse(storage.exists('pregen/Firefox/el/default.json.gz'))
+            self.assertFalse(storage.exists('pregen/Firefox/el/default.json.raw'))
+
+    @override_settings(MEDIA_BUNDLES_PREGEN_ROOT='pregen',
+                       BUNDLE_ENCODINGS=['br', 'gzip', 'identity'])
+    def test_streaming(self):
+        JobFactory(status=Job.PUBLISHED, snippet__locale=',el,')
+        JobFactory(status=Job.PUBLISHED, snippet__locale=',el,fr,')
+        JobFactory(status=Job.PUBLISHED, snippet__locale=',el-gr,')
+        storage = self.get_storage()
+
+        def get_bundles():
+            bundles = {}
+            for filename, decompress in [('default.json', brotli.decompress),
+                                         ('default.json.gz', gzip.decompress),
+                                         ('default.json.raw', lambda content: content)]:
+                with storage.open(f'pregen/Firefox/el-gr/{filename}') as fp:
+                    bundle = json.loads(decompress(fp.read()))
+                bundle['metadata'].pop('generated_at')
+                bundles[filename] = bundle
+            return bundles
+
+        def get_content():
+            with storage.open('pregen/Firefox/el-gr/default.json.raw') as fp:
+                content = fp.read()
+            generated_at = json.loads(content)['metadata']['generated_at']
+            return content.replace(generated_at.encode('utf-8'), b'')
+
+        def get_entry():
+            entry = load_manifest()['bundles']['Firefox/el-gr/default.json']
+            return entry['size'], entry['content_hash']
+
+        with self.patch_bundles(storage, ['el-GR']):
+            for compact in [False, True]:
+                with self.settings(BUNDLE_COMPACT_ENCODING=compact):
+                    generate_bundles(stdout=Mock())
+                    bundles = get_bundles()
+                    content = get_content()
+                    entry = get_entry()
+
+                with self.settings(BUNDLE_STREAMING=True, BUNDLE_STREAMING_CHUNK_SIZE=2,
+                                   BUNDLE_COMPACT_ENCODING=compact):
+                    # Streaming doesn't change the content hash of bundles.
+                    summary = generate_bundles(stdout=Mock())
+                    self.assertEqual(summary['unchanged'], ['pregen/Firefox/el-gr/default.json'])
+
+                    for filename in ['default.json', 'default.json.gz', 'default.json.raw']:
+                        storage.delete(f'pregen/Firefox/el-gr/{filename}')
+                    summary = generate_bundles(stdout=Mock())
+                    self.assertEqual(summary['written'], ['pregen/Firefox/el-gr/default.json'])
+                    self.assertEqual(len(get_bundles()['default.json']['messages']), 3)
+                    self.assertEqual(get_bundles(), bundles)
+                    self.assertEqual(get_content(), content)
+                    self.assertEqual(get_entry(), entry)
+
+                    # Unchanged streamed bundles don't get written again.
+                    summary = generate_bundles(stdout=Mock())
+                    self.assertEqual(summary['unchanged'], ['pregen/Firefox/el-gr/default.json'])
+
+    @override_settings(MEDIA_BUNDLES_PREGEN_ROOT='pregen',
+                       BUNDLE_ENCODINGS=['br', 'identity'])
+    def test_staged_publish(self):
+        JobFactory(status=Job.PUBLISHED, snippet__locale=',el,')
+        fr_job = JobFactory(status=Job.PUBLISHED, snippet__locale=',fr,')
+        storage = self.get_storage()
+
+        with self.patch_bundles(storage, ['el', 'fr']):
+            def publish(summary, staging, stats, existing_files):
+                # Nothing is in place until all files got uploaded.
+                self.assertFalse(storage.exists('pregen/Firefox'))
+                self.assertTrue(storage.exists(f'{staging}/Firefox/el/default.json.raw'))
+                _publish_staged_bundles(summary, staging, stats, existing_files)
+
+            with patch('snippets.base.bundles._publish_staged_bundles', side_effect=publish):
+                generate_bundles(stdout=Mock())
+            for filename in ['pregen/Firefox/el/default.json',
+                             'pregen/Firefox/el/default.json.raw',
+                             'pregen/Firefox/fr/default.json',
+                             'pregen/Firefox/fr/default.json.raw']:
+                self.assertTrue(storage.exists(filename))
+            self.assertEqual(storage.get_content_hash('pregen/Firefox/el/default.json'),
+                             load_manifest()['bundles']['Firefox/el/default.json']['content_hash'])
+            self.assertEqual(storage.listdir('pregen/.staging'), ([], []))
+
+            fr_job.change_status(Job.COMPLETED)
+            summary = generate_bundles(stdout=Mock())
+            self.assertEqual(summary['removed'], ['pregen/Firefox/fr/default.json'])
+            self.assertFalse(storage.exists('pregen/Firefox/fr/default.json'))
+            self.assertFalse(storage.exists('pregen/Firefox/fr/default.json.raw'))
+
+            # Staged files get removed when generation fails.
+            with patch('snippets.base.bundles._move') as move_mock:
+                move_mock.side_effect = IOError
+                JobFactory(status=Job.PUBLISHED, snippet__locale=',el,')
+                self.assertRaises(IOError, generate_bundles, stdout=Mock())
+            self.assertEqual(storage.listdir('pregen/.staging'), ([], []))
+
+    @override_settings(MEDIA_BUNDLES_PREGEN_ROOT='pregen', BUNDLE_LEASE_BATCH=1,
+                       BUNDLE_ENCODINGS=['br', 'identity'])
+    def test_distributed(self):
+        JobFactory(status=Job.PUBLISHED, snippet__locale=',el,')
+        JobFactory(status=Job.PUBLISHED, snippet__locale=',fr,')
+        storage = self.get_storage()
+
+        bundle_connection = connections[settings.BUNDLE_DATABASE_ALIAS]
+        with self.patch_bundles(storage, ['el', 'fr']), \
+                CaptureQueriesContext(connection) as default_queries, \
+                CaptureQueriesContext(bundle_connection) as bundle_queries:
+            summary = generate_bundles(stdout=Mock(), distributed=True)
+            self.assertEqual(sorted(summary['written']),
+                             ['pregen/Firefox/el/default.json', 'pregen/Firefox/fr/default.json'])
+            # The units processed by this worker count their queries once.
+            self.assertEqual(
+                sum(phase['queries'] for phase in summary['stats'].values()),
+                len(default_queries) + len(bundle_queries))
+            self.assertEqual(sorted(load_manifest()['bundles']),
+                             ['Firefox/el/default.json', 'Firefox/fr/default.json'])
+            self.assertTrue(storage.exists('pregen/Firefox/fr/default.json.raw'))
+            self.assertFalse(BundleGeneration.objects.exists())
+
+            # Units that keep failing fail the generation.
+            JobFactory(status=Job.PUBLISHED, snippet__locale=',el,')
+            with patch('snippets.base.bundles._write_bundles', side_effect=IOError):
+                self.assertRaises(BundleWorkUnitFailed, generate_bundles,
+                                  stdout=Mock(), distributed=True)
+            self.assertFalse(BundleGeneration.objects.exists())
+            self.assertEqual(storage.listdir('pregen/.staging'), ([], []))
+
+    @override_settings(BUNDLE_DAEMON_DEBOUNCE=0.01, BUNDLE_DAEMON_MAX_DELAY=10)
+    def test_bundle_daemon(self):
+        listener = Mock()
+        # A notification followed by another one within the debounce time,
+        # then an idle timeout without DirtyBundles.
+        listener.wait.side_effect = [1, 1, 0, 0]
+        with patch('snippets.base.bundles.generate_bundles') as generate_mock:
+            run_bundle_daemon(listener=listener, iterations=2, stdout=Mock())
+        # Once on start and once for the notifications.
+        self.assertEqual(generate_mock.call_count, 2)
+        generate_mock.assert_called_with(dirty=True, distributed=False, stdout=ANY)
+        listener.close.assert_called()
+
+        # DirtyBundles get generated on idle timeouts too.
+        DirtyBundle.objects.create(locale='el', distribution_bundle=self.distribution_bundle)
+        listener.wait.side_effect = [0]
+        with patch('snippets.base.bundles.generate_bundles') as generate_mock:
+            run_bundle_daemon(listener=listener, iterations=1, stdout=Mock())
+        self.assertEqual(generate_mock.call_count, 2)
+
+        # Notifications that keep coming don't delay generation past the
+        # maximum delay.
+        listener.wait.side_effect = itertools.repeat(1)
+        with patch('snippets.base.bundles.generate_bundles') as generate_mock, \
+                self.settings(BUNDLE_DAEMON_MAX_DELAY=0.05):
+            run_bundle_daemon(listener=listener, iterations=1, stdout=Mock())
+        self.assertEqual(generate_mock.call_count, 2)
+
+    @override_settings(BUNDLE_PRESTAGE=True)
+    def test_bundle_daemon_prestaged(self):
+        now = datetime.utcnow()
+        listener = Mock()
+        listener.wait.return_value = 0
+        with patch.multiple('snippets.base.bundles', generate_bundles=DEFAULT,
+                            get_prestaged_boundaries=DEFAULT,
+                            promote_prestaged_bundles=DEFAULT) as mocks:
+            mocks['get_prestaged_boundaries'].return_value = [
+                now - timedelta(seconds=1), now + timedelta(seconds=30)]
+            run_bundle_daemon(listener=listener, iterations=1, stdout=Mock())
+
+        # Bundles prestaged for past boundaries get promoted and the daemon
+        # wakes up at the next one.
+        mocks['promote_prestaged_bundles'].assert_called_once_with(ANY, ANY)
+        self.assertTrue(25 < listener.wait.call_args[0][0] <= 30)
+
+    def test_claim_work_units(self):
+        generation = BundleGeneration.objects.create()
+        leased, expired, done = [
+            BundleWorkUnit.objects.create(generation=generation, locale=locale,
+                                          distribution_bundle=self.distribution_bundle)
+            for locale in ['el', 'fr', 'de']
+        ]
+        BundleWorkUnit.objects.filter(id=leased.id).update(
+            owner='other', lease_expires=datetime.utcnow() + timedelta(minutes=1))
+        BundleWorkUnit.objects.filter(id=expired.id).update(
+            owner='crashed', lease_expires=datetime.utcnow() - timedelta(minutes=1))
+        BundleWorkUnit.objects.filter(id=done.id).update(done=True)
+
+        self.assertEqual(_claim_work_units('me'), [expired])
+        expired.refresh_from_db()
+        self.assertEqual(expired.owner, 'me')
+        self.assertGreater(expired.lease_expires, datetime.utcnow())
+        self.assertEqual(_claim_work_units('me'), [])
+
+    @override_settings(MEDIA_BUNDLES_PREGEN_ROOT='pregen', BUNDLE_CHANNEL_PARTITIONING=True)
+    def test_channel_partitioning(self):
+        release_job = JobFactory(status=Job.PUBLISHED, snippet__locale=',el,',
+                                 targets=[TargetFactory(channels='release;beta')])
+        nightly_job = JobFactory(status=Job.PUBLISHED, snippet__locale=',el,',
+                                 targets=[TargetFactory(channels='nightly')])
+        storage = self.get_storage()
+
+        def get_job_ids(channel):
+            with storage.open(f'pregen/Firefox/el/{channel}/default.json') as fp:
+                bundle = json.loads(fp.read())
+            self.assertEqual(bundle['metadata']['channel'], channel)
+            return [message['id'] for message in bundle['messages']]
+
+        for streaming in [False, True]:
+            with self.patch_bundles(storage, ['el']), \
+                    self.settings(BUNDLE_STREAMING=streaming):
+                storage.delete_many(storage.list_files('pregen'))
+                summary = generate_bundles(stdout=Mock())
+                self.assertEqual(sorted(summary['written']), [
+                    'pregen/Firefox/el/beta/default.json',
+                    'pregen/Firefox/el/nightly/default.json',
+                    'pregen/Firefox/el/release/default.json',
+                ])
+                self.assertEqual(get_job_ids('release'), [str(release_job.id)])
+                self.assertEqual(get_job_ids('beta'), [str(release_job.id)])
+                self.assertEqual(get_job_ids('nightly'), [str(nightly_job.id)])
+                self.assertFalse(storage.exists('pregen/Firefox/el/aurora/default.json'))
+                self.assertFalse(storage.exists('pregen/Firefox/el/default.json'))
+                self.assertEqual(
+                    load_manifest()['bundles']['Firefox/el/nightly/default.json']['channel'],
+                    'nightly')
+
+        # Bundles of channels left without Jobs get removed.
+        with self.patch_bundles(storage, ['el']):
+            nightly_job.change_status(Job.COMPLETED)
+            summary = generate_bundles(stdout=Mock())
+        self.assertEqual(summary['removed'], ['pregen/Firefox/el/nightly/default.json'])
+        self.assertTrue(storage.exists('pregen/Firefox/el/release/default.json'))
+
+    @override_settings(SNIPPETS_PUBLICATION_OFFSET=5)
+    def test_get_publish_boundaries(self):
+        now = datetime(2020, 1, 1, 12, 0)
+        JobFactory(status=Job.SCHEDULED, publish_start=now + timedelta(minutes=10))
+        JobFactory(status=Job.SCHEDULED, publish_start=now - timedelta(minutes=10))
+        JobFactory(status=Job.PUBLISHED, publish_end=now + timedelta(minutes=30))
+        JobFactory(status=Job.PUBLISHED, publish_end=now + timedelta(minutes=90))
+        JobFactory(status=Job.DRAFT, publish_start=now + timedelta(minutes=20))
+
+        self.assertEqual(get_publish_boundaries(now, now + timedelta(minutes=60)), [
+            now + timedelta(minutes=15),
+            now + timedelta(minutes=30),
+        ])
+
+    @override_settings(MEDIA_BUNDLES_PREGEN_ROOT='pregen', SNIPPETS_PUBLICATION_OFFSET=0)
+    def test_prestage_bundles(self):
+        now = datetime.utcnow()
+        start = now + timedelta(minutes=10)
+        published_job = JobFactory(status=Job.PUBLISHED, snippet__locale=',el,')
+        scheduled_job = JobFactory(status=Job.SCHEDULED, snippet__locale=',el,',
+                                   publish_start=start)
+        storage = self.get_storage()
+
+        def get_job_ids():
+            with storage.open('pregen/Firefox/el/default.json') as fp:
+                return {message['id'] for message in json.loads(fp.read())['messages']}
+
+        with self.patch_bundles(storage, ['el']):
+            generate_bundles(stdout=Mock())
+
+            plans = prestage_bundles(now=now, horizon=timedelta(minutes=60))
+            self.assertEqual([plan['boundary'] for plan in plans], [start.isoformat()])
+            self.assertEqual(list(plans[0]['bundles']), ['Firefox/el/default.json'])
+            self.assertEqual(get_job_ids(), {str(published_job.id)})
+
+            # Not promoted before the boundary.
+            manifest = load_manifest()
+            _promote_prestaged_bundles(manifest, now, BundleStats(), Mock())
+            self.assertEqual(get_job_ids(), {str(published_job.id)})
+
+            self.assertEqual(get_prestaged_boundaries(), [start])
+            promote_prestaged_bundles(now=start, stdout=Mock())
+            self.assertEqual(get_job_ids(), {str(published_job.id), str(scheduled_job.id)})
+            self.assertEqual(load_manifest()['bundles']['Firefox/el/default.json'],
+                             plans[0]['bundles']['Firefox/el/default.json']['entry'])
+            self.assertEqual(storage.listdir('pregen/.prestaged'), ([], []))
+
+            # The Job gets published with its bundles, which don't get
+            # rendered again.
+            scheduled_job.refresh_from_db()
+            self.assertEqual(scheduled_job.status, Job.PUBLISHED)
+            self.assertFalse(DirtyBundle.objects.exists())
+            summary = generate_bundles(stdout=Mock(), dirty=True)
+            self.assertEqual(summary['processed'], 0)
+
+            # Rendering the bundle after publishing the Job gives the same one.
+            summary = generate_bundles(stdout=Mock())
+            self.assertEqual(summary['unchanged'], ['pregen/Firefox/el/default.json'])
+
+    @override_settings(MEDIA_BUNDLES_PREGEN_ROOT='pregen', SNIPPETS_PUBLICATION_OFFSET=0)
+    def test_prestage_bundles_changed(self):
+        now = datetime.utcnow()
+        end = now + timedelta(minutes=10)
+        JobFactory(status=Job.PUBLISHED, snippet__locale=',el,', publish_end=end)
+        storage = self.get_storage()
+
+        with self.patch_bundles(storage, ['el']):
+            generate_bundles(stdout=Mock())
+
+            plans = prestage_bundles(now=now, horizon=timedelta(minutes=60))
+            self.assertIsNone(plans[0]['bundles']['Firefox/el/default.json']['entry'])
+
+            # The bundle changes after it got prestaged.
+            JobFactory(status=Job.PUBLISHED, snippet__locale=',el,')
+            generate_bundles(stdout=Mock())
+            DirtyBundle.objects.all().delete()
+
+            manifest = load_manifest()
+            _promote_prestaged_bundles(manifest, end, BundleStats(), Mock())
+            self.assertTrue(storage.exists('pregen/Firefox/el/default.json'))
+            self.assertEqual(
+                list(DirtyBundle.objects.values_list('locale', 'distribution_bundle__code_name')),
+                [('el', 'default')])
+
+    @override_settings(MEDIA_BUNDLES_PREGEN_ROOT='pregen',
+                       BUNDLE_ENCODINGS=['br', 'identity'])
+    def test_history_and_rollback(self):
+        job = JobFactory(status=Job.PUBLISHED, snippet__locale=',el,')
+        storage = self.get_storage()
+
+        def get_job_ids(locale):
+            with storage.open(f'pregen/Firefox/{locale}/default.json.raw') as fp:
+                return {message['id'] for message in json.loads(fp.read())['messages']}
+
+        with self.patch_bundles(storage, ['el', 'fr']):
+            generate_bundles(stdout=Mock())
+            first_run = BundleRun.objects.get()
+            content_hash = load_manifest()['bundles']['Firefox/el/default.json']['content_hash']
+            self.assertEqual(
+                list(first_run.bundles.values_list('path', 'content_hash')),
+                [('Firefox/el/default.json', content_hash)])
+            self.assertTrue(storage.exists(
+                f'pregen/.objects/{content_hash[:2]}/{content_hash}.json.raw'))
+
+            # Runs without changes don't get recorded.
+            generate_bundles(stdout=Mock())
+            self.assertEqual(BundleRun.objects.count(), 1)
+
+            bad_job = JobFactory(status=Job.PUBLISHED, snippet__locale=',el,fr,')
+            generate_bundles(stdout=Mock())
+            self.assertEqual(get_job_ids('el'), {str(job.id), str(bad_job.id)})
+
+            result = rollback_bundles(first_run.id, locale='fr', dry_run=True)
+            self.assertEqual(result, {'restored': [], 'removed': ['Firefox/fr/default.json']})
+            self.assertTrue(storage.exists('pregen/Firefox/fr/default.json'))
+
+            result = rollback_bundles(first_run.id)
+            self.assertEqual(result, {'restored': ['Firefox/el/default.json'],
+                                      'removed': ['Firefox/fr/default.json']})
+            self.assertEqual(get_job_ids('el'), {str(job.id)})
+            self.assertFalse(storage.exists('pregen/Firefox/fr/default.json'))
+            manifest = load_manifest()
+            self.assertEqual(manifest['bundles']['Firefox/el/default.json']['content_hash'],
+                             content_hash)
+            self.assertNotIn('Firefox/fr/default.json', manifest['bundles'])
+            self.assertEqual(BundleRun.objects.first().rollback_to, first_run)
+
+            # Nothing left to roll back.
+            self.assertEqual(rollback_bundles(first_run.id), {'restored': [], 'removed': []})
+
+    @override_settings(MEDIA_BUNDLES_PREGEN_ROOT='pregen', BUNDLE_LOCALE_ALIASES=True,
+                       BUNDLE_LOCALE_WEIGHTS={'en-us': 10})
+    def test_rollback_aliases(self):
+        JobFactory(status=Job.PUBLISHED, snippet__locale=',en,')
+        storage = self.get_storage()
+
+        def get_content(locale):
+            with storage.open(f'pregen/Firefox/{locale}/default.json') as fp:
+                return fp.read()
+
+        with self.patch_bundles(storage, ['en-gb', 'en-us', 'fr']):
+            generate_bundles(stdout=Mock())
+            first_run = BundleRun.objects.get()
+            content = get_content('en-us')
+
+            JobFactory(status=Job.PUBLISHED, snippet__locale=',en,fr,')
+            generate_bundles(stdout=Mock())
+            self.assertNotEqual(get_content('en-us'), content)
+
+            result = rollback_bundles(first_run.id)
+            self.assertEqual(result, {'restored': ['Firefox/en-us/default.json'],
+                                      'removed': ['Firefox/fr/default.json']})
+            self.assertEqual(get_content('en-us'), content)
+            self.assertFalse(DirtyBundle.objects.exists())
+            manifest = load_manifest()
+            self.assertEqual(manifest['bundles']['Firefox/en-gb/default.json']['alias_of'],
+                             'Firefox/en-us/default.json')
+            with storage.open('pregen/aliases.json') as fp:
+                self.assertEqual(json.loads(fp.read()), {
+                    'Firefox/en-gb/default.json': 'Firefox/en-us/default.json',
+                })
+
+            # Processing the dirty bundles doesn't undo the rollback.
+            generate_bundles(dirty=True, stdout=Mock())
+            self.assertEqual(get_content('en-us'), content)
+
+    @override_settings(MEDIA_BUNDLES_PREGEN_ROOT='pregen', BUNDLE_HISTORY_DAYS=30)
+    def test_prune_history(self):
+        storage = self.get_storage()
+
+        def get_object_filename():
+            content_hash = load_manifest()['bundles']['Firefox/el/default.json']['content_hash']
+            return f'pregen/.objects/{content_hash[:2]}/{content_hash}.json'
+
+        with self.patch_bundles(storage, ['el']):
+            JobFactory(status=Job.PUBLISHED, snippet__locale=',el,')
+            generate_bundles(stdout=Mock())
+            first_object = get_object_filename()
+            JobFactory(status=Job.PUBLISHED, snippet__locale=',el,')
+            generate_bundles(stdout=Mock())
+            second_object = get_object_filename()
+            first_run, second_run = BundleRun.objects.order_by('id')
+            BundleRun.objects.update(created=datetime.now() - timedelta(days=31))
+
+            JobFactory(status=Job.PUBLISHED, snippet__locale=',el,')
+            generate_bundles(stdout=Mock())
+
+        # The latest history from before BUNDLE_HISTORY_DAYS is kept for
+        # rollbacks to later runs.
+        self.assertFalse(BundleRun.objects.filter(id=first_run.id).exists())
+        self.assertEqual(second_run.bundles.count(), 1)
+        self.assertEqual(BundleRun.objects.count(), 2)
+        self.assertFalse(storage.exists(first_object))
+        self.assertTrue(storage.exists(second_object))
+
+    @override_settings(MEDIA_BUNDLES_PREGEN_ROOT='pregen')
+    def test_snapshot(self):
+        JobFactory(status=Job.PUBLISHED, snippet__locale=',el,')
+        storage = self.get_storage()
+
+        # Tests run without BUNDLE_SNAPSHOT, which also requires PostgreSQL.
+        with bundle_snapshot() as snapshot:
+            self.assertEqual(snapshot, None)
+
+        with self.patch_bundles(storage, ['el']):
+            token = current_snapshot.set(
+                ('default', {'xmin': 42, 'timestamp': '2020-12-31T00:00:00'}))
+            try:
+                generate_bundles(stdout=Mock())
+            finally:
+                current_snapshot.reset(token)
+
+            with storage.open('pregen/Firefox/el/default.json') as fp:
+                metadata = json.loads(fp.read())['metadata']
+            self.assertEqual(metadata['snapshot'],
+                             {'xmin': 42, 'timestamp': '2020-12-31T00:00:00'})
+
+            # The snapshot doesn't count as a change of the bundle.
+            summary = generate_bundles(stdout=Mock())
+            self.assertEqual(summary['unchanged'], ['pregen/Firefox/el/default.json'])
+
+    @override_settings(MEDIA_BUNDLES_PREGEN_ROOT='pregen', BUNDLE_LOCALE_WEIGHTS={'fr': 10},
+                       BUNDLE_TRAFFIC_COVERAGE=[50, 100])
+    def test_traffic_priority(self):
+        for locale in ['el', 'fr', 'de']:
+            JobFactory(status=Job.PUBLISHED, snippet__locale=f',{locale},')
+        BundleTraffic.objects.create(locale='de', distribution_bundle=self.distribution_bundle,
+                                     requests=50)
+        storage = self.get_storage()
+
+        with self.patch_bundles(storage, ['de', 'el', 'fr']):
+            stdout = StringIO()
+            summary = generate_bundles(stdout=stdout)
+
+        self.assertEqual(summary['written'], ['pregen/Firefox/de/default.json',
+                                              'pregen/Firefox/fr/default.json',
+                                              'pregen/Firefox/el/default.json'])
+        self.assertEqual([percent for percent, seconds in summary['coverage']], [50, 100])
+        self.assertLessEqual(summary['coverage'][0][1], summary['coverage'][1][1])
+        self.assertIn('Traffic 50% covered', stdout.getvalue())
+
+    @override_settings(MEDIA_BUNDLES_PREGEN_ROOT='pregen', BUNDLE_LOCALE_WEIGHTS={'fr': 3})
+    def test_traffic_weights(self):
+        bundles_to_process = [(self.distribution_bundle, locale) for locale in ['de', 'el', 'fr']]
+        self.assertEqual(_get_traffic_weights(bundles_to_process), {
+            (self.distribution_bundle.id, 'de'): 0.2,
+            (self.distribution_bundle.id, 'el'): 0.2,
+            (self.distribution_bundle.id, 'fr'): 0.6,
+        })
+
+        # Requests weigh as much as the configured weights, whatever their
+        # scale.
+        update_bundle_traffic([
+            ('/pregen/Firefox/de/default.json', '600'),
+            ('/pregen/Firefox/de/release/default.json', '200'),
+            ('/pregen/Firefox/el/default.json', '200'),
+            ('/pregen/Firefox/el/unknown.json', '1000'),
+            ('/pregen/aliases.json', '1000'),
+        ])
+        self.assertEqual(
+            list(BundleTraffic.objects.order_by('locale').values_list('locale', 'requests')),
+            [('de', 800), ('el', 200)])
+        self.assertEqual(_get_traffic_weights(bundles_to_process), {
+            (self.distribution_bundle.id, 'de'): 0.5,
+            (self.distribution_bundle.id, 'el'): 0.2,
+            (self.distribution_bundle.id, 'fr'): 0.3,
+        })
+
+        # Updates replace the previous traffic.
+        update_bundle_traffic([('/pregen/Firefox/fr/default.json', '10')])
+        self.assertEqual(
+            list(BundleTraffic.objects.values_list('locale', 'requests')), [('fr', 10)])
+
+    @override_settings(MEDIA_BUNDLES_PREGEN_ROOT='pregen', BUNDLE_LOCALE_ALIASES=True,
+                       BUNDLE_LOCALE_WEIGHTS={'en-us': 10})
+    def test_locale_aliases(self):
+        JobFactory(status=Job.PUBLISHED, snippet__locale=',en,')
+        en_gb_job = JobFactory(status=Job.PUBLISHED, snippet__locale=',en-gb,')
+        storage = self.get_storage()
+
+        for streaming in [False, True]:
+            with self.settings(BUNDLE_STREAMING=streaming), \
+                    self.patch_bundles(storage, ['en-gb', 'en-us']):
+                Job.objects.filter(id=en_gb_job.id).update(status=Job.PUBLISHED)
+                summary = generate_bundles(stdout=Mock())
+                self.assertEqual(summary['aliased'], [])
+                self.assertTrue(storage.exists('pregen/Firefox/en-gb/default.json'))
+
+                # Bundles identical to the en-us one, with more traffic,
+                # become its aliases.
+                Job.objects.filter(id=en_gb_job.id).update(status=Job.COMPLETED)
+                diff = generate_bundles(dry_run=True, stdout=Mock())
+                self.assertEqual([bundle_diff['filename'] for bundle_diff in diff['aliased']],
+                                 ['pregen/Firefox/en-gb/default.json'])
+                self.assertEqual(diff['aliased'][0]['removed_messages'], [str(en_gb_job.id)])
+                stdout = StringIO()
+                summary = generate_bundles(stdout=stdout)
+                self.assertEqual(summary['unchanged'], ['pregen/Firefox/en-us/default.json'])
+                self.assertEqual(summary['aliased'], ['pregen/Firefox/en-gb/default.json'])
+                self.assertIn('Bundles Aliased: 1', stdout.getvalue())
+                with storage.open('pregen/aliases.json') as fp:
+                    self.assertEqual(json.loads(fp.read()), {
+                        'Firefox/en-gb/default.json': 'Firefox/en-us/default.json',
+                    })
+                self.assertEqual(get_bundle_file_encoding('pregen/aliases.json'), 'identity')
+
+                summary = generate_bundles(stdout=Mock())
+                self.assertEqual(summary['unchanged'], ['pregen/Firefox/en-us/default.json',
+                                                        'pregen/Firefox/en-gb/default.json'])
+
+                # Files of aliases are kept until the redirects to them expire.
+                self.assertTrue(storage.exists('pregen/Firefox/en-gb/default.json'))
+                with self.settings(SNIPPET_BUNDLE_PREGEN_REDIRECT_TIMEOUT=0):
+                    generate_bundles(stdout=Mock())
+                self.assertFalse(storage.exists('pregen/Firefox/en-gb/default.json'))
+                entry = load_manifest()['bundles']['Firefox/en-gb/default.json']
+                self.assertEqual(entry['alias_of'], 'Firefox/en-us/default.json')
+                self.assertIsNone(entry['aliased_at'])
+
+                # Dry runs compare aliases with the bundle they alias.
+                diff = generate_bundles(dry_run=True, stdout=Mock())
+                self.assertEqual(diff['added'], [])
+                self.assertEqual(diff['unchanged'], 2)
+
+                # Aliases get processed with the bundle they alias, and get
+                # their own file once they differ.
+                Job.objects.filter(id=en_gb_job.id).update(status=Job.PUBLISHED)
+                diff = generate_bundles(dry_run=True, limit_to_locale='en-us', stdout=Mock())
+                self.assertEqual(diff['added'], [])
+                self.assertEqual([bundle_diff['filename'] for bundle_diff in diff['changed']],
+                                 ['pregen/Firefox/en-gb/default.json'])
+                self.assertEqual(diff['changed'][0]['added_messages'], [str(en_gb_job.id)])
+                summary = generate_bundles(limit_to_locale='en-us', stdout=Mock())
+                self.assertEqual(summary['written'], ['pregen/Firefox/en-gb/default.json'])
+                self.assertEqual(summary['aliased'], [])
+                with storage.open('pregen/aliases.json') as fp:
+                    self.assertEqual(json.loads(fp.read()), {})
+
+            for name in storage.listdir('pregen')[1]:
+                storage.delete(f'pregen/{name}')
+
+    @override_settings(MEDIA_BUNDLES_PREGEN_ROOT='pregen')
+    def test_stats(self):
+        JobFactory(status=Job.PUBLISHED, snippet__locale=',el,')
+        storage = self.get_storage()
+
+        for streaming in [False, True]:
+            stdout = StringIO()
+            with self.settings(BUNDLE_STREAMING=streaming), \
+                    self.patch_bundles(storage, ['el']):
+                summary = generate_bundles(stdout=stdout, stats_format='json')
+
+            self.assertEqual(set(summary['stats'].keys()), set(BundleStats.PHASES))
+            self.assertGreater(summary['stats']['query']['queries'], 0)
+            self.assertGreater(summary['stats']['render']['time'], 0)
+            self.assertGreater(summary['stats']['serialize']['time'], 0)
+            self.assertGreater(summary['stats']['write']['time'], 0)
+            self.assertEqual(summary['bytes_written'], {
+                'pregen/Firefox/el/default.json': storage.size('pregen/Firefox/el/default.json'),
+            })
+
+            stats_line = json.loads(stdout.getvalue().splitlines()[-1])
+            self.assertEqual(stats_line['event'], 'generate_bundles')
+            self.assertEqual(stats_line['written'], 1)
+            self.assertEqual(stats_line['phases'], summary['stats'])
+
+            storage.delete('pregen/manifest.json')
+            storage.delete('pregen/Firefox/el/default.json')
+
+    @override_settings(MEDIA_BUNDLES_PREGEN_ROOT='pregen', BUNDLE_BROTLI_COMPRESS=True)
+    def test_dry_run(self):
+        job = JobFactory(status=Job.PUBLISHED, snippet__locale=',el,')
+        JobFactory(status=Job.PUBLISHED, snippet__locale=',fr,')
+        storage = self.get_storage()
+
+        with self.patch_bundles(storage, ['el', 'fr', 'de']):
+            diff = generate_bundles(dry_run=True, stdout=Mock())
+            self.assertEqual(
+                [bundle_diff['filename'] for bundle_diff in diff['added']],
+                ['pregen/Firefox/el/default.json', 'pregen/Firefox/fr/default.json']
+            )
+            self.assertFalse(storage.exists('pregen/Firefox/el/default.json'))
+            self.assertFalse(storage.exists('pregen/manifest.json'))
+
+            generate_bundles(stdout=Mock())
+            diff = generate_bundles(dry_run=True, stdout=Mock())
+            self.assertEqual(diff, {'added': [], 'removed': [], 'changed': [], 'aliased': [],
+                                    'unchanged': 2})
+
+            new_job = JobFactory(status=Job.PUBLISHED, snippet__locale=',el,')
+            JobFactory(status=Job.PUBLISHED, snippet__locale=',de,')
+            job.change_status(Job.COMPLETED, send_slack=False)
+            Job.objects.filter(snippet__locale__code=',fr,').update(status=Job.COMPLETED)
+
+            diff = generate_bundles(dry_run=True, dirty=True, stdout=Mock())
+            self.assertEqual(len(diff['changed']), 1)
+            self.assertTrue(DirtyBundle.objects.exists())
+
+            stdout = StringIO()
+            diff = generate_bundles(dry_run=True, diff=True, stdout=stdout)
+            self.assertEqual(len(diff['added']), 1)
+            self.assertEqual(diff['added'][0]['filename'], 'pregen/Firefox/de/default.json')
+            self.assertEqual(len(diff['removed']), 1)
+            self.assertEqual(diff['removed'][0]['filename'], 'pregen/Firefox/fr/default.json')
+            self.assertEqual(len(diff['changed']), 1)
+            self.assertEqual(diff['changed'][0]['added_messages'], [str(new_job.id)])
+            self.assertEqual(diff['changed'][0]['removed_messages'], [str(job.id)])
+            self.assertIn('~ pregen/Firefox/el/default.json: +1 -1 messages', stdout.getvalue())
+            self.assertIn('Bundles Removed: 1', stdout.getvalue())
+
+            # Nothing got written or claimed.
+            self.assertTrue(storage.exists('pregen/Firefox/fr/default.json'))
+
+    @override_settings(MEDIA_BUNDLES_PREGEN_ROOT='pregen', BUNDLE_SIZE_BUDGET=100)
+    def test_size_budget(self):
+        JobFactory(status=Job.PUBLISHED, snippet__locale=',el,')
+        storage = self.get_storage()
+
+        with self.patch_bundles(storage, ['el']):
+            with self.settings(BUNDLE_SIZE_BUDGET_ACTION='fail'):
+                self.assertRaises(BundleSizeBudgetExceeded, generate_bundles, stdout=Mock())
+            self.assertFalse(storage.exists('pregen/Firefox/el/default.json'))
+
+            # The temporary files of streamed bundles get closed.
+            with self.settings(BUNDLE_SIZE_BUDGET_ACTION='fail', BUNDLE_STREAMING=True), \
+                    patch('snippets.base.bundles._close_variants') as close_variants_mock:
+                self.assertRaises(BundleSizeBudgetExceeded, generate_bundles, stdout=Mock())
+            close_variants_mock.assert_called_once()
+            self.assertTrue(DirtyBundle.objects.exists())
+
+            stdout = StringIO()
+            summary = generate_bundles(stdout=stdout)
+            self.assertEqual(summary['over_budget'], ['pregen/Firefox/el/default.json'])
+            self.assertTrue(storage.exists('pregen/Firefox/el/default.json'))
+            self.assertIn('Warning: pregen/Firefox/el/default.json is over the size budget',
+                          stdout.getvalue())
+
+    def test_get_size_report(self):
+        job = JobFactory(status=Job.PUBLISHED, snippet__locale=',el,',
+                         targets=[TargetFactory(jexl_expr='foo == 1')])
+        JobFactory(status=Job.PUBLISHED, snippet__locale=',el,fr,')
+
+        with patch('snippets.base.bundles.get_locale_index') as get_locale_index_mock:
+            get_locale_index_mock.return_value = LocaleIndex(['el', 'fr'])
+            report = get_size_report()
+
+        self.assertEqual([bundle['path'] for bundle in report['bundles']],
+                         ['Firefox/el/default.json', 'Firefox/fr/default.json'])
+        self.assertEqual(report['bundles'][0]['number_of_snippets'], 2)
+        self.assertEqual(sorted(message['bundles'] for message in report['messages']), [1, 2])
+
+        message = [message for message in report['messages'] if message['job'] == job.id][0]
+        self.assertEqual(message['template'], 'simple_snippet')
+        self.assertGreater(message['fields']['icons'], 0)
+        self.assertGreater(message['fields']['text'], 0)
+        self.assertGreater(message['fields']['targeting'], len('foo == 1'))
+        self.assertEqual(sum(message['fields'].values()), message['raw'])
+
+        self.assertEqual(report['templates']['simple_snippet']['count'], 3)
+        self.assertEqual(sum(report['fields'].values()),
+                         sum(message['raw'] * message['bundles']
+                             for message in report['messages']))
+
+    def test_bundle_stats_phases(self):
+        stats = BundleStats()
+        with stats.phase('render'):
+            stats(Mock(), 'SELECT 1', None, False, {})
+            with stats.phase('query'):
+                stats(Mock(), 'SELECT 1', None, False, {})
+        stats(Mock(), 'SELECT 1', None, False, {})
+        stats.add_time('compress', 2)
+        stats.merge({'compress': {'time': 1, 'queries': 0}})
+
+        phases = stats.as_dict()
+        self.assertEqual(phases['render']['queries'], 1)
+        self.assertEqual(phases['query']['queries'], 1)
+        self.assertEqual(phases['other']['queries'], 1)
+        self.assertEqual(phases['compress']['time'], 3)
+
+    @override_settings(BUNDLE_ENCODINGS=['gzip', 'br'])
+    def test_get_bundle_file_encoding(self):
+        self.assertEqual(get_bundle_file_encoding('pregen/Firefox/el/default.json'), 'gzip')
+        self.assertEqual(get_bundle_file_encoding('pregen/Firefox/el/default.json.br'), 'br')
+        self.assertEqual(get_bundle_file_encoding('pregen/manifest.json'), 'identity')
+
+    def test_compact_encoding_without_orjson(self):
+        bundle = {'messages': [{'id': '1', 'content': {'text': 'Καλημέρα'}}]}
+        with patch('snippets.base.bundles.orjson', None):
+            self.assertEqual(
+                json.loads(_encode_bundle(bundle, compact=True)),
+                json.loads(_encode_bundle(bundle))
+            )
+            self.assertLess(len(_encode_bundle(bundle, compact=True)),
+                            len(_encode_bundle(bundle)))
+
+    def test_elide_defaults(self):
+        message = {
+            'id': '1',
+            'content': {'tall': False, 'do_not_autoblock': True, 'include_sms': 0, 'text': 'foo'},
+        }
+        self.assertEqual(
+            _elide_defaults(message),
+            {'id': '1', 'content': {'do_not_autoblock': True, 'include_sms': 0, 'text': 'foo'}}
+        )
+        # The original message is not modified.
+        self.assertIn('tall', message['content'])
+
+    def test_get_encoding_sizes(self):
+        JobFactory(status=Job.PUBLISHED, snippet__locale=',el,')
+        sizes = get_encoding_sizes()
+        self.assertGreater(sizes['default']['raw'], sizes['minified']['raw'])
+        self.assertGreater(sizes['minified']['raw'], sizes['minified, without defaults']['raw'])
+        self.assertGreater(sizes['default']['raw'], sizes['default']['brotli'])
+
+
+class BundleSnapshotTests(TestCase):
+    databases = {'default', settings.BUNDLE_DATABASE_ALIAS}
+
+    def setUp(self):
+        distribution_bundle = DistributionBundleFactory.create(code_name='default')
+        distribution_bundle.distributions.add(DistributionFactory.create(name='Default'))
+
+    def test_init_bundles_worker(self):
+        # Forked workers inherit the connection of the bundle snapshot of the
+        # parent process, which they must replace without closing it.
+        alias = settings.BUNDLE_DATABASE_ALIAS
+        inherited = connections[alias]
+        with transaction.atomic(using=alias):
+            bundles._close_connections_before_fork()
+            self.assertIsNotNone(inherited.connection)
+
+            token = current_snapshot.set((alias, {}))
+            try:
+                with patch.object(inherited, 'close') as close_mock:
+                    bundles._init_bundles_worker()
+                close_mock.assert_not_called()
+                self.assertIsNone(current_snapshot.get())
+                worker_connection = connections[alias]
+                self.assertIsNot(worker_connection, inherited)
+                self.assertFalse(worker_connection.in_atomic_block)
+                with worker_connection.cursor() as cursor:
+                    cursor.execute('SELECT 1')
+            finally:
+                connections[alias].close()
+                connections[alias] = inherited
+                bundles._inherited_connections.remove(inherited)
+                current_snapshot.reset(token)
+
+            # The parent process keeps using its snapshot.
+            with inherited.cursor() as cursor:
+                cursor.execute('SELECT 1')
+
+    @skipUnless(connection.vendor == 'postgresql', 'Bundle snapshots require PostgreSQL.')
+    @override_settings(MEDIA_BUNDLES_PREGEN_ROOT='pregen', BUNDLE_SNAPSHOT=True)
+    def test_snapshot_workers(self):
+        JobFactory(status=Job.PUBLISHED, snippet__locale=',el,')
+        JobFactory(status=Job.PUBLISHED, snippet__locale=',fr,')
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        storage = OverwriteStorage(location=directory.name)
+
+        with patch.multiple('snippets.base.bundles',
+                            get_locale_index=Mock(return_value=LocaleIndex(['el', 'fr'])),
+                            default_storage=storage):
+            summary = generate_bundles(stdout=Mock(), workers=2)
+
+        self.assertEqual(sorted(summary['written']),
+                         ['pregen/Firefox/el/default.json', 'pregen/Firefox/fr/default.json'])
+        snapshots = []
+        for filename in summary['written']:
+            with storage.open(filename) as fp:
+                snapshots.append(json.loads(fp.read())['metadata']['snapshot'])
+        # Both workers read from the snapshot of the parent process.
+        self.assertEqual(snapshots[0], snapshots[1])
+
+
+class BundlePlannerTests(TestCase):
+    def setUp(self):
+        self.distribution = DistributionFactory.create(name='Default')
+        self.distribution_bundle = DistributionBundleFactory.create(name='Default',
+                                                                    code_name='default')
+        self.distribution_bundle.distributions.add(self.distribution)
+
+    def test_get_jobs(self):
+        job_en = JobFactory(snippet__locale=',en,')
+        job_en_gb = JobFactory(snippet__locale=',en-gb,el,')
+        JobFactory(snippet__locale=',en-us,')
+        JobFactory(status=Job.DRAFT, snippet__locale=',en,')
+        JobFactory(snippet__locale=',en,', distribution__name='not-default')
+
+        planner = BundlePlanner([self.distribution_bundle])
+        self.assertEqual(
+            set(planner.get_jobs(self.distribution_bundle, 'en-gb')),
+            {job_en, job_en_gb}
+        )
+        self.assertEqual(planner.get_jobs(self.distribution_bundle, 'el'), [job_en_gb])
+        self.assertEqual(planner.get_jobs(self.distribution_bundle, 'de'), [])
+
+    def test_fixed_number_of_queries(self):
+        for _ in range(5):
+            JobFactory(snippet__locale=',en,')
+
+        distribution_bundle = DistributionBundle.objects.prefetch_related('distributions').get()
+        planner = BundlePlanner([distribution_bundle])
+        # One query for the Jobs and one to prefetch their Targets.
+        with self.assertNumQueries(2):
+            jobs = planner.get_jobs(distribution_bundle, 'en-us')
+            for job in jobs:
+                planner.render(job)
+        self.assertEqual(len(jobs), 5)
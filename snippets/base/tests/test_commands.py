@@ -1,4 +1,7 @@
+import json
+import tempfile
 from datetime import date, datetime, timedelta
+from io import StringIO
 
 from unittest.mock import ANY, Mock, call, patch
 
@@ -9,7 +12,7 @@ from django.test.utils import override_settings
 
 from snippets.base import models
 from snippets.base.management.commands import fetch_daily_metrics
-from snippets.base.tests import JobFactory, TestCase
+from snippets.base.tests import DistributionBundleFactory, JobFactory, TestCase
 
 
 @override_settings(REDASH_API_KEY='secret')
@@ -268,10 +271,177 @@ class GenerateBundlesTests(TestCase):
     def test_base(self):
         with patch('snippets.base.management.commands.generate_bundles.bundles') as bundles_mock:
             call_command('generate_bundles', timestamp='2020-12-31', stdout=Mock())
-            bundles_mock.generate_bundles.assert_called_with(timestamp='2020-12-31', stdout=ANY)
+            bundles_mock.generate_bundles.assert_called_with(
+                timestamp='2020-12-31', dirty=False, workers=1, stats_format=None,
+                dry_run=False, diff=False, distributed=False, stdout=ANY)
 
             call_command('generate_bundles', stdout=Mock())
-            bundles_mock.generate_bundles.assert_called_with(timestamp=None, stdout=ANY)
+            bundles_mock.generate_bundles.assert_called_with(
+                timestamp=None, dirty=False, workers=1, stats_format=None,
+                dry_run=False, diff=False, distributed=False, stdout=ANY)
+
+            call_command('generate_bundles', workers=4, stdout=Mock())
+            bundles_mock.generate_bundles.assert_called_with(
+                timestamp=None, dirty=False, workers=4, stats_format=None,
+                dry_run=False, diff=False, distributed=False, stdout=ANY)
+
+            call_command('generate_bundles', dirty=True, stdout=Mock())
+            bundles_mock.generate_bundles.assert_called_with(
+                timestamp=None, dirty=True, workers=1, stats_format=None,
+                dry_run=False, diff=False, distributed=False, stdout=ANY)
+
+            call_command('generate_bundles', '--stats', stdout=Mock())
+            bundles_mock.generate_bundles.assert_called_with(
+                timestamp=None, dirty=False, workers=1, stats_format='text',
+                dry_run=False, diff=False, distributed=False, stdout=ANY)
+
+            call_command('generate_bundles', '--stats=json', stdout=Mock())
+            bundles_mock.generate_bundles.assert_called_with(
+                timestamp=None, dirty=False, workers=1, stats_format='json',
+                dry_run=False, diff=False, distributed=False, stdout=ANY)
+
+            call_command('generate_bundles', '--dry-run', '--diff', stdout=Mock())
+            bundles_mock.generate_bundles.assert_called_with(
+                timestamp=None, dirty=False, workers=1, stats_format=None,
+                dry_run=True, diff=True, distributed=False, stdout=ANY)
+
+            call_command('generate_bundles', '--distributed', stdout=Mock())
+            bundles_mock.generate_bundles.assert_called_with(
+                timestamp=None, dirty=False, workers=1, stats_format=None,
+                dry_run=False, diff=False, distributed=True, stdout=ANY)
+
+            self.assertRaises(CommandError, call_command, 'generate_bundles', '--diff',
+                              stdout=Mock())
+
+    def test_worker(self):
+        with patch('snippets.base.management.commands.generate_bundles.bundles') as bundles_mock:
+            call_command('generate_bundles', '--worker', stdout=Mock())
+        bundles_mock.run_bundle_worker.assert_called_with(stdout=ANY)
+        bundles_mock.generate_bundles.assert_not_called()
+
+
+class BenchmarkBundlesTests(TestCase):
+    @patch('snippets.base.management.commands.benchmark_bundles.connections')
+    @patch('snippets.base.management.commands.benchmark_bundles.connection')
+    @patch('snippets.base.management.commands.benchmark_bundles.benchmark')
+    def test_base(self, benchmark_mock, connection_mock, connections_mock):
+        benchmark_mock.run_benchmark.return_value = {'runs': {}}
+        stdout = StringIO()
+        call_command('benchmark_bundles', jobs=10, workers=2, stdout=stdout)
+
+        connection_mock.creation.create_test_db.assert_called()
+        connection_mock.creation.destroy_test_db.assert_called()
+        # Bundles get generated from the test database too.
+        connections_mock['bundles'].creation.set_as_test_mirror.assert_called_with(
+            connection_mock.settings_dict)
+        benchmark_mock.run_benchmark.assert_called_with(
+            jobs=10, locales=20, distribution_bundles=3, changed_jobs=10, workers=2)
+        self.assertEqual(json.loads(stdout.getvalue()), {'runs': {}})
+
+
+class BundleDaemonTests(TestCase):
+    def test_base(self):
+        with patch('snippets.base.management.commands.bundle_daemon.bundles') as bundles_mock:
+            call_command('bundle_daemon', stdout=Mock())
+        bundles_mock.run_bundle_daemon.assert_called_with(stdout=ANY)
+
+
+class PrestageBundlesTests(TestCase):
+    @override_settings(BUNDLE_PRESTAGE_HORIZON=60)
+    def test_base(self):
+        with patch('snippets.base.management.commands.prestage_bundles.bundles') as bundles_mock:
+            call_command('prestage_bundles', stdout=Mock())
+            bundles_mock.prestage_bundles.assert_called_with(
+                horizon=timedelta(minutes=60), stdout=ANY)
+
+            call_command('prestage_bundles', horizon=15, stdout=Mock())
+            bundles_mock.prestage_bundles.assert_called_with(
+                horizon=timedelta(minutes=15), stdout=ANY)
+
+
+class RollbackBundlesTests(TestCase):
+    def test_base(self):
+        run = models.BundleRun.objects.create(git_sha='abcdef')
+        with patch('snippets.base.management.commands.rollback_bundles.bundles') as bundles_mock:
+            bundles_mock.rollback_bundles.return_value = {'restored': ['foo'], 'removed': []}
+            stdout = StringIO()
+            call_command('rollback_bundles', run.id, locale='el', stdout=stdout)
+            bundles_mock.rollback_bundles.assert_called_with(
+                run.id, locale='el', distribution_bundle=None, dry_run=False, stdout=ANY)
+            self.assertIn('Bundles Restored: 1', stdout.getvalue())
+
+            self.assertRaises(CommandError, call_command, 'rollback_bundles', run.id + 1,
+                              stdout=Mock())
+
+            # Runs from before BUNDLE_HISTORY_DAYS can't be rolled back to.
+            with self.settings(BUNDLE_HISTORY_DAYS=0):
+                self.assertRaises(CommandError, call_command, 'rollback_bundles', run.id,
+                                  stdout=Mock())
+
+    def test_list(self):
+        run = models.BundleRun.objects.create(git_sha='abcdef')
+        models.BundleHistory.objects.create(run=run, path='Firefox/el/default.json')
+        stdout = StringIO()
+        call_command('rollback_bundles', stdout=stdout)
+        self.assertIn(f'{run.id:>8}', stdout.getvalue())
+        self.assertIn('1 bundles', stdout.getvalue())
+
+
+class UpdateBundleTrafficTests(TestCase):
+    def test_base(self):
+        DistributionBundleFactory.create(code_name='default')
+        with tempfile.NamedTemporaryFile('w', suffix='.csv') as fp:
+            fp.write('/Firefox/el/default.json,40\n'
+                     '/Firefox/el/release/default.json,2\n'
+                     '/Firefox/el/unknown.json,10\n')
+            fp.flush()
+            stdout = StringIO()
+            call_command('update_bundle_traffic', fp.name, stdout=stdout)
+
+        self.assertEqual(list(models.BundleTraffic.objects.values_list('locale', 'requests')),
+                         [('el', 42)])
+        self.assertIn('Updated the traffic of 1 bundles', stdout.getvalue())
+
+
+class BundleSizeReportTests(TestCase):
+    def test_base(self):
+        stdout = StringIO()
+        with patch('snippets.base.management.commands.'
+                   'bundle_size_report.bundles') as bundles_mock:
+            bundles_mock.get_size_report.return_value = {
+                'bundles': [
+                    {'path': 'Firefox/el/default.json', 'number_of_snippets': 1,
+                     'raw': 100, 'brotli': 20},
+                    {'path': 'Firefox/fr/default.json', 'number_of_snippets': 2,
+                     'raw': 200, 'brotli': 40},
+                ],
+                'messages': [
+                    {'job': 1, 'snippet': 'Foo', 'template': 'simple_snippet', 'raw': 100,
+                     'brotli': 20, 'bundles': 3, 'fields': {}},
+                ],
+                'templates': {'simple_snippet': {'count': 3, 'raw': 300, 'brotli': 60}},
+                'fields': {'text': 150, 'icons': 50},
+            }
+            call_command('bundle_size_report', limit=1, stdout=stdout)
+
+        output = stdout.getvalue()
+        self.assertIn('Firefox/fr/default.json', output)
+        self.assertNotIn('Firefox/el/default.json', output)
+        self.assertIn('75.0%', output)
+
+
+class BundleEncodingReportTests(TestCase):
+    def test_base(self):
+        stdout = StringIO()
+        with patch('snippets.base.management.commands.'
+                   'bundle_encoding_report.bundles') as bundles_mock:
+            bundles_mock.get_encoding_sizes.return_value = {
+                'default': {'raw': 100, 'brotli': 20},
+                'minified': {'raw': 80, 'brotli': 18},
+            }
+            call_command('bundle_encoding_report', stdout=stdout)
+
+        self.assertIn('20.0%', stdout.getvalue())
 
 
 @override_settings(REDASH_API_KEY='secret')
@@ -0,0 +1,38 @@
+from unittest.mock import patch
+
+from django.test.utils import override_settings
+
+from snippets.base import locales
+from snippets.base.locales import LocaleIndex
+from snippets.base.tests import TestCase
+
+
+class LocaleIndexTests(TestCase):
+    def setUp(self):
+        self.index = LocaleIndex(['en-US', 'en-GB', 'el', 'es-ES', 'es-MX', 'fr'])
+
+    def test_expand(self):
+        self.assertEqual(self.index.expand(['en']), ['en-gb', 'en-us'])
+        self.assertEqual(self.index.expand(['EN-US', 'en', 'e']),
+                         ['el', 'en-gb', 'en-us', 'es-es', 'es-mx'])
+        self.assertEqual(self.index.expand(['de']), [])
+        self.assertEqual(self.index.expand(['fr-fr']), [])
+
+    def test_contains(self):
+        self.assertIn('en-us', self.index)
+        self.assertIn('EN-US', self.index)
+        self.assertNotIn('en', self.index)
+
+    def test_get_locale_index(self):
+        with patch('snippets.base.locales.product_details') as product_details_mock, \
+                patch('snippets.base.locales._locale_index', None):
+            product_details_mock.languages.keys.return_value = ['el']
+            index = locales.get_locale_index()
+            self.assertEqual(index.locales, ['el'])
+            self.assertIs(locales.get_locale_index(), index)
+
+            # Updates get picked up after the timeout.
+            product_details_mock.languages.keys.return_value = ['el', 'fr']
+            self.assertEqual(locales.get_locale_index().locales, ['el'])
+            with override_settings(LOCALE_INDEX_TIMEOUT=0):
+                self.assertEqual(locales.get_locale_index().locales, ['el', 'fr'])
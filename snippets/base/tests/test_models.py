@@ -15,6 +15,7 @@ from django.test.utils import override_settings
 from django.urls import reverse
 
 from snippets.base.models import (STATUS_CHOICES,
+                                  DirtyBundle,
                                   Icon,
                                   Locale,
                                   Job,
@@ -445,6 +446,14 @@ class LocaleTests(TestCase):
         locale.save()
         self.assertEqual(locale.code, ',bar,')
 
+    def test_sync_codes(self):
+        locale = Locale.objects.create(name='foo', code='es-MX,es-AR')
+        self.assertEqual(set(locale.codes.values_list('code', flat=True)), {'es-mx', 'es-ar'})
+
+        locale.code = ',es-ar,es-cl,'
+        locale.save()
+        self.assertEqual(set(locale.codes.values_list('code', flat=True)), {'es-ar', 'es-cl'})
+
 
 class JobTests(TestCase):
     def test_channels(self):
@@ -515,6 +524,49 @@ class JobTests(TestCase):
         generated_output = job.render(always_eval_to_false=True)
         self.assertEqual(generated_output['targeting'], '(la==lo) && false')
 
+    def test_render_cache(self):
+        job = JobFactory.create(targets=[TargetFactory(jexl_expr='foo==bar')])
+        with patch.object(Job, '_render', autospec=True, return_value={'id': 'foo'}) as render_mock:
+            self.assertEqual(job.render(), {'id': 'foo'})
+            self.assertEqual(job.render(), {'id': 'foo'})
+            self.assertEqual(render_mock.call_count, 1)
+
+            # A different argument renders again.
+            job.render(always_eval_to_false=True)
+            self.assertEqual(render_mock.call_count, 2)
+
+            # Changing a Target invalidates the cached render.
+            target = job.targets.get()
+            target.jexl_expr = 'bar==foo'
+            target.save()
+            job.render()
+            self.assertEqual(render_mock.call_count, 3)
+
+            # Adding a Target invalidates the cached render.
+            job.targets.add(TargetFactory())
+            job.render()
+            self.assertEqual(render_mock.call_count, 4)
+
+    @override_settings(JOB_RENDER_CACHE_TIMEOUT=0)
+    def test_render_cache_disabled(self):
+        job = JobFactory.create()
+        with patch.object(Job, '_render', autospec=True, return_value={}) as render_mock:
+            job.render()
+            job.render()
+        self.assertEqual(render_mock.call_count, 2)
+
+    def test_render_cache_key(self):
+        job = JobFactory.create()
+        cache_key = job.get_render_cache_key()
+        self.assertTrue(cache_key.startswith(f'job-render:{job.id}:'))
+        self.assertNotEqual(cache_key, job.get_render_cache_key(always_eval_to_false=True))
+
+        icon = job.snippet.template_ng.icon
+        icon.name = 'new name'
+        icon.save()
+        job.refresh_from_db()
+        self.assertNotEqual(cache_key, job.get_render_cache_key())
+
     def test_render_client_limits(self):
         # Combined
         job = JobFactory.create(
@@ -635,3 +687,76 @@ class TargetTests(TestCase):
         self.assertTrue(target.is_custom)
         not_custom_target = TargetFactory(filtr_is_default_browser='true')
         self.assertFalse(not_custom_target.is_custom)
+
+
+class DirtyBundleTests(TestCase):
+    def setUp(self):
+        self.distribution_bundle = DistributionBundleFactory(code_name='default')
+        self.job = JobFactory(status=Job.DRAFT, snippet__locale=',en,el,')
+        self.distribution_bundle.distributions.add(self.job.distribution)
+        DirtyBundle.objects.all().delete()
+
+    def dirty_bundles(self):
+        return set(DirtyBundle.objects.values_list('locale', 'distribution_bundle__code_name'))
+
+    def test_mark(self):
+        DirtyBundle.mark(Job.objects.all())
+        DirtyBundle.mark(Job.objects.all())
+        self.assertEqual(self.dirty_bundles(), {('en', 'default'), ('el', 'default')})
+
+    def test_mark_notify(self):
+        with patch('snippets.base.models.connection') as connection_mock:
+            connection_mock.vendor = 'postgresql'
+            DirtyBundle.mark(Job.objects.none())
+            connection_mock.cursor.assert_not_called()
+
+            DirtyBundle.mark(Job.objects.all())
+        cursor = connection_mock.cursor.return_value.__enter__.return_value
+        cursor.execute.assert_called_once_with('NOTIFY snippets_dirty_bundles')
+
+    def test_job_status_change(self):
+        self.job.change_status(Job.PUBLISHED, send_slack=False)
+        self.assertEqual(self.dirty_bundles(), {('en', 'default'), ('el', 'default')})
+
+    def test_draft_job_snippet_change(self):
+        self.job.snippet.name = 'foo'
+        self.job.snippet.save()
+        self.assertEqual(self.dirty_bundles(), set())
+
+    def test_published_job_snippet_locale_change(self):
+        self.job.change_status(Job.PUBLISHED, send_slack=False)
+        DirtyBundle.objects.all().delete()
+
+        snippet = self.job.snippet
+        snippet.locale = Locale.objects.create(code=',fr,', name='French')
+        snippet.save()
+        # Both the previous and the new locales are dirty.
+        self.assertEqual(self.dirty_bundles(),
+                         {('en', 'default'), ('el', 'default'), ('fr', 'default')})
+
+    def test_target_change(self):
+        self.job.change_status(Job.PUBLISHED, send_slack=False)
+        DirtyBundle.objects.all().delete()
+
+        target = self.job.targets.get()
+        target.save()
+        self.assertEqual(self.dirty_bundles(), {('en', 'default'), ('el', 'default')})
+
+    def test_distribution_bundle_distributions_change(self):
+        self.job.change_status(Job.PUBLISHED, send_slack=False)
+        distribution_bundle = DistributionBundleFactory(code_name='other')
+        DirtyBundle.objects.all().delete()
+
+        distribution_bundle.distributions.add(self.job.distribution)
+        self.assertEqual(self.dirty_bundles(), {('en', 'default'), ('el', 'default'),
+                                                ('en', 'other'), ('el', 'other')})
+        DirtyBundle.objects.all().delete()
+
+        # Removed Distributions get marked while they still belong to the
+        # DistributionBundle.
+        self.job.distribution.distributionbundle_set.remove(distribution_bundle)
+        self.assertIn(('en', 'other'), self.dirty_bundles())
+        DirtyBundle.objects.all().delete()
+
+        self.distribution_bundle.distributions.clear()
+        self.assertEqual(self.dirty_bundles(), {('en', 'default'), ('el', 'default')})
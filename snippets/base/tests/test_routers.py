@@ -0,0 +1,30 @@
+from snippets.base.models import DirtyBundle, Job
+from snippets.base.routers import BundleSnapshotRouter, current_snapshot
+from snippets.base.tests import JobFactory, TestCase
+
+
+class BundleSnapshotRouterTests(TestCase):
+    def setUp(self):
+        self.router = BundleSnapshotRouter()
+
+    def test_db_for_read(self):
+        self.assertEqual(self.router.db_for_read(Job), None)
+
+        token = current_snapshot.set(('bundles', {'xmin': 1, 'timestamp': ''}))
+        try:
+            self.assertEqual(self.router.db_for_read(Job), 'bundles')
+            # Bookkeeping models always get read from the default database.
+            self.assertEqual(self.router.db_for_read(DirtyBundle), None)
+        finally:
+            current_snapshot.reset(token)
+
+    def test_db_for_write(self):
+        job = JobFactory()
+        self.assertEqual(self.router.db_for_write(Job, instance=job), None)
+        job._state.db = 'bundles'
+        self.assertEqual(self.router.db_for_write(Job, instance=job), 'default')
+        self.assertTrue(self.router.allow_relation(job, JobFactory()))
+
+    def test_allow_migrate(self):
+        self.assertFalse(self.router.allow_migrate('bundles', 'base'))
+        self.assertEqual(self.router.allow_migrate('default', 'base'), None)
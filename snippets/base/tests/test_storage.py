@@ -0,0 +1,142 @@
+import tempfile
+from unittest.mock import patch
+
+from botocore.exceptions import ClientError
+from django.core.files.base import ContentFile
+from django.test.utils import override_settings
+
+from snippets.base.storage import OverwriteStorage, S3Storage
+from snippets.base.tests import TestCase
+
+
+class OverwriteStorageTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.storage = OverwriteStorage(location=directory.name)
+
+    def test_content_hash(self):
+        content_file = ContentFile(b'foo')
+        content_file.content_hash = 'abc'
+        self.storage.save('bundle.json', content_file)
+        self.assertEqual(self.storage.get_content_hash('bundle.json'), 'abc')
+
+        content_file = ContentFile(b'bar')
+        content_file.content_hash = 'def'
+        self.storage.save('bundle.json', content_file)
+        self.assertEqual(self.storage.get_content_hash('bundle.json'), 'def')
+        with self.storage.open('bundle.json') as fp:
+            self.assertEqual(fp.read(), b'bar')
+
+        self.storage.delete('bundle.json')
+        self.assertFalse(self.storage.exists('bundle.json.sha256'))
+        self.assertIsNone(self.storage.get_content_hash('bundle.json'))
+
+    def test_no_content_hash(self):
+        self.storage.save('bundle.json', ContentFile(b'foo'))
+        self.assertIsNone(self.storage.get_content_hash('bundle.json'))
+
+    def test_list_files(self):
+        self.assertEqual(self.storage.list_files('bundles'), set())
+        self.storage.save('bundles/Firefox/el/default.json', ContentFile(b'foo'))
+        self.storage.save('bundles/manifest.json', ContentFile(b'foo'))
+        self.storage.save('other.json', ContentFile(b'foo'))
+        self.assertEqual(self.storage.list_files('bundles'),
+                         {'bundles/Firefox/el/default.json', 'bundles/manifest.json'})
+
+        self.storage.delete_many(['bundles/Firefox/el/default.json', 'bundles/missing.json'])
+        self.assertEqual(self.storage.list_files('bundles/'), {'bundles/manifest.json'})
+
+    def test_move(self):
+        content_file = ContentFile(b'foo')
+        content_file.content_hash = 'abc'
+        self.storage.save('staging/bundle.json', content_file)
+        self.storage.save('bundles/bundle.json', ContentFile(b'bar'))
+
+        self.storage.move('staging/bundle.json', 'bundles/bundle.json')
+        self.assertFalse(self.storage.exists('staging/bundle.json'))
+        self.assertFalse(self.storage.exists('staging/bundle.json.sha256'))
+        self.assertEqual(self.storage.get_content_hash('bundles/bundle.json'), 'abc')
+        with self.storage.open('bundles/bundle.json') as fp:
+            self.assertEqual(fp.read(), b'foo')
+
+        self.storage.save('staging/bundle.json', ContentFile(b'baz'))
+        self.storage.move('staging/bundle.json', 'bundles/bundle.json')
+        self.assertIsNone(self.storage.get_content_hash('bundles/bundle.json'))
+
+    def test_copy(self):
+        content_file = ContentFile(b'foo')
+        content_file.content_hash = 'abc'
+        self.storage.save('objects/abc.json', content_file)
+
+        self.storage.copy('objects/abc.json', 'bundles/bundle.json')
+        self.assertEqual(self.storage.get_content_hash('objects/abc.json'), 'abc')
+        self.assertEqual(self.storage.get_content_hash('bundles/bundle.json'), 'abc')
+        with self.storage.open('bundles/bundle.json') as fp:
+            self.assertEqual(fp.read(), b'foo')
+
+
+@override_settings(AWS_STORAGE_BUCKET_NAME='bucket')
+class S3StorageTests(TestCase):
+    def test_write_parameters(self):
+        storage = S3Storage()
+        content_file = ContentFile(b'foo')
+        content_file.content_encoding = 'br'
+        content_file.content_hash = 'abc'
+        params = storage._get_write_parameters('bundle.json', content_file)
+        self.assertEqual(params['ContentEncoding'], 'br')
+        self.assertEqual(params['Metadata'], {'content-hash': 'abc'})
+
+    def test_get_content_hash(self):
+        storage = S3Storage()
+        with patch.object(S3Storage, 'connection') as connection_mock:
+            head_object = connection_mock.meta.client.head_object
+            head_object.return_value = {'Metadata': {'content-hash': 'abc'}}
+            self.assertEqual(storage.get_content_hash('bundle.json'), 'abc')
+
+            head_object.side_effect = ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+            self.assertIsNone(storage.get_content_hash('bundle.json'))
+
+    def test_move(self):
+        storage = S3Storage()
+        with patch.object(S3Storage, 'connection') as connection_mock, \
+                patch.object(S3Storage, 'delete') as delete_mock:
+            storage.move('staging/bundle.json', 'bundles/bundle.json')
+
+        connection_mock.meta.client.copy_object.assert_called_with(
+            Bucket='bucket',
+            Key='bundles/bundle.json',
+            CopySource={'Bucket': 'bucket', 'Key': 'staging/bundle.json'},
+        )
+        delete_mock.assert_called_with('staging/bundle.json')
+
+    def test_list_files(self):
+        storage = S3Storage()
+        with patch.object(S3Storage, 'connection') as connection_mock:
+            paginator = connection_mock.meta.client.get_paginator.return_value
+            paginator.paginate.return_value = [
+                {'Contents': [{'Key': 'bundles/Firefox/el/default.json'}]},
+                {'Contents': [{'Key': 'bundles/manifest.json'}]},
+            ]
+            self.assertEqual(storage.list_files('bundles/'),
+                             {'bundles/Firefox/el/default.json', 'bundles/manifest.json'})
+        paginator.paginate.assert_called_with(Bucket='bucket', Prefix='bundles/')
+
+    def test_delete_many(self):
+        storage = S3Storage()
+        names = [f'bundles/{i}.json' for i in range(1001)]
+        with patch.object(S3Storage, 'connection') as connection_mock:
+            delete_objects = connection_mock.meta.client.delete_objects
+            delete_objects.return_value = {}
+            storage.delete_many(names)
+
+            self.assertEqual(delete_objects.call_count, 2)
+            self.assertEqual(len(delete_objects.call_args_list[0][1]['Delete']['Objects']), 1000)
+            delete_objects.assert_called_with(
+                Bucket='bucket',
+                Delete={'Objects': [{'Key': 'bundles/1000.json'}], 'Quiet': True},
+            )
+
+            delete_objects.return_value = {
+                'Errors': [{'Key': 'bundles/1.json', 'Message': 'Access Denied'}]}
+            self.assertRaises(IOError, storage.delete_many, names[:2])
@@ -96,8 +96,14 @@ WSGI_APPLICATION = 'snippets.wsgi.application'
 # https://docs.djangoproject.com/en/1.7/ref/settings/#databases
 
 DATABASES = {
-    'default': config('DATABASE_URL', cast=dj_database_url.parse)
+    'default': config('DATABASE_URL', cast=dj_database_url.parse),
+    # Bundles get generated from this database, e.g. a read replica.
+    # Defaults to the default database.
+    'bundles': config('BUNDLE_DATABASE_URL', default=config('DATABASE_URL'),
+                      cast=dj_database_url.parse),
 }
+DATABASES['bundles']['TEST'] = {'MIRROR': 'default'}
+DATABASE_ROUTERS = ['snippets.base.routers.BundleSnapshotRouter']
 
 SILENCED_SYSTEM_CHECKS = [
 ]
@@ -202,6 +208,89 @@ SNIPPET_BUNDLE_PREGEN_REDIRECT_TIMEOUT = config(
     'SNIPPET_BUNDLE_PREGEN_REDIRECT_TIMEOUT', default=60 * 60 * 24, cast=int)  # One day
 
 BUNDLE_BROTLI_COMPRESS = config('BUNDLE_BROTLI_COMPRESS', default=False, cast=bool)
+# Comma separated list of `br`, `gzip` and `identity`. The first encoding
+# gets stored in the bundle path and the rest next to it with `.br`, `.gz`
+# or `.raw` appended. Defaults to BUNDLE_BROTLI_COMPRESS.
+BUNDLE_ENCODINGS = config('BUNDLE_ENCODINGS', default='', cast=Csv())
+BUNDLE_BROTLI_QUALITY = config('BUNDLE_BROTLI_QUALITY', default=11, cast=int)
+BUNDLE_BROTLI_WINDOW = config('BUNDLE_BROTLI_WINDOW', default=22, cast=int)
+BUNDLE_GZIP_LEVEL = config('BUNDLE_GZIP_LEVEL', default=9, cast=int)
+BUNDLE_COMPRESSION_THREADS = config('BUNDLE_COMPRESSION_THREADS', default=4, cast=int)
+# Bundle files get uploaded under a staging prefix and moved into place once
+# all of them are uploaded.
+BUNDLE_STAGED_PUBLISH = config('BUNDLE_STAGED_PUBLISH', default=True, cast=bool)
+BUNDLE_UPLOAD_THREADS = config('BUNDLE_UPLOAD_THREADS', default=8, cast=int)
+# Render and compress bundles one chunk of Jobs at a time into temporary
+# files, to keep memory usage flat with large numbers of Jobs.
+BUNDLE_STREAMING = config('BUNDLE_STREAMING', default=False, cast=bool)
+BUNDLE_STREAMING_CHUNK_SIZE = config('BUNDLE_STREAMING_CHUNK_SIZE', default=100, cast=int)
+# Maximum size in bytes of a bundle file, as shipped with its first encoding.
+# Zero disables the budget. BUNDLE_SIZE_BUDGET_ACTION is `warn` or `fail`.
+BUNDLE_SIZE_BUDGET = config('BUNDLE_SIZE_BUDGET', default=0, cast=int)
+BUNDLE_SIZE_BUDGET_ACTION = config('BUNDLE_SIZE_BUDGET_ACTION', default='warn')
+# Generate one bundle per channel under Firefox/{locale}/{channel}/ instead of
+# one for all channels. The redirector must be configured the same.
+BUNDLE_CHANNEL_PARTITIONING = config('BUNDLE_CHANNEL_PARTITIONING', default=False, cast=bool)
+# Prestage the bundles of the Jobs getting published or completed within the
+# next BUNDLE_PRESTAGE_HORIZON minutes, to promote them at their publish time.
+BUNDLE_PRESTAGE = config('BUNDLE_PRESTAGE', default=False, cast=bool)
+BUNDLE_PRESTAGE_HORIZON = config('BUNDLE_PRESTAGE_HORIZON', default=60, cast=int)
+# Keep a content-addressed copy of every bundle written and record the
+# changes of each run, for rollback_bundles. Runs older than
+# BUNDLE_HISTORY_DAYS get pruned, along with the copies only they refer to.
+BUNDLE_HISTORY = config('BUNDLE_HISTORY', default=True, cast=bool)
+BUNDLE_HISTORY_DAYS = config('BUNDLE_HISTORY_DAYS', default=30, cast=int)
+# `generate_bundles --distributed` splits the generation into work units that
+# `generate_bundles --worker` processes on any node. Workers lease
+# BUNDLE_LEASE_BATCH units for BUNDLE_LEASE_SECONDS at a time and retry
+# failed units up to BUNDLE_LEASE_ATTEMPTS times.
+BUNDLE_DISTRIBUTED = config('BUNDLE_DISTRIBUTED', default=False, cast=bool)
+BUNDLE_LEASE_SECONDS = config('BUNDLE_LEASE_SECONDS', default=300, cast=int)
+BUNDLE_LEASE_BATCH = config('BUNDLE_LEASE_BATCH', default=20, cast=int)
+BUNDLE_LEASE_ATTEMPTS = config('BUNDLE_LEASE_ATTEMPTS', default=3, cast=int)
+BUNDLE_WORKER_POLL_INTERVAL = config('BUNDLE_WORKER_POLL_INTERVAL', default=5, cast=int)
+# Regenerate dirty bundles from the `bundle_daemon` process, as soon as they
+# get marked, instead of from the clock process every minute. In seconds.
+BUNDLE_DAEMON = config('BUNDLE_DAEMON', default=False, cast=bool)
+BUNDLE_DAEMON_DEBOUNCE = config('BUNDLE_DAEMON_DEBOUNCE', default=2, cast=float)
+BUNDLE_DAEMON_MAX_DELAY = config('BUNDLE_DAEMON_MAX_DELAY', default=10, cast=float)
+BUNDLE_DAEMON_IDLE_TIMEOUT = config('BUNDLE_DAEMON_IDLE_TIMEOUT', default=300, cast=float)
+
+
+def _cast_weight(value):
+    name, weight = value.rsplit(':', 1)
+    return name, float(weight)
+
+
+# Traffic weights of bundles, to generate the ones with the most traffic
+# first. Weights are given as e.g. `en-us:40,de:10` and a bundle weighs its
+# locale weight times its DistributionBundle weight, with unlisted ones
+# weighing BUNDLE_TRAFFIC_DEFAULT_WEIGHT. The shares of the configured weights
+# get averaged with the shares of the BundleTraffic requests, which
+# `update_bundle_traffic` loads.
+# generate_bundles reports the seconds until each BUNDLE_TRAFFIC_COVERAGE
+# percent of the traffic to the written bundles got the new files.
+BUNDLE_LOCALE_WEIGHTS = config('BUNDLE_LOCALE_WEIGHTS', default='',
+                               cast=Csv(cast=_cast_weight, post_process=dict))
+BUNDLE_DISTRIBUTION_WEIGHTS = config('BUNDLE_DISTRIBUTION_WEIGHTS', default='',
+                                     cast=Csv(cast=_cast_weight, post_process=dict))
+BUNDLE_TRAFFIC_DEFAULT_WEIGHT = config('BUNDLE_TRAFFIC_DEFAULT_WEIGHT', default=1, cast=float)
+BUNDLE_TRAFFIC_COVERAGE = config('BUNDLE_TRAFFIC_COVERAGE', default='50,90,99',
+                                 cast=Csv(cast=int))
+# Generate bundles from a single REPEATABLE READ READ ONLY snapshot of the
+# BUNDLE_DATABASE_ALIAS database. Requires PostgreSQL. Off by default until
+# it has been run with the pool, distributed and daemon generation.
+BUNDLE_SNAPSHOT = config('BUNDLE_SNAPSHOT', default=False, cast=bool)
+BUNDLE_DATABASE_ALIAS = 'bundles'
+# Bundles identical to a bundle of another locale with more traffic don't get
+# uploaded but listed in `aliases.json`, for the redirector to redirect to
+# that bundle. Must match the BUNDLE_LOCALE_ALIASES setting of the redirector.
+BUNDLE_LOCALE_ALIASES = config('BUNDLE_LOCALE_ALIASES', default=False, cast=bool)
+# Minify bundles and leave out values equal to Firefox's defaults.
+BUNDLE_COMPACT_ENCODING = config('BUNDLE_COMPACT_ENCODING', default=False, cast=bool)
+
+# In seconds. Set to zero to disable caching of rendered Jobs.
+JOB_RENDER_CACHE_TIMEOUT = config('JOB_RENDER_CACHE_TIMEOUT', default=60 * 60 * 24, cast=int)
 
 SITE_URL = config('SITE_URL', default='')
 SITE_HEADER = config('SITE_HEADER', default='Snippets Administration')
@@ -224,6 +313,9 @@ PROD_DETAILS_STORAGE = config('PROD_DETAILS_STORAGE',
                               default='product_details.storage.PDFileStorage')
 PROD_DETAILS_DIR = config('PROD_DETAILS_DIR',
                           default=product_details.settings_defaults.PROD_DETAILS_DIR)
+# Seconds before the index of product_details locales gets rebuilt, for
+# running processes to pick up the updates of `update_product_details`.
+LOCALE_INDEX_TIMEOUT = config('LOCALE_INDEX_TIMEOUT', default=60 * 60, cast=int)
 
 DEFAULT_FILE_STORAGE = config('FILE_STORAGE', 'snippets.base.storage.OverwriteStorage')
 
@@ -10,6 +10,8 @@ from django.urls import include, path, re_path
 import sentry_sdk
 from ratelimit.exceptions import Ratelimited
 
+from snippets.base.bundles import get_bundle_file_encoding
+
 
 def robots_txt(request):
     permission = 'Allow' if settings.ENGAGE_ROBOTS else 'Disallow'
@@ -58,9 +60,10 @@ if settings.DEBUG:
     def serve_media(*args, **kwargs):
         response = static_serve(*args, **kwargs)
         response['Access-Control-Allow-Origin'] = '*'
-        if (settings.BUNDLE_BROTLI_COMPRESS and
-                kwargs['path'].startswith(settings.MEDIA_BUNDLES_PREGEN_ROOT)):
-            response['Content-Encoding'] = 'br'
+        if kwargs['path'].startswith(settings.MEDIA_BUNDLES_PREGEN_ROOT):
+            encoding = get_bundle_file_encoding(kwargs['path'])
+            if encoding != 'identity':
+                response['Content-Encoding'] = encoding
         return response
 
     urlpatterns += [